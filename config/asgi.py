@@ -13,4 +13,11 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Импорт после настройки Django: users.bloom и users.live обращаются к моделям
+from users.bloom import invite_codes  # noqa: E402
+from users.live import DisconnectMiddleware  # noqa: E402
+
+application = DisconnectMiddleware(django_application)
+invite_codes.warm_up()
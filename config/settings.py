@@ -27,14 +27,18 @@ INSTALLED_APPS = [
     "users",
 ]
 
+# Middleware из users.middleware - стандартные, но пропускающие запросы к JSON API
+# (API_PREFIX): для них не загружаются сессии и не проверяется CSRF
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
+    "users.middleware.APIGZipMiddleware",
+    "users.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
-    "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware",
-    "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "users.middleware.CsrfViewMiddleware",
+    "users.middleware.AuthenticationMiddleware",
+    "users.middleware.MessageMiddleware",
+    "users.middleware.XFrameOptionsMiddleware",
+    "users.profiling.ProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "config.urls"
@@ -58,13 +62,21 @@ TEMPLATES = [
 WSGI_APPLICATION = "config.wsgi.application"
 
 REST_FRAMEWORK = {
-    "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
-    ),
+    "DEFAULT_AUTHENTICATION_CLASSES": ("users.auth_backends.ShardedJWTAuthentication",),
+    # FastJSONRenderer и FastJSONParser используют orjson, если он установлен,
+    # иначе работают как стандартные JSONRenderer и JSONParser
     "DEFAULT_RENDERER_CLASSES": [
-        "rest_framework.renderers.JSONRenderer",
+        "users.renderers.FastJSONRenderer",
         "rest_framework.renderers.TemplateHTMLRenderer",
     ],
+    "DEFAULT_PARSER_CLASSES": [
+        "users.renderers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
+    "DEFAULT_THROTTLE_RATES": {
+        "batch_lookup": os.getenv("BATCH_LOOKUP_THROTTLE_RATE") or "60/min",
+    },
 }
 
 DATABASES = {
@@ -78,6 +90,26 @@ DATABASES = {
     }
 }
 
+# Шардирование пользователей по номеру телефона (см. users/sharding.py).
+# USER_SHARDS - алиасы баз данных-шардов, пустой список - шардирование выключено.
+# В базе default хранится глобальный справочник пользователей.
+# USER_SHARD_HOSTS - хосты Postgres для шардов через запятую,
+# USER_SHARDS_SQLITE - количество локальных SQLite-шардов для разработки и тестов.
+USER_SHARDS = []
+if os.getenv("USER_SHARDS_SQLITE"):
+    for index in range(int(os.getenv("USER_SHARDS_SQLITE"))):
+        DATABASES[f"shard_{index}"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / f"shard_{index}.sqlite3",
+        }
+        USER_SHARDS.append(f"shard_{index}")
+elif os.getenv("USER_SHARD_HOSTS"):
+    for index, host in enumerate(os.getenv("USER_SHARD_HOSTS").split(",")):
+        DATABASES[f"shard_{index}"] = {**DATABASES["default"], "HOST": host.strip()}
+        USER_SHARDS.append(f"shard_{index}")
+
+DATABASE_ROUTERS = ["users.routers.UserShardRouter"]
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -103,6 +135,18 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 STATICFILES_DIRS = (BASE_DIR / "static",)
+STATIC_ROOT = os.getenv("STATIC_ROOT") or BASE_DIR / "staticfiles"
+
+# collectstatic добавляет в имена файлов хэш содержимого и пишет сжатые копии .gz
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "users.assets.CompressedManifestStaticFilesStorage"},
+}
+
+# Отдавать собранную статику из STATIC_ROOT средствами приложения (users.assets.serve_static)
+SERVE_STATIC = (os.getenv("SERVE_STATIC") or "True") == "True"
+# Время кэширования (в секундах) статики без хэша в имени файла
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE") or 60)
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
@@ -119,5 +163,107 @@ SIMPLE_JWT = {
 
 AUTHENTICATION_BACKENDS = ["users.auth_backends.EnterCodeBackend"]
 
+# Общий кэш процессов приложения. Без REDIS_URL используется LocMemCache, который у каждого
+# процесса свой: объединение запросов кода, лимит попыток ввода кода, коды JSON API и
+# Idempotency-Key тогда работают только в пределах одного процесса
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+
 SMSAERO_EMAIL = os.getenv("SMSAERO_EMAIL")
 SMSAERO_API_KEY = os.getenv("SMSAERO_API_KEY")
+
+# Время (в секундах), в течение которого повторные запросы кода на тот же номер
+# телефона получают уже выданный код вместо генерации нового и повторной отправки смс
+ENTER_CODE_COALESCE_TIMEOUT = int(os.getenv("ENTER_CODE_COALESCE_TIMEOUT") or 60)
+# Время (в секундах), в течение которого можно завершить регистрацию нового номера вводом кода
+PENDING_REGISTRATION_TTL = int(os.getenv("PENDING_REGISTRATION_TTL") or 900)
+# Время жизни (в секундах) кода входа, выданного клиенту JSON API без сессии
+ENTER_CODE_TIMEOUT = int(os.getenv("ENTER_CODE_TIMEOUT") or 300)
+# Число попыток ввода кода для одного номера телефона за ENTER_CODE_ATTEMPTS_WINDOW секунд
+ENTER_CODE_MAX_ATTEMPTS = int(os.getenv("ENTER_CODE_MAX_ATTEMPTS") or 5)
+ENTER_CODE_ATTEMPTS_WINDOW = int(os.getenv("ENTER_CODE_ATTEMPTS_WINDOW") or 900)
+
+# Transactional outbox для событий реферальной системы
+OUTBOX_SINK = os.getenv("OUTBOX_SINK") or "users.outbox.LocMemSink"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE") or 500)
+OUTBOX_FILE_PATH = os.getenv("OUTBOX_FILE_PATH") or os.path.join(
+    BASE_DIR, "outbox.jsonl"
+)
+OUTBOX_HTTP_URL = os.getenv("OUTBOX_HTTP_URL")
+OUTBOX_HTTP_TIMEOUT = float(os.getenv("OUTBOX_HTTP_TIMEOUT") or 5)
+
+# Инкрементальный пересчёт дневной статистики (команда update_rollups)
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE") or 10000)
+# Возраст (в секундах), после которого строка учитывается в статистике. Должен быть больше
+# времени самой долгой транзакции, вставляющей события outbox
+ROLLUP_SAFETY_LAG = int(os.getenv("ROLLUP_SAFETY_LAG") or 60)
+
+# Загрузка аватаров
+AVATAR_MAX_UPLOAD_SIZE = int(os.getenv("AVATAR_MAX_UPLOAD_SIZE") or 5 * 1024 * 1024)
+AVATAR_MAX_PIXELS = int(os.getenv("AVATAR_MAX_PIXELS") or 4096 * 4096)
+AVATAR_ALLOWED_FORMATS = ("JPEG", "PNG", "WEBP")
+AVATAR_THUMBNAIL_SIZES = (64, 128, 256)
+# Количество процессов для генерации миниатюр, 0 - генерировать в процессе запроса
+AVATAR_THUMBNAIL_WORKERS = int(os.getenv("AVATAR_THUMBNAIL_WORKERS") or 2)
+
+# Время жизни (в секундах) кэша сериализованного профиля пользователя
+PROFILE_CACHE_TIMEOUT = int(os.getenv("PROFILE_CACHE_TIMEOUT") or 300)
+
+# Фильтр Блума инвайт-кодов (users.bloom): доля ложноположительных ответов,
+# период подгрузки кодов из других процессов и перекрытие подгрузок (больше времени самой
+# долгой транзакции, создающей пользователей) в секундах
+INVITE_CODE_BLOOM_ENABLED = (os.getenv("INVITE_CODE_BLOOM_ENABLED") or "True") == "True"
+INVITE_CODE_BLOOM_ERROR_RATE = float(os.getenv("INVITE_CODE_BLOOM_ERROR_RATE") or 0.01)
+INVITE_CODE_BLOOM_SYNC_INTERVAL = float(
+    os.getenv("INVITE_CODE_BLOOM_SYNC_INTERVAL") or 5
+)
+INVITE_CODE_BLOOM_SYNC_OVERLAP = float(
+    os.getenv("INVITE_CODE_BLOOM_SYNC_OVERLAP") or 60
+)
+
+# Максимальное количество значений в одном запросе пакетной проверки (/users/lookup/)
+BATCH_LOOKUP_MAX_ITEMS = int(os.getenv("BATCH_LOOKUP_MAX_ITEMS") or 1000)
+
+# JSON API без сессий и HTML (API_PREFIX + v2/, по умолчанию /api/v2/)
+# и минимальный размер ответа для сжатия gzip
+API_PREFIX = os.getenv("API_PREFIX") or "/api/"
+API_GZIP_MIN_SIZE = int(os.getenv("API_GZIP_MIN_SIZE") or 1024)
+
+# Поток событий реферальной системы (users.live, /users/events/):
+# максимальное количество событий в очереди одного соединения, соединений одного пользователя
+# в процессе, интервал heartbeat и время жизни соединения (в секундах), пауза перед
+# переподключением клиента (в миллисекундах), время действия токена потока в адресе,
+# который получают страницы (в секундах). Если задан LIVE_EVENTS_SOCKET_DIR,
+# процессы обмениваются событиями через Unix-сокеты в этом каталоге
+LIVE_EVENTS_QUEUE_SIZE = int(os.getenv("LIVE_EVENTS_QUEUE_SIZE") or 100)
+LIVE_EVENTS_MAX_CONNECTIONS = int(os.getenv("LIVE_EVENTS_MAX_CONNECTIONS") or 5)
+LIVE_EVENTS_HEARTBEAT = float(os.getenv("LIVE_EVENTS_HEARTBEAT") or 15)
+LIVE_EVENTS_MAX_DURATION = float(os.getenv("LIVE_EVENTS_MAX_DURATION") or 300)
+LIVE_EVENTS_RETRY = int(os.getenv("LIVE_EVENTS_RETRY") or 3000)
+LIVE_EVENTS_TOKEN_TTL = int(os.getenv("LIVE_EVENTS_TOKEN_TTL") or 3600)
+LIVE_EVENTS_SOCKET_DIR = os.getenv("LIVE_EVENTS_SOCKET_DIR")
+
+# Заголовок Idempotency-Key (users.idempotency): время хранения ответа и время,
+# на которое занимается ключ выполняющегося запроса (в секундах)
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL") or 24 * 60 * 60)
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT") or 30)
+
+# Время (в секундах), на которое браузер может закэшировать страницы с формами
+FORM_PAGE_MAX_AGE = int(os.getenv("FORM_PAGE_MAX_AGE") or 600)
+
+# Профилирование запросов (users.profiling.ProfilingMiddleware, отчёт - команда profile_report)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED") == "True"
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE") or 0)
+PROFILING_URL_NAMES = [
+    name for name in (os.getenv("PROFILING_URL_NAMES") or "").split(",") if name
+]
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILING_DIR = os.getenv("PROFILING_DIR") or os.path.join(BASE_DIR, "profiles")
+# Сколько последних профилей хранить для каждого представления, более старые удаляются
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES") or 1000)
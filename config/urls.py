@@ -1,9 +1,13 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 
+from users.assets import serve_static
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Authentication and referral system",
@@ -20,6 +24,11 @@ schema_view = get_schema_view(
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("users/", include("users.urls", namespace="users")),
+    # Префикс совпадает с API_PREFIX, по которому middleware пропускает сессии и CSRF
+    path(
+        f"{settings.API_PREFIX.strip('/')}/v2/",
+        include("users.api_urls", namespace="api_v2"),
+    ),
     path(
         "swagger/",
         schema_view.with_ui("swagger", cache_timeout=0),
@@ -27,3 +36,11 @@ urlpatterns = [
     ),
     path("redoc/", schema_view.with_ui("redoc", cache_timeout=0), name="schema-redoc"),
 ]
+
+if settings.DEBUG:
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+if settings.SERVE_STATIC:
+    urlpatterns += [
+        re_path(rf"^{settings.STATIC_URL.lstrip('/')}(?P<path>.+)$", serve_static),
+    ]
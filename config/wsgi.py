@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
 application = get_wsgi_application()
+
+# Импорт после настройки Django: users.bloom обращается к моделям
+from users.bloom import invite_codes  # noqa: E402
+
+invite_codes.warm_up()
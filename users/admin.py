@@ -1,3 +1,76 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 
-# Register your models here.
+from users.models import User
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор, который для таблицы без фильтров берёт оценку количества строк
+    из pg_class.reltuples вместо COUNT(*) по всей таблице.
+    """
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if connection.vendor == "postgresql" and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [self.object_list.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            # reltuples равен -1 (или 0), пока таблица не проанализирована
+            if row and row[0] > 0:
+                return row[0]
+        return super().count
+
+
+@admin.register(User)
+class UserAdmin(admin.ModelAdmin):
+    list_display = (
+        "phone",
+        "invite_code",
+        "invited_by",
+        "referrals_count",
+        "is_active",
+        "is_staff",
+        "date_joined",
+    )
+    list_filter = ("is_staff", "is_active")
+    list_select_related = ("invited_by",)
+    # Поиск по префиксу (LIKE 'abc%') использует индексы *_like, которые Postgres
+    # создаёт для уникальных полей phone и invite_code
+    search_fields = ("^phone", "^invite_code")
+    raw_id_fields = ("invited_by",)
+    readonly_fields = ("last_login", "date_joined", "profile_version")
+    ordering = ("-id",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    exclude = ("password", "groups", "user_permissions")
+
+    def get_queryset(self, request):
+        """
+        Добавляет количество рефералов коррелированным подзапросом: он выполняется
+        только для строк текущей страницы, в отличие от GROUP BY по всей таблице.
+        """
+        referrals_count = (
+            User.objects.filter(invited_by=OuterRef("pk"))
+            .order_by()
+            .values("invited_by")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(referrals_count=Coalesce(Subquery(referrals_count), 0))
+        )
+
+    @admin.display(description="Рефералы")
+    def referrals_count(self, obj):
+        return obj.referrals_count
@@ -0,0 +1,71 @@
+from rest_framework.negotiation import DefaultContentNegotiation
+
+from users.auth_backends import ShardedJWTAuthentication
+from users.renderers import FastJSONRenderer
+from users.views import (
+    AvatarUploadAPIView,
+    BatchLookupAPIView,
+    MyTokenObtainPairView,
+    MyTokenRefreshView,
+    SetReferrerAPIView,
+    StatsAPIView,
+    UserGetCodeAPIView,
+    UserRetrieveAPIView,
+)
+
+
+class JSONOnlyNegotiation(DefaultContentNegotiation):
+    """
+    Выбор рендерера без разбора заголовка Accept: у представлений API
+    единственный рендерер, поэтому он и используется.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        renderer = renderers[0]
+        return renderer, renderer.media_type
+
+
+class JSONOnlyAPIMixin:
+    """
+    Миксин представлений JSON API (/api/v2/): только JSON и только JWT.
+    Для этих адресов users.middleware пропускает сессии, CSRF, сообщения
+    и защиту от clickjacking, а большие ответы сжимает gzip.
+    """
+
+    renderer_classes = [FastJSONRenderer]
+    authentication_classes = [ShardedJWTAuthentication]
+    content_negotiation_class = JSONOnlyNegotiation
+
+
+class GetCodeView(JSONOnlyAPIMixin, UserGetCodeAPIView):
+    pass
+
+
+class SendCodeView(JSONOnlyAPIMixin, MyTokenObtainPairView):
+    authentication_classes = ()
+    http_method_names = ["post", "options"]
+
+
+class RefreshView(JSONOnlyAPIMixin, MyTokenRefreshView):
+    authentication_classes = ()
+    http_method_names = ["post", "options"]
+
+
+class SetReferrerView(JSONOnlyAPIMixin, SetReferrerAPIView):
+    pass
+
+
+class RetrieveView(JSONOnlyAPIMixin, UserRetrieveAPIView):
+    pass
+
+
+class StatsView(JSONOnlyAPIMixin, StatsAPIView):
+    pass
+
+
+class AvatarUploadView(JSONOnlyAPIMixin, AvatarUploadAPIView):
+    pass
+
+
+class BatchLookupView(JSONOnlyAPIMixin, BatchLookupAPIView):
+    pass
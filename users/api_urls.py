@@ -0,0 +1,17 @@
+from django.urls import path
+
+from users import api, live
+
+app_name = "api_v2"
+
+urlpatterns = [
+    path("auth/get_code/", api.GetCodeView.as_view(), name="get_code"),
+    path("auth/send_code/", api.SendCodeView.as_view(), name="send_code"),
+    path("auth/refresh/", api.RefreshView.as_view(), name="token_refresh"),
+    path("set_referrer/", api.SetReferrerView.as_view(), name="set_referrer"),
+    path("retrieve/", api.RetrieveView.as_view(), name="retrieve"),
+    path("stats/", api.StatsView.as_view(), name="stats"),
+    path("avatar/", api.AvatarUploadView.as_view(), name="avatar"),
+    path("lookup/", api.BatchLookupView.as_view(), name="lookup"),
+    path("events/", live.events_stream, name="events"),
+]
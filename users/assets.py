@@ -0,0 +1,101 @@
+import gzip
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import (
+    ManifestStaticFilesStorage,
+    staticfiles_storage,
+)
+from django.core.files.base import ContentFile
+from django.http import Http404
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.static import serve
+
+# Имя файла с хэшем содержимого, которое добавляет ManifestStaticFilesStorage
+HASHED_NAME_RE = re.compile(r"\.[0-9a-f]{12}(\.[^/.]+)$")
+ACCEPTS_GZIP_RE = re.compile(r"\bgzip\b")
+
+# Год - максимальный срок, который имеет смысл указывать в Cache-Control
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Хранилище статики, которое при collectstatic добавляет в имена файлов хэш
+    содержимого и рядом с каждым текстовым файлом записывает сжатую копию .gz.
+    Сжатие выполняется один раз при сборке, а не при каждом запросе.
+    """
+
+    compressible_extensions = (".css", ".js", ".map", ".svg", ".txt", ".json")
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+
+        for name, hashed_name in self.hashed_files.items():
+            for path in (name, hashed_name):
+                if path.endswith(self.compressible_extensions):
+                    self.write_compressed(path)
+
+    def write_compressed(self, path: str) -> None:
+        """Записывает path.gz, если сжатие уменьшает размер файла"""
+        with self.open(path) as original:
+            content = original.read()
+        # mtime=0 делает результат воспроизводимым между сборками
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) >= len(content):
+            return
+        compressed_path = f"{path}.gz"
+        if self.exists(compressed_path):
+            self.delete(compressed_path)
+        self._save(compressed_path, ContentFile(compressed))
+
+    def stored_name(self, name):
+        """
+        Имя файла с хэшем. Пока collectstatic не запускался и манифеста нет (например,
+        при запуске тестов), возвращается исходное имя, а не ошибка рендеринга. Если
+        манифест есть, а файла в нём нет, ошибка не скрывается, как и с manifest_strict.
+        """
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            if self.hashed_files:
+                raise
+            return name
+
+    def is_hashed_name(self, name: str) -> bool:
+        """Записано ли name в манифест как имя с хэшем, а не просто похоже на него"""
+        original = HASHED_NAME_RE.sub(r"\1", name)
+        if original == name:
+            return False
+        return self.hashed_files.get(self.hash_key(self.clean_name(original))) == name
+
+
+def serve_static(request, path):
+    """
+    Отдаёт собранную статику из STATIC_ROOT.
+
+    Если клиент принимает gzip и для файла есть сжатая копия, отдаётся она
+    с заголовком Content-Encoding: gzip. Файлы с хэшем содержимого в имени из
+    манифеста никогда не меняются, поэтому кэшируются браузером на год как immutable,
+    остальные (в том числе файлы, имя которых только похоже на имя с хэшем) -
+    на STATIC_MAX_AGE секунд.
+    """
+    response = None
+    if ACCEPTS_GZIP_RE.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        try:
+            response = serve(request, f"{path}.gz", document_root=settings.STATIC_ROOT)
+        except Http404:
+            pass
+    if response is None:
+        response = serve(request, path, document_root=settings.STATIC_ROOT)
+
+    patch_vary_headers(response, ["Accept-Encoding"])
+    if staticfiles_storage.is_hashed_name(path):
+        patch_cache_control(
+            response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True
+        )
+    else:
+        patch_cache_control(response, public=True, max_age=settings.STATIC_MAX_AGE)
+    return response
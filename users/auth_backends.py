@@ -1,5 +1,29 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import BaseBackend
+from django.db import transaction
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from users.models import OutboxEvent
+from users.outbox import publish_event
+from users.serializers import UserRetrieveSerializer
+from users.services import (
+    complete_registration,
+    create_invite_code,
+    get_client_ident,
+    pop_enter_code,
+    register_enter_code_attempt,
+    release_enter_code,
+    reset_enter_code_attempts,
+)
+from users.sharding import (
+    get_or_create_user,
+    get_user_by_id,
+    get_user_by_phone,
+    is_sharded,
+)
 
 User = get_user_model()
 
@@ -23,16 +47,36 @@ class EnterCodeBackend(BaseBackend):
         if phone is None or enter_code is None:
             return None
 
-        try:
-            user = User.objects.get(phone=phone)
-        except User.DoesNotExist:
+        # Любая попытка, верная или нет, снимает объединение запросов кода: следующий
+        # запрос выдаст новый код, а не переотправит старый
+        release_enter_code(phone)
+        client = get_client_ident(request)
+        allowed = register_enter_code_attempt(phone, client)
+
+        # Попытка извлечь код из сессии (или кэша для JSON API) и сравнить его с введённым кодом
+        correct_enter_code = pop_enter_code(request, phone)
+        if not allowed or not correct_enter_code or enter_code != correct_enter_code:
             return None
+        reset_enter_code_attempts(phone, client)
 
-        # Попытка извлечь код из сессии и сравнить его с введённым кодом
-        correct_enter_code = request.session.pop(phone, "")
-        if enter_code == correct_enter_code:
-            return user
-        return None
+        with transaction.atomic():
+            if complete_registration(phone):
+                # Номер подтверждён: создаём пользователя из незавершённой регистрации.
+                # Новый номер стоит двух запросов: DELETE регистрации и INSERT пользователя
+                user, _ = get_or_create_user(
+                    phone, defaults={"invite_code": create_invite_code}
+                )
+            else:
+                try:
+                    user = get_user_by_phone(phone)
+                except User.DoesNotExist:
+                    return None
+        if user.last_login is None:
+            # Событие первого входа используется для подсчёта конверсии в статистике
+            publish_event(
+                OutboxEvent.FIRST_LOGIN, {"user_id": user.pk, "phone": user.phone}
+            )
+        return user
 
     def get_user(self, user_id):
         """
@@ -42,6 +86,68 @@ class EnterCodeBackend(BaseBackend):
         :return: User объект, если пользователь существует, или None, если не существует.
         """
         try:
-            return User.objects.get(pk=user_id)
+            return get_user_by_id(user_id)
         except User.DoesNotExist:
             return None
+
+
+class ShardedJWTAuthentication(JWTAuthentication):
+    """
+    JWT-аутентификация, которая загружает пользователя из его шарда
+    через справочник пользователей (см. users.sharding).
+    """
+
+    def get_user(self, validated_token):
+        if not is_sharded():
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        try:
+            user = get_user_by_id(user_id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
+
+
+class ProfileJWTAuthentication(ShardedJWTAuthentication):
+    """
+    JWT-аутентификация профиля (/users/retrieve/). Пользователь сразу загружается
+    запросом профиля с реферером и рефералами для полей из ?fields= и ?exclude=,
+    поэтому чтение профиля стоит одного запроса, а не запроса аутентификации и
+    запроса профиля. При шардировании работает как ShardedJWTAuthentication.
+    """
+
+    def authenticate(self, request):
+        self.request = request
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if is_sharded():
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        try:
+            fieldset = UserRetrieveSerializer.get_fieldset(self.request.query_params)
+        except ValidationError:
+            # Ошибку в ?fields= вернёт представление, пользователь загружается как обычно
+            fieldset = ()
+        queryset = UserRetrieveSerializer.annotate_profile(User.objects.all(), fieldset)
+        try:
+            user = queryset.get(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
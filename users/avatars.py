@@ -0,0 +1,109 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Пул процессов для генерации миниатюр создаётся лениво при первой загрузке аватара
+_executor = None
+
+
+def get_thumbnail_name(avatar_name: str, size: int) -> str:
+    """Имя файла миниатюры аватара заданного размера в хранилище"""
+    directory, filename = os.path.split(avatar_name)
+    return os.path.join(directory, "thumbnails", str(size), filename)
+
+
+def get_thumbnail_urls(avatar_name: str) -> dict:
+    """URL миниатюр аватара всех размеров из AVATAR_THUMBNAIL_SIZES"""
+    if not avatar_name:
+        return {}
+    return {
+        str(size): default_storage.url(get_thumbnail_name(avatar_name, size))
+        for size in settings.AVATAR_THUMBNAIL_SIZES
+    }
+
+
+def make_thumbnails(source_path: str, targets: list, max_pixels: int) -> None:
+    """
+    Создаёт миниатюры изображения. Выполняется в отдельном процессе, поэтому
+    работает только с путями к файлам и не обращается к Django.
+
+    Для JPEG draft() уменьшает изображение уже при декодировании (DCT scaling),
+    поэтому исходник в полном разрешении в память не загружается. Миниатюры
+    строятся от большей к меньшей, каждая из предыдущей.
+
+    Parameters:
+    source_path (str): Путь к исходному изображению.
+    targets (list): Пары (размер стороны, путь для сохранения миниатюры).
+    max_pixels (int): Ограничение на количество пикселей исходного изображения.
+    Проверяется по заголовку файла до декодирования, глобальный Image.MAX_IMAGE_PIXELS
+    не меняется.
+    """
+    targets = sorted(targets, reverse=True)
+    with Image.open(source_path) as image:
+        width, height = image.size
+        if width * height > max_pixels:
+            raise Image.DecompressionBombError(
+                f"Изображение {width}x{height} больше {max_pixels} пикселей"
+            )
+        image_format = image.format
+        largest = targets[0][0]
+        image.draft("RGB", (largest, largest))
+        thumbnail = image.copy()
+
+    for size, target_path in targets:
+        thumbnail.thumbnail((size, size))
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        thumbnail.save(target_path, format=image_format)
+
+
+def _report_thumbnail_error(future):
+    """Записывает в лог ошибку генерации миниатюр, если она произошла в фоновом процессе"""
+    error = future.exception()
+    if error is not None:
+        logger.error(
+            "Не удалось создать миниатюры аватара: %s",
+            error,
+            exc_info=(type(error), error, error.__traceback__),
+        )
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Возвращает пул процессов для генерации миниатюр"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.AVATAR_THUMBNAIL_WORKERS)
+    return _executor
+
+
+def schedule_thumbnails(avatar_name: str) -> None:
+    """
+    Ставит генерацию миниатюр аватара в фоновый пул процессов, чтобы декодирование
+    и масштабирование не выполнялись в рабочем процессе, обрабатывающем запрос.
+    При AVATAR_THUMBNAIL_WORKERS = 0 миниатюры создаются сразу.
+    """
+    targets = [
+        (size, default_storage.path(get_thumbnail_name(avatar_name, size)))
+        for size in settings.AVATAR_THUMBNAIL_SIZES
+    ]
+    args = (default_storage.path(avatar_name), targets, settings.AVATAR_MAX_PIXELS)
+    if not settings.AVATAR_THUMBNAIL_WORKERS:
+        make_thumbnails(*args)
+        return
+    get_executor().submit(make_thumbnails, *args).add_done_callback(
+        _report_thumbnail_error
+    )
+
+
+def delete_avatar(avatar_name: str) -> None:
+    """Удаляет аватар и все его миниатюры из хранилища"""
+    if not avatar_name:
+        return
+    default_storage.delete(avatar_name)
+    for size in settings.AVATAR_THUMBNAIL_SIZES:
+        default_storage.delete(get_thumbnail_name(avatar_name, size))
@@ -0,0 +1,204 @@
+"""
+Фильтр Блума инвайт-кодов в памяти процесса.
+
+Фильтр отвечает "кода нет в фильтре" или "код, возможно, есть". Фильтр процесса
+отстаёт от базы: код, созданный другим процессом, попадает в него только при следующей
+подгрузке. Поэтому промах фильтра - не доказательство, что кода нет: вызывающий код
+либо проверяет его по базе (users.views.SetReferrerAPIView), либо опирается на
+уникальный индекс (users.services.create_invite_code).
+
+Фильтр строится в фоновом потоке при запуске сервера (config/asgi.py, config/wsgi.py)
+по всем инвайт-кодам, размер подбирается по количеству пользователей. Дальше он
+пополняется кодами, которые выдаёт этот процесс, и не чаще раза в
+INVITE_CODE_BLOOM_SYNC_INTERVAL секунд - только строками, созданными или изменёнными
+после прошлой подгрузки (по updated_at). Заново по всей таблице фильтр строится,
+только когда в него добавлено больше кодов, чем рассчитана его ёмкость.
+"""
+
+import hashlib
+import math
+import threading
+from datetime import timedelta
+from time import monotonic
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.utils import timezone
+
+from users.models import UserDirectory
+from users.sharding import is_sharded
+
+User = get_user_model()
+
+# Минимальная ёмкость фильтра: для пустой базы он не пересоздаётся после каждой регистрации
+MIN_CAPACITY = 10_000
+
+
+class BloomFilter:
+    """
+    Фильтр Блума на bytearray. Позиции битов считаются двойным хэшированием
+    по одному дайджесту blake2b. Ложноотрицательных ответов не бывает,
+    доля ложноположительных не превышает error_rate при заполнении до capacity.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(capacity, 1)
+        self.size = max(
+            int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8
+        )
+        self.hash_count = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value: str) -> list:
+        """Номера битов значения"""
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value: str) -> None:
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(value)
+        )
+
+
+class InviteCodeFilter:
+    """
+    Фильтр Блума всех инвайт-кодов с инкрементальным обновлением.
+
+    Подгрузка идёт по updated_at с перекрытием INVITE_CODE_BLOOM_SYNC_OVERLAP секунд:
+    строка транзакции, которая закоммитилась позже строк с более поздним updated_at,
+    попадёт в следующую подгрузку, а не будет пропущена, как при отметке по id.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Захватывается без ожидания: одновременно фильтр строит только один поток
+        self.rebuild_lock = threading.Lock()
+        self.bloom = None
+        self.synced_until = None
+        self.synced_at = 0.0
+
+    def get_queryset(self):
+        """Источник инвайт-кодов: при шардировании - справочник пользователей"""
+        model = UserDirectory if is_sharded() else User
+        return model.objects.order_by()
+
+    def load(self, bloom, queryset) -> None:
+        """Добавляет в фильтр коды из queryset, которых в нём ещё нет"""
+        for invite_code in queryset.values_list("invite_code", flat=True).iterator(
+            chunk_size=10_000
+        ):
+            with self.lock:
+                if invite_code not in bloom:
+                    bloom.add(invite_code)
+
+    def rebuild(self) -> bool:
+        """
+        Строит фильтр заново по всем инвайт-кодам и заменяет им текущий.
+        Возвращает False, если фильтр уже строит другой поток.
+        """
+        if not self.rebuild_lock.acquire(blocking=False):
+            return False
+        try:
+            synced_until = timezone.now()
+            queryset = self.get_queryset()
+            bloom = BloomFilter(
+                max(queryset.count() * 2, MIN_CAPACITY),
+                settings.INVITE_CODE_BLOOM_ERROR_RATE,
+            )
+            self.load(bloom, queryset)
+            with self.lock:
+                self.bloom = bloom
+                self.synced_until = synced_until
+                self.synced_at = monotonic()
+            return True
+        finally:
+            self.rebuild_lock.release()
+
+    def rebuild_in_background(self) -> None:
+        """Запускает перестройку фильтра в фоновом потоке, если она ещё не идёт"""
+        if self.rebuild_lock.locked():
+            return
+
+        def run():
+            try:
+                self.rebuild()
+            finally:
+                connections.close_all()
+
+        threading.Thread(target=run, name="invite-code-bloom", daemon=True).start()
+
+    def warm_up(self) -> None:
+        """Строит фильтр в фоне при запуске сервера, чтобы запросы не ждали его построения"""
+        if settings.INVITE_CODE_BLOOM_ENABLED:
+            self.rebuild_in_background()
+
+    def sync(self) -> None:
+        """Добавляет коды пользователей, созданных или изменённых после последней подгрузки"""
+        with self.lock:
+            bloom = self.bloom
+            if bloom is None:
+                return
+            since = self.synced_until - timedelta(
+                seconds=settings.INVITE_CODE_BLOOM_SYNC_OVERLAP
+            )
+            self.synced_at = monotonic()
+        synced_until = timezone.now()
+        self.load(bloom, self.get_queryset().filter(updated_at__gte=since))
+        with self.lock:
+            if self.bloom is bloom:
+                self.synced_until = max(self.synced_until, synced_until)
+        if bloom.count > bloom.capacity:
+            # Фильтр переполнен, доля ложноположительных ответов растёт
+            self.rebuild_in_background()
+
+    def add(self, invite_code: str) -> None:
+        """Добавляет выданный код, если фильтр уже построен"""
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(invite_code)
+
+    def reset(self) -> None:
+        """Сбрасывает фильтр: он будет построен заново при следующем обращении"""
+        with self.lock:
+            self.bloom = None
+
+    def contains(self, invite_code: str):
+        """Есть ли код в фильтре, или None, если фильтр ещё не построен"""
+        with self.lock:
+            if self.bloom is None:
+                return None
+            return invite_code in self.bloom
+
+    def might_exist(self, invite_code: str) -> bool:
+        """
+        False, если кода нет в фильтре процесса, иначе True. Код, созданный другим
+        процессом после последней подгрузки, тоже даёт False (см. описание модуля).
+        При промахе фильтр сначала дополняется кодами, созданными или изменёнными
+        другими процессами (не чаще раза в INVITE_CODE_BLOOM_SYNC_INTERVAL секунд).
+        Пока фильтр не построен, возвращает True и запускает построение в фоне.
+        """
+        if not settings.INVITE_CODE_BLOOM_ENABLED:
+            return True
+        contains = self.contains(invite_code)
+        if contains is None:
+            self.rebuild_in_background()
+            return True
+        if contains:
+            return True
+        if monotonic() - self.synced_at < settings.INVITE_CODE_BLOOM_SYNC_INTERVAL:
+            return False
+        self.sync()
+        return self.contains(invite_code) is not False
+
+
+invite_codes = InviteCodeFilter()
@@ -0,0 +1,154 @@
+"""
+Поддержка заголовка Idempotency-Key для изменяющих запросов.
+
+Первый ответ на запрос с ключом (статус, тело, заголовки и cookies) сохраняется в кэше
+на IDEMPOTENCY_TTL секунд по (адрес, пользователь или номер телефона, ключ). Повтор запроса
+с тем же ключом получает сохранённый ответ без повторного выполнения представления (запросов
+к базе и отправки смс). Пока первый запрос выполняется, его ключ занят (cache.add), и
+одновременный повтор сразу получает 409 с Retry-After, а не занимает поток ожиданием.
+Ответы 5xx не сохраняются: запрос можно повторить.
+"""
+
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+# Через сколько секунд повторить запрос, если запрос с тем же ключом ещё выполняется
+IN_FLIGHT_RETRY_AFTER = 1
+
+
+def get_request_fingerprint(data) -> str:
+    """Хэш тела запроса: тот же ключ с другим телом - ошибка клиента"""
+    if hasattr(data, "lists"):
+        data = dict(data.lists())
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def user_scope(request):
+    """Владелец ключа - авторизованный пользователь"""
+    if request.user and request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    return None
+
+
+def phone_scope(request):
+    """
+    Владелец ключа - номер телефона из тела запроса (запросы до авторизации).
+    Только для запросов без сессии (/api/v2/): код входа браузера хранится в его сессии,
+    и сохранённый ответ не привязал бы код к сессии, в которой пришёл повтор.
+    """
+    if hasattr(request, "session"):
+        return None
+    phone = request.data.get("phone")
+    if phone:
+        return f"phone:{phone}"
+    return None
+
+
+def get_idempotency_cache_key(request, scope: str, key: str) -> str:
+    """Ключ кэша с ответом: адрес, владелец и сам ключ, сжатые в хэш фиксированной длины"""
+    digest = hashlib.sha256(f"{request.path_info}|{scope}|{key}".encode()).hexdigest()
+    return f"idempotency:{digest}"
+
+
+def replay(stored: dict, fingerprint: str) -> Response:
+    """Сохранённый ответ на повтор запроса"""
+    if stored["fingerprint"] != fingerprint:
+        return Response(
+            {"error": "Idempotency-Key уже использован для запроса с другим телом"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    response = Response(
+        stored["data"],
+        status=stored["status"],
+        # Ответы, сохранённые до появления заголовков и cookies в кэше, повторяются без них
+        headers={**stored.get("headers", {}), "Idempotent-Replayed": "true"},
+    )
+    response.cookies.update(stored.get("cookies", {}))
+    return response
+
+
+def store(response) -> dict:
+    """
+    Часть ответа, которую нужно повторить: заголовки, выставленные представлением
+    (Location, ETag и т. п.), и cookies. Content-Type выставляется заново при рендеринге.
+    """
+    return {
+        "status": response.status_code,
+        "data": response.data,
+        "headers": {
+            name: value
+            for name, value in response.items()
+            if name.lower() != "content-type"
+        },
+        "cookies": response.cookies,
+    }
+
+
+def idempotent(get_scope=user_scope):
+    """
+    Декоратор метода APIView, который делает запросы с заголовком Idempotency-Key
+    идемпотентными. get_scope(request) возвращает владельца ключа, чтобы ключи разных
+    пользователей не пересекались, или None, если запрос не нужно делать идемпотентным.
+    Запросы без заголовка и запросы HTML-форм обрабатываются как обычно.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+            if not key or request.accepted_renderer.format == "html":
+                return method(self, request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return Response(
+                    {
+                        "error": f"Idempotency-Key не может быть длиннее {MAX_KEY_LENGTH} символов"
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            scope = get_scope(request)
+            if scope is None:
+                return method(self, request, *args, **kwargs)
+
+            cache_key = get_idempotency_cache_key(request, scope, key)
+            lock_key = f"{cache_key}:lock"
+            fingerprint = get_request_fingerprint(request.data)
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return replay(stored, fingerprint)
+            if not cache.add(lock_key, 1, timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT):
+                return Response(
+                    {"error": "Запрос с этим Idempotency-Key ещё выполняется"},
+                    status=status.HTTP_409_CONFLICT,
+                    headers={"Retry-After": str(IN_FLIGHT_RETRY_AFTER)},
+                )
+            # Ответ мог быть сохранён между проверкой и захватом ключа
+            stored = cache.get(cache_key)
+            if stored is not None:
+                cache.delete(lock_key)
+                return replay(stored, fingerprint)
+
+            try:
+                response = method(self, request, *args, **kwargs)
+                if response.status_code < 500:
+                    cache.set(
+                        cache_key,
+                        {"fingerprint": fingerprint, **store(response)},
+                        timeout=settings.IDEMPOTENCY_TTL,
+                    )
+            finally:
+                cache.delete(lock_key)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,377 @@
+"""
+Доставка событий реферальной системы пользователям в реальном времени (Server-Sent Events).
+
+Представление events_stream держит открытое соединение и отправляет пользователю события
+"new_referral" (у него появился реферал) и "referrer_set" (ему установлен реферер),
+поэтому клиентам не нужно опрашивать /users/retrieve/.
+
+События проходят через хаб в памяти процесса. Если задан LIVE_EVENTS_SOCKET_DIR,
+процессы обмениваются событиями через Unix-сокеты в этом каталоге: каждый процесс с
+открытыми соединениями слушает свой сокет, а публикация рассылает событие во все сокеты
+каталога. Так несколько процессов на одном сервере работают без внешнего брокера.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import threading
+from collections import defaultdict, deque
+from time import monotonic
+
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from rest_framework.exceptions import AuthenticationFailed
+
+from users.auth_backends import ShardedJWTAuthentication
+from users.sharding import get_user_by_id
+
+User = get_user_model()
+
+NEW_REFERRAL = "new_referral"
+REFERRER_SET = "referrer_set"
+# Ключ scope ASGI с asyncio.Event, который устанавливается при разрыве соединения
+DISCONNECTED_KEY = "users.live.disconnected"
+# Соль подписи токенов потока событий для страниц (см. get_events_url)
+EVENTS_TOKEN_SALT = "users.live.events"
+
+
+class Subscription:
+    """
+    Очередь событий одного соединения. Хранит не больше LIVE_EVENTS_QUEUE_SIZE событий:
+    если клиент не успевает их забирать, очередь помечается переполненной и соединение
+    закрывается, а клиент переподключается и заново загружает профиль.
+    """
+
+    def __init__(self, user_id: int, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.events = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def push(self, event: dict) -> None:
+        """Добавляет событие в очередь. Вызывается в цикле событий соединения."""
+        if len(self.events) >= settings.LIVE_EVENTS_QUEUE_SIZE:
+            self.overflowed = True
+            self.events.clear()
+        else:
+            self.events.append(event)
+        self.ready.set()
+
+    async def get(self, timeout: float, disconnected=None):
+        """
+        Следующее событие или None, если за timeout секунд событий не было.
+        Ожидание прерывается, как только установлено событие disconnected (клиент ушёл).
+        """
+        if not self.events and not self.overflowed:
+            self.ready.clear()
+            waiters = {asyncio.ensure_future(self.ready.wait())}
+            if disconnected is not None:
+                waiters.add(asyncio.ensure_future(disconnected.wait()))
+            done, pending = await asyncio.wait(
+                waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for waiter in pending:
+                waiter.cancel()
+        if self.events:
+            return self.events.popleft()
+        return None
+
+
+class EventHub:
+    """Подписки пользователей на события в памяти процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+        self.listener = None
+
+    def subscribe(self, user_id: int):
+        """
+        Регистрирует соединение пользователя в текущем цикле событий.
+        Возвращает None, если у пользователя уже LIVE_EVENTS_MAX_CONNECTIONS соединений.
+        """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if len(self.subscriptions[user_id]) >= settings.LIVE_EVENTS_MAX_CONNECTIONS:
+                return None
+            subscription = Subscription(user_id, loop)
+            self.subscriptions[user_id].add(subscription)
+            if settings.LIVE_EVENTS_SOCKET_DIR and self.listener is None:
+                self.listener = SocketListener(self, loop)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+            if not self.subscriptions and self.listener is not None:
+                self.listener.close()
+                self.listener = None
+
+    def dispatch(self, user_id: int, event: dict) -> None:
+        """Передаёт событие всем соединениям пользователя в этом процессе. Потокобезопасен."""
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.push, event)
+
+    def publish(self, user_id: int, event_type: str, data: dict) -> None:
+        """
+        Публикует событие для пользователя. Если задан LIVE_EVENTS_SOCKET_DIR, событие
+        рассылается всем процессам (включая текущий) через их сокеты.
+        """
+        event = {"type": event_type, "data": data}
+        if settings.LIVE_EVENTS_SOCKET_DIR:
+            broadcast(settings.LIVE_EVENTS_SOCKET_DIR, {"user_id": user_id, **event})
+        else:
+            self.dispatch(user_id, event)
+
+
+class SocketListener:
+    """Сокет процесса в каталоге LIVE_EVENTS_SOCKET_DIR, принимающий события других процессов"""
+
+    def __init__(self, hub: EventHub, loop):
+        self.hub = hub
+        self.loop = loop
+        os.makedirs(settings.LIVE_EVENTS_SOCKET_DIR, exist_ok=True)
+        self.path = os.path.join(settings.LIVE_EVENTS_SOCKET_DIR, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        loop.call_soon_threadsafe(loop.add_reader, self.sock, self.receive)
+
+    def receive(self) -> None:
+        while True:
+            try:
+                message = json.loads(self.sock.recv(65536))
+            except (BlockingIOError, OSError):
+                return
+            except ValueError:
+                continue
+            self.hub.dispatch(message.pop("user_id"), message)
+
+    def close(self) -> None:
+        def remove_reader():
+            self.loop.remove_reader(self.sock)
+            self.sock.close()
+
+        self.loop.call_soon_threadsafe(remove_reader)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def broadcast(directory: str, message: dict) -> None:
+    """Отправляет сообщение во все сокеты каталога, удаляя сокеты завершившихся процессов"""
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(".sock")]
+    except FileNotFoundError:
+        return
+    payload = json.dumps(message, ensure_ascii=False).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # Буфер сокета процесса заполнен: событие для него теряется,
+                # как и при переполнении очереди соединения
+                pass
+
+
+hub = EventHub()
+
+
+def format_event(event_type: str, data) -> str:
+    """Событие в формате text/event-stream"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def get_events_url(request, user):
+    """
+    Адрес потока событий для страницы пользователя или None, если страница отдана не
+    ASGI-сервером: при WSGI поток недоступен (код 501), и страница не подписывается на события.
+
+    EventSource не умеет передавать заголовок Authorization, а страницы открываются по JWT,
+    без сессии. Поэтому в адрес добавляется подписанный токен с id пользователя,
+    который действует LIVE_EVENTS_TOKEN_TTL секунд.
+    """
+    if not isinstance(getattr(request, "_request", request), ASGIRequest):
+        return None
+    token = signing.dumps(user.pk, salt=EVENTS_TOKEN_SALT)
+    return f"{reverse('users:events')}?{urlencode({'token': token})}"
+
+
+def authenticate(request):
+    """
+    Пользователь соединения: по токену страницы (?token=, см. get_events_url), по JWT
+    из заголовка Authorization (мобильное приложение, JSON API) или по сессии браузера.
+    None, если пользователь не авторизован.
+    """
+    token = request.GET.get("token")
+    if token:
+        try:
+            user_id = signing.loads(
+                token, salt=EVENTS_TOKEN_SALT, max_age=settings.LIVE_EVENTS_TOKEN_TTL
+            )
+            return get_user_by_id(user_id)
+        except (signing.BadSignature, User.DoesNotExist):
+            return None
+    try:
+        result = ShardedJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if result is not None:
+        return result[0]
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return user
+    return None
+
+
+class DisconnectMiddleware:
+    """
+    ASGI-middleware, которое замечает разрыв соединения клиентом во время ответа.
+
+    Django 4.2 после чтения тела запроса больше не вызывает receive(), поэтому сообщение
+    http.disconnect закрытой вкладки до потока событий не доходит, а отправка в закрытое
+    соединение ошибки не вызывает. Middleware после чтения тела ждёт следующее сообщение
+    само и при http.disconnect устанавливает asyncio.Event из scope[DISCONNECTED_KEY]:
+    поток событий завершается сразу, а не через LIVE_EVENTS_MAX_DURATION секунд.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        disconnected = asyncio.Event()
+        watcher = None
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        async def receive_body():
+            nonlocal watcher
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body") and watcher is None:
+                watcher = asyncio.ensure_future(watch())
+            return message
+
+        try:
+            await self.app(
+                {**scope, DISCONNECTED_KEY: disconnected}, receive_body, send
+            )
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+
+class EventStream:
+    """
+    Поток событий соединения с комментариями-heartbeat раз в LIVE_EVENTS_HEARTBEAT секунд.
+
+    Поток завершается, когда клиент закрывает соединение (см. DisconnectMiddleware), а
+    также через LIVE_EVENTS_MAX_DURATION секунд, после чего клиент переподключается: так
+    освобождаются соединения, разрыв которых сервер всё же не заметил (например, за
+    прокси). Подписка снимается в close(), который Django вызывает при закрытии ответа.
+    """
+
+    def __init__(self, subscription: Subscription, disconnected=None):
+        self.subscription = subscription
+        self.disconnected = disconnected
+        self.deadline = monotonic() + settings.LIVE_EVENTS_MAX_DURATION
+        self.started = False
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self.closed:
+            raise StopAsyncIteration
+        if not self.started:
+            self.started = True
+            return f"retry: {settings.LIVE_EVENTS_RETRY}\n\n"
+
+        remaining = self.deadline - monotonic()
+        if remaining <= 0 or self.is_disconnected():
+            self.close()
+            raise StopAsyncIteration
+        event = await self.subscription.get(
+            min(settings.LIVE_EVENTS_HEARTBEAT, remaining), self.disconnected
+        )
+        if self.is_disconnected():
+            self.close()
+            raise StopAsyncIteration
+        if self.subscription.overflowed:
+            self.close()
+            return format_event("overflow", {})
+        if event is None:
+            return ": heartbeat\n\n"
+        return format_event(event["type"], event["data"])
+
+    def is_disconnected(self) -> bool:
+        return self.disconnected is not None and self.disconnected.is_set()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            hub.unsubscribe(self.subscription)
+
+
+async def events_stream(request):
+    """
+    Поток событий реферальной системы текущего пользователя (text/event-stream).
+    Требует ASGI-сервера: при WSGI (в том числе manage.py runserver) каждое соединение
+    занимало бы поток, поэтому запрос отклоняется с кодом 501.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {"detail": "Поток событий доступен только на ASGI-сервере"}, status=501
+        )
+    user = await sync_to_async(authenticate)(request)
+    if user is None:
+        return JsonResponse(
+            {"detail": "Учетные данные не были предоставлены."}, status=401
+        )
+
+    subscription = hub.subscribe(user.pk)
+    if subscription is None:
+        return JsonResponse({"detail": "Слишком много открытых соединений"}, status=429)
+
+    response = StreamingHttpResponse(
+        EventStream(subscription, request.scope.get(DISCONNECTED_KEY)),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Отключает буферизацию ответа в nginx
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,32 @@
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Field, Lookup
+
+
+@Field.register_lookup
+class AnyLookup(Lookup):
+    """
+    Поиск по списку значений: field__any=[...].
+
+    В Postgres компилируется в "field = ANY(%s)" с одним параметром-массивом:
+    текст запроса не зависит от длины списка, поэтому план переиспользуется,
+    а драйвер передаёт один параметр вместо тысячи. В остальных базах - обычный IN.
+    """
+
+    lookup_name = "any"
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        return "%s", [list(value)]
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        values = list(self.rhs)
+        if not values:
+            raise EmptyResultSet
+        placeholders = ", ".join(["%s"] * len(values))
+        return f"{lhs} IN ({placeholders})", (*lhs_params, *values)
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} = ANY({rhs})", (*lhs_params, *rhs_params)
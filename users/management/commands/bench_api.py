@@ -0,0 +1,75 @@
+from time import perf_counter
+
+from django.core.management import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from users.sharding import get_user_by_phone
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает время обработки запросов к адресам /users/ и JSON API /api/v2/ "
+        "через полный стек middleware проекта"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--phone", required=True, help="Номер телефона существующего пользователя"
+        )
+        parser.add_argument(
+            "--requests", type=int, default=500, help="Количество запросов на адрес"
+        )
+
+    def measure(self, client, method, url, requests, **extra):
+        """Среднее время запроса в миллисекундах и размер последнего ответа"""
+        send = getattr(client, method)
+        send(url, **extra)
+        started = perf_counter()
+        for _ in range(requests):
+            response = send(url, **extra)
+        elapsed = (perf_counter() - started) / requests * 1000
+        return elapsed, len(response.content)
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_by_phone(options["phone"])
+        except User.DoesNotExist:
+            raise CommandError(f"Пользователь {options['phone']} не найден")
+
+        client = Client()
+        auth = {"HTTP_AUTHORIZATION": f"Bearer {AccessToken.for_user(user)}"}
+        cases = [
+            ("GET retrieve", "get", "retrieve", auth),
+            ("GET set_referrer", "get", "set_referrer", auth),
+            # Невалидный номер: форма проверяется, но код не отправляется
+            ("POST get_code", "post", "get_code", {"data": {"phone": "0"}}),
+        ]
+
+        self.stdout.write(
+            f"{'запрос':<20} {'/users/, мс':>12} {'/api/v2/, мс':>13} "
+            f"{'ускорение':>10} {'байт v1':>9} {'байт v2':>9}"
+        )
+        for title, method, name, extra in cases:
+            v1_time, v1_size = self.measure(
+                client,
+                method,
+                reverse(f"users:{name}"),
+                options["requests"],
+                HTTP_ACCEPT="application/json",
+                **extra,
+            )
+            v2_time, v2_size = self.measure(
+                client,
+                method,
+                reverse(f"api_v2:{name}"),
+                options["requests"],
+                HTTP_ACCEPT_ENCODING="gzip",
+                **extra,
+            )
+            self.stdout.write(
+                f"{title:<20} {v1_time:>12.3f} {v2_time:>13.3f} "
+                f"{v1_time / v2_time:>9.1f}x {v1_size:>9} {v2_size:>9}"
+            )
@@ -0,0 +1,97 @@
+from io import BytesIO
+from timeit import Timer
+
+from django.core.management import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from users.renderers import FastJSONParser, FastJSONRenderer, orjson
+from users.serializers import UserRetrieveSerializer
+
+
+def build_profile(index: int, referrals_count: int) -> dict:
+    """Данные профиля в том виде, в котором их возвращает UserRetrieveSerializer"""
+    data = {
+        "phone": f"7{index:010d}",
+        "invite_code": f"{index:06d}"[-6:],
+        "invited_by_phone": "+70000000001",
+        "invite_code_referer": "cAXcJR",
+        "referrals": [f"79{i:09d}" for i in range(referrals_count)],
+        "avatar": None,
+        "avatar_thumbnails": {},
+    }
+    return {field: data[field] for field in UserRetrieveSerializer.Meta.fields}
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает скорость стандартных JSONRenderer/JSONParser и "
+        "FastJSONRenderer/FastJSONParser на данных профиля пользователя"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--referrals",
+            type=int,
+            nargs="+",
+            default=[10, 1000, 100000],
+            help="Количество рефералов в профиле для каждого замера",
+        )
+        parser.add_argument(
+            "--profiles",
+            type=int,
+            default=100,
+            help="Количество профилей в списке для замера списка",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Количество повторов замера"
+        )
+
+    def measure(self, func, repeat):
+        """Лучшее время одного вызова func в миллисекундах"""
+        timer = Timer(func)
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat=repeat, number=number)) / number * 1000
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write(
+                "orjson не установлен: FastJSONRenderer использует стандартный json"
+            )
+
+        payloads = [
+            (f"профиль, рефералов: {count}", build_profile(1, count))
+            for count in options["referrals"]
+        ]
+        payloads.append(
+            (
+                f"список из {options['profiles']} профилей по 10 рефералов",
+                [build_profile(i, 10) for i in range(options["profiles"])],
+            )
+        )
+
+        renderer, fast_renderer = JSONRenderer(), FastJSONRenderer()
+        parser, fast_parser = JSONParser(), FastJSONParser()
+        self.stdout.write(
+            f"{'данные':<45} {'json, мс':>10} {'fast, мс':>10} {'ускорение':>10}"
+        )
+        for title, payload in payloads:
+            body = renderer.render(payload)
+            for operation, standard, fast in (
+                (
+                    "render",
+                    lambda: renderer.render(payload),
+                    lambda: fast_renderer.render(payload),
+                ),
+                (
+                    "parse",
+                    lambda: parser.parse(BytesIO(body)),
+                    lambda: fast_parser.parse(BytesIO(body)),
+                ),
+            ):
+                standard_time = self.measure(standard, options["repeat"])
+                fast_time = self.measure(fast, options["repeat"])
+                self.stdout.write(
+                    f"{operation + ' ' + title:<45} {standard_time:>10.3f} "
+                    f"{fast_time:>10.3f} {standard_time / fast_time:>9.1f}x"
+                )
@@ -0,0 +1,52 @@
+from time import sleep
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils.module_loading import import_string
+
+from users.outbox import drain_batch, get_outbox_databases
+
+
+class Command(BaseCommand):
+    help = "Доставляет события outbox реферальной системы во внешний sink пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sink",
+            default=settings.OUTBOX_SINK,
+            help="Путь к классу sink, например users.outbox.FileSink",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.OUTBOX_BATCH_SIZE,
+            help="Количество событий в одной пачке",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Не завершаться, а ожидать новые события",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Пауза в секундах между опросами пустой очереди в режиме --loop",
+        )
+
+    def handle(self, *args, **options):
+        sink = import_string(options["sink"])()
+        total = 0
+        while True:
+            # Базы обходятся по очереди: порядок событий сохраняется только в пределах базы
+            delivered = sum(
+                drain_batch(sink, options["batch_size"], using)
+                for using in get_outbox_databases()
+            )
+            total += delivered
+            if delivered:
+                continue
+            if not options["loop"]:
+                break
+            sleep(options["interval"])
+        self.stdout.write(f"Доставлено событий: {total}")
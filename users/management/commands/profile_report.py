@@ -0,0 +1,56 @@
+import glob
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from users.profiling import get_profile_dir
+
+
+class Command(BaseCommand):
+    help = (
+        "Показывает самые затратные функции по профилям, собранным ProfilingMiddleware"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--view",
+            help="Имя представления, например users:retrieve. По умолчанию - все представления",
+        )
+        parser.add_argument(
+            "--sort",
+            default="cumulative",
+            choices=["cumulative", "tottime", "ncalls"],
+            help="Поле сортировки",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=20, help="Количество функций в отчёте"
+        )
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Удалить профили после построения отчёта",
+        )
+
+    def handle(self, *args, **options):
+        if options["view"]:
+            directories = [get_profile_dir(options["view"])]
+        else:
+            directories = sorted(glob.glob(os.path.join(settings.PROFILING_DIR, "*")))
+
+        for directory in directories:
+            files = sorted(glob.glob(os.path.join(directory, "*.prof")))
+            if not files:
+                if options["view"]:
+                    raise CommandError(f"Нет профилей в {directory}")
+                continue
+
+            self.stdout.write(
+                f"\n=== {os.path.basename(directory)}: запросов {len(files)}"
+            )
+            stats = pstats.Stats(*files, stream=self.stdout)
+            stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+            if options["clear"]:
+                for filename in files:
+                    os.remove(filename)
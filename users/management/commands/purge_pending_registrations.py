@@ -0,0 +1,47 @@
+from time import sleep
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from users.models import PendingRegistration
+
+
+class Command(BaseCommand):
+    help = (
+        "Удаляет просроченные незавершённые регистрации пачками. Каждая пачка удаляется "
+        "отдельным коротким запросом по первичному ключу, поэтому строки не блокируются надолго"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Количество записей, удаляемых за один запрос",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.0,
+            help="Пауза в секундах между пачками, чтобы снизить нагрузку на базу",
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        total = 0
+        while True:
+            ids = list(
+                PendingRegistration.objects.filter(expires_at__lte=now)
+                .order_by("expires_at")
+                .values_list("pk", flat=True)[: options["batch_size"]]
+            )
+            if not ids:
+                break
+            # Повторная проверка срока: запись могли продлить после выборки
+            deleted, _ = PendingRegistration.objects.filter(
+                pk__in=ids, expires_at__lte=now
+            ).delete()
+            total += deleted
+            if options["pause"]:
+                sleep(options["pause"])
+        self.stdout.write(f"Удалено незавершённых регистраций: {total}")
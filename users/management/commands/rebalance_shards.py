@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections
+
+from users.models import User, UserDirectory
+from users.sharding import get_shard_for_phone, is_sharded, move_user
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит пользователей в шарды, соответствующие хэшу их номера телефона "
+        "(например, после изменения USER_SHARDS), и дополняет справочник пользователей"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            nargs="*",
+            default=[],
+            help="Дополнительные базы данных, из которых нужно перенести пользователей, например default",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Количество пользователей, читаемых из шарда за один запрос",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Только показать, сколько пользователей будет перенесено",
+        )
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("Шардирование выключено: USER_SHARDS пуст")
+
+        moved = 0
+        sources = list(dict.fromkeys([*settings.USER_SHARDS, *options["source"]]))
+        for source in sources:
+            last_id = 0
+            while True:
+                users = list(
+                    User.objects.using(source)
+                    .filter(pk__gt=last_id)
+                    .order_by("pk")[: options["batch_size"]]
+                )
+                if not users:
+                    break
+                last_id = users[-1].pk
+                if not options["dry_run"]:
+                    self.add_missing_directory_entries(users)
+
+                for user in users:
+                    target = get_shard_for_phone(user.phone)
+                    if target == source:
+                        continue
+                    moved += 1
+                    if not options["dry_run"]:
+                        move_user(user, target)
+            self.stdout.write(f"Обработан шард {source}")
+
+        if not options["dry_run"]:
+            self.reset_directory_sequence()
+        action = "Будет перенесено" if options["dry_run"] else "Перенесено"
+        self.stdout.write(f"{action} пользователей: {moved}")
+
+    def add_missing_directory_entries(self, users):
+        """Создаёт записи справочника для пользователей, которых в нём ещё нет"""
+        existing = set(
+            UserDirectory.objects.filter(
+                pk__in=[user.pk for user in users]
+            ).values_list("pk", flat=True)
+        )
+        UserDirectory.objects.bulk_create(
+            [
+                UserDirectory(
+                    pk=user.pk,
+                    phone=user.phone,
+                    invite_code=user.invite_code,
+                    shard=user._state.db,
+                    invited_by_id=user.invited_by_id,
+                )
+                for user in users
+                if user.pk not in existing
+            ]
+        )
+
+    def reset_directory_sequence(self):
+        """
+        Сдвигает последовательность id справочника за максимальный id: записи для
+        существующих пользователей создаются с явным id, а новые получают id от неё.
+        """
+        connection = connections["default"]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [UserDirectory]):
+                cursor.execute(sql)
@@ -0,0 +1,99 @@
+import io
+from time import monotonic
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections, transaction
+
+from users.models import ReferralTreeStats, User
+from users.referral_graph import CHUNK_SIZE, compute_tree_stats, load_edges
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает для всех пользователей количество прямых рефералов, "
+        "размер дерева рефералов и глубину в дереве приглашений"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help="Количество строк, читаемых и записываемых за один раз",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        started = monotonic()
+        shards = settings.USER_SHARDS or ["default"]
+        ids, parent_ids = load_edges(
+            [User.objects.using(shard).all() for shard in shards], chunk_size
+        )
+        loaded = monotonic()
+        direct, descendants, depth = compute_tree_stats(ids, parent_ids)
+        computed = monotonic()
+        self.write_stats(ids, direct, descendants, depth, chunk_size)
+        self.stdout.write(
+            f"Пользователей: {len(ids)}, чтение: {loaded - started:.1f} с, "
+            f"расчёт: {computed - loaded:.1f} с, запись: {monotonic() - computed:.1f} с"
+        )
+
+    def write_stats(self, ids, direct, descendants, depth, chunk_size):
+        """
+        Полностью заменяет содержимое таблицы показателей. В Postgres данные
+        загружаются через COPY, в остальных базах - через bulk_create пачками.
+        """
+        connection = connections["default"]
+        table = ReferralTreeStats._meta.db_table
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute(f"TRUNCATE {connection.ops.quote_name(table)}")
+                    for start in range(0, len(ids), chunk_size):
+                        buffer = io.StringIO()
+                        for row in self.iter_rows(
+                            ids, direct, descendants, depth, start, chunk_size
+                        ):
+                            buffer.write(
+                                "\t".join(r"\N" if v is None else str(v) for v in row)
+                                + "\n"
+                            )
+                        buffer.seek(0)
+                        cursor.copy_expert(
+                            f"COPY {connection.ops.quote_name(table)} "
+                            "(user_id, direct_referrals, descendants, depth) FROM STDIN",
+                            buffer,
+                        )
+                return
+
+            ReferralTreeStats.objects.all().delete()
+            for start in range(0, len(ids), chunk_size):
+                rows = self.iter_rows(
+                    ids, direct, descendants, depth, start, chunk_size
+                )
+                ReferralTreeStats.objects.bulk_create(
+                    ReferralTreeStats(
+                        user_id=row[0],
+                        direct_referrals=row[1],
+                        descendants=row[2],
+                        depth=row[3],
+                    )
+                    for row in rows
+                )
+
+    def iter_rows(self, ids, direct, descendants, depth, start, chunk_size):
+        """Строки таблицы показателей для среза массивов; -1 заменяется на None"""
+        end = start + chunk_size
+        for user_id, direct_referrals, user_descendants, user_depth in zip(
+            ids[start:end].tolist(),
+            direct[start:end].tolist(),
+            descendants[start:end].tolist(),
+            depth[start:end].tolist(),
+        ):
+            yield (
+                user_id,
+                direct_referrals,
+                None if user_descendants < 0 else user_descendants,
+                None if user_depth < 0 else user_depth,
+            )
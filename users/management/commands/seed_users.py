@@ -0,0 +1,265 @@
+import io
+import string
+from time import monotonic
+
+import numpy as np
+from django.core.management import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.utils import timezone
+
+from users.models import User
+
+# Алфавит инвайт-кодов, как в users.services.create_invite_code
+INVITE_CODE_ALPHABET = np.frombuffer(
+    (string.ascii_letters + string.digits).encode(), dtype=np.uint8
+)
+INVITE_CODE_SPACE = len(INVITE_CODE_ALPHABET) ** 6
+# Номера телефонов вида 79XXXXXXXXX
+PHONE_SPACE = 10**9
+SECONDS_IN_YEAR = 365 * 24 * 60 * 60
+
+# Все столбцы таблицы пользователей: у updated_at и других полей нет значения по умолчанию
+# в базе данных, поэтому COPY должен заполнять каждый столбец (проверяется в тестах)
+COLUMNS = (
+    "id",
+    "password",
+    "last_login",
+    "is_superuser",
+    "first_name",
+    "last_name",
+    "is_staff",
+    "is_active",
+    "date_joined",
+    "phone",
+    "email",
+    "avatar",
+    "country",
+    "invite_code",
+    "invited_by_id",
+    "profile_version",
+    "updated_at",
+)
+
+
+def coprime_multiplier(rng, modulus: int, factors: tuple) -> int:
+    """
+    Случайный множитель, взаимно простой с modulus (factors - простые делители modulus).
+    Отображение i -> (i * a + b) % modulus тогда биективно: разные i дают разные значения.
+    """
+    while True:
+        multiplier = int(rng.integers(modulus // 3, modulus))
+        if all(multiplier % factor for factor in factors):
+            return multiplier
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполняет пустую базу синтетическими пользователями для нагрузочного тестирования: "
+        "степенное распределение рефералов, длинные цепочки приглашений и пользователи, "
+        "ни разу не входившие в систему. Результат зависит только от --seed и --chunk-size. "
+        "Для шардированной базы заполните default и выполните rebalance_shards --source default"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=1_000_000, help="Количество пользователей"
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Зерно генератора случайных чисел"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100_000,
+            help="Количество пользователей, генерируемых и записываемых за один раз",
+        )
+        parser.add_argument(
+            "--referral-ratio",
+            type=float,
+            default=0.7,
+            help="Доля пользователей, у которых есть реферер",
+        )
+        parser.add_argument(
+            "--chain-ratio",
+            type=float,
+            default=0.02,
+            help="Доля рефералов, приглашённых предыдущим пользователем (длинные цепочки)",
+        )
+        parser.add_argument(
+            "--unverified-ratio",
+            type=float,
+            default=0.3,
+            help="Доля пользователей, ни разу не входивших в систему",
+        )
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=3.0,
+            help="Степень перекоса в сторону ранних пользователей при выборе реферера: "
+            "чем больше, тем больше рефералов у самых активных рефереров",
+        )
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Удалить всех пользователей перед заполнением",
+        )
+
+    def handle(self, *args, **options):
+        if options["count"] >= PHONE_SPACE:
+            raise CommandError(
+                f"Можно создать не больше {PHONE_SPACE - 1} пользователей"
+            )
+
+        connection = connections["default"]
+        if options["clear"]:
+            self.clear(connection)
+        elif User.objects.using("default").exists():
+            raise CommandError(
+                "Таблица пользователей не пуста, используйте --clear для её очистки"
+            )
+
+        rng = np.random.default_rng(options["seed"])
+        self.phone_a = coprime_multiplier(rng, PHONE_SPACE, (2, 5))
+        self.phone_b = int(rng.integers(PHONE_SPACE))
+        self.code_a = coprime_multiplier(rng, INVITE_CODE_SPACE, (2, 31))
+        self.code_b = int(rng.integers(INVITE_CODE_SPACE))
+        self.now = int(timezone.now().timestamp())
+
+        started = monotonic()
+        count, chunk_size = options["count"], options["chunk_size"]
+        with transaction.atomic(using="default"):
+            for start in range(0, count, chunk_size):
+                stop = min(start + chunk_size, count)
+                chunk = self.generate_chunk(rng, start, stop, count, options)
+                if connection.vendor == "postgresql":
+                    self.copy_chunk(connection, chunk)
+                else:
+                    self.bulk_create_chunk(chunk)
+                self.stdout.write(
+                    f"Создано пользователей: {stop} ({monotonic() - started:.1f} с)"
+                )
+            self.reset_sequence(connection)
+
+    def clear(self, connection):
+        """Удаляет всех пользователей без загрузки их в память"""
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"TRUNCATE {connection.ops.quote_name(User._meta.db_table)} CASCADE"
+                )
+        else:
+            User.objects.using("default").all()._raw_delete("default")
+
+    def generate_chunk(self, rng, start, stop, count, options) -> dict:
+        """
+        Генерирует пользователей с номерами start..stop-1 в виде массивов numpy.
+        Пользователь i приглашается только пользователем с меньшим номером,
+        поэтому реферер всегда зарегистрирован раньше реферала.
+        """
+        index = np.arange(start, stop, dtype=np.int64)
+        size = len(index)
+
+        # Номер реферера - i * u^skew: ранние пользователи приглашают непропорционально
+        # много, что даёт степенное распределение количества рефералов
+        referrer = (index * rng.random(size) ** options["skew"]).astype(np.int64)
+        chain = rng.random(size) < options["chain_ratio"]
+        referrer[chain] = index[chain] - 1
+        has_referrer = (rng.random(size) < options["referral_ratio"]) & (index > 0)
+        invited_by_id = np.where(has_referrer, referrer + 1, 0)
+
+        date_joined = (
+            self.now - SECONDS_IN_YEAR + index * SECONDS_IN_YEAR // max(count, 1)
+        )
+        verified = rng.random(size) >= options["unverified_ratio"]
+        last_login = date_joined + rng.integers(60, 3600, size)
+
+        phones = (index * self.phone_a + self.phone_b) % PHONE_SPACE
+        codes = (index * self.code_a + self.code_b) % INVITE_CODE_SPACE
+        code_digits = np.empty((size, 6), dtype=np.int64)
+        for position in range(5, -1, -1):
+            codes, code_digits[:, position] = np.divmod(
+                codes, len(INVITE_CODE_ALPHABET)
+            )
+
+        return {
+            "id": (index + 1).tolist(),
+            "phone": [f"79{phone:09d}" for phone in phones.tolist()],
+            "invite_code": [
+                code.decode()
+                for code in INVITE_CODE_ALPHABET[code_digits].view("S6").ravel()
+            ],
+            "invited_by_id": [value or None for value in invited_by_id.tolist()],
+            "date_joined": self.format_timestamps(date_joined),
+            "last_login": [
+                value if is_verified else None
+                for value, is_verified in zip(
+                    self.format_timestamps(last_login), verified.tolist()
+                )
+            ],
+        }
+
+    def format_timestamps(self, timestamps) -> list:
+        """Метки времени Unix в виде строк ISO 8601 в UTC"""
+        values = np.datetime_as_string(timestamps.astype("datetime64[s]"), unit="s")
+        return [f"{value}+00:00" for value in values.tolist()]
+
+    def iter_rows(self, chunk):
+        """Строки таблицы пользователей в порядке COLUMNS"""
+        for row in zip(
+            chunk["id"],
+            chunk["last_login"],
+            chunk["date_joined"],
+            chunk["phone"],
+            chunk["invite_code"],
+            chunk["invited_by_id"],
+        ):
+            user_id, last_login, date_joined, phone, invite_code, invited_by_id = row
+            yield (
+                user_id,
+                "",
+                last_login,
+                False,
+                "",
+                "",
+                False,
+                True,
+                date_joined,
+                phone,
+                None,
+                "",
+                None,
+                invite_code,
+                invited_by_id,
+                0,
+                last_login or date_joined,
+            )
+
+    def copy_chunk(self, connection, chunk):
+        """Загружает пачку пользователей в Postgres через COPY"""
+        buffer = io.StringIO()
+        for row in self.iter_rows(chunk):
+            buffer.write(
+                "\t".join(r"\N" if value is None else str(value) for value in row)
+                + "\n"
+            )
+        buffer.seek(0)
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {quote_name(User._meta.db_table)} "
+                f"({', '.join(quote_name(column) for column in COLUMNS)}) FROM STDIN",
+                buffer,
+            )
+
+    def bulk_create_chunk(self, chunk):
+        """Загружает пачку пользователей через bulk_create (для баз, отличных от Postgres)"""
+        User.objects.using("default").bulk_create(
+            User(**dict(zip(COLUMNS, row))) for row in self.iter_rows(chunk)
+        )
+
+    def reset_sequence(self, connection):
+        """Сдвигает последовательность id за максимальный id: пользователи созданы с явными id"""
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User]):
+                cursor.execute(sql)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from users.rollups import update_rollups
+
+
+class Command(BaseCommand):
+    help = "Инкрементально обновляет дневную статистику регистраций, входов и рефералов по событиям outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.ROLLUP_BATCH_SIZE,
+            help="Количество строк каждого источника в одной транзакции",
+        )
+
+    def handle(self, *args, **options):
+        events = update_rollups(options["batch_size"])
+        self.stdout.write(f"Учтено событий: {events}")
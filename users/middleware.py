@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as messages_middleware
+from django.contrib.sessions import middleware as sessions_middleware
+from django.middleware import clickjacking, csrf, gzip
+
+
+def is_api_request(request) -> bool:
+    """Относится ли запрос к JSON API (API_PREFIX, по умолчанию /api/)"""
+    return request.path_info.startswith(settings.API_PREFIX)
+
+
+class BrowserOnlyMixin:
+    """
+    Пропускает middleware для запросов к JSON API.
+
+    Сессии, CSRF, сообщения и защита от clickjacking нужны только браузерному
+    интерфейсу. Клиенты API авторизуются по JWT и получают JSON, поэтому для них
+    запрос передаётся дальше по цепочке без обработки этим middleware.
+    """
+
+    def __call__(self, request):
+        if is_api_request(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(BrowserOnlyMixin, sessions_middleware.SessionMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(BrowserOnlyMixin, csrf.CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if is_api_request(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class AuthenticationMiddleware(
+    BrowserOnlyMixin, auth_middleware.AuthenticationMiddleware
+):
+    pass
+
+
+class MessageMiddleware(BrowserOnlyMixin, messages_middleware.MessageMiddleware):
+    pass
+
+
+class XFrameOptionsMiddleware(BrowserOnlyMixin, clickjacking.XFrameOptionsMiddleware):
+    pass
+
+
+class APIGZipMiddleware(gzip.GZipMiddleware):
+    """
+    Сжимает ответы JSON API размером от API_GZIP_MIN_SIZE байт.
+    Маленькие ответы не сжимаются: выигрыш в размере не окупает затраты на сжатие.
+    Поток событий (text/event-stream) не сжимается, чтобы события не задерживались в буфере.
+    """
+
+    def process_response(self, request, response):
+        if not is_api_request(request):
+            return response
+        if response.get("Content-Type", "").startswith("text/event-stream"):
+            return response
+        if (
+            not response.streaming
+            and len(response.content) < settings.API_GZIP_MIN_SIZE
+        ):
+            return response
+        return super().process_response(request, response)
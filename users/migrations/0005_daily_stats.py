@@ -0,0 +1,129 @@
+# Generated by Django 4.2 on 2026-10-19 16:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0004_outboxevent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField(unique=True, verbose_name="День")),
+                (
+                    "registrations",
+                    models.PositiveIntegerField(
+                        default=0,
+                        verbose_name="Регистрации (запросы кода с нового номера)",
+                    ),
+                ),
+                (
+                    "logins",
+                    models.PositiveIntegerField(default=0, verbose_name="Первые входы"),
+                ),
+                (
+                    "referrals",
+                    models.PositiveIntegerField(default=0, verbose_name="Рефералы"),
+                ),
+            ],
+            options={
+                "verbose_name": "Статистика за день",
+                "verbose_name_plural": "Статистика по дням",
+                "ordering": ["-day"],
+            },
+        ),
+        migrations.CreateModel(
+            name="RollupWatermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        max_length=50, unique=True, verbose_name="Источник"
+                    ),
+                ),
+                (
+                    "last_id",
+                    models.BigIntegerField(default=0, verbose_name="Последний id"),
+                ),
+            ],
+            options={
+                "verbose_name": "Отметка пересчёта статистики",
+                "verbose_name_plural": "Отметки пересчёта статистики",
+            },
+        ),
+        migrations.AlterField(
+            model_name="outboxevent",
+            name="event_type",
+            field=models.CharField(
+                choices=[
+                    ("referrer_set", "Установлен реферер"),
+                    ("first_login", "Первый вход"),
+                ],
+                max_length=50,
+                verbose_name="Тип события",
+            ),
+        ),
+        migrations.CreateModel(
+            name="ReferrerDailyStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField(verbose_name="День")),
+                (
+                    "referrals",
+                    models.PositiveIntegerField(default=0, verbose_name="Рефералы"),
+                ),
+                (
+                    "referrer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_stats",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Реферер",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Статистика реферера за день",
+                "verbose_name_plural": "Статистика рефереров по дням",
+                "ordering": ["-day"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="referrerdailystats",
+            constraint=models.UniqueConstraint(
+                fields=("day", "referrer"), name="unique_referrer_daily_stats"
+            ),
+        ),
+    ]
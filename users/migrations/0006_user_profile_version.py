@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-19 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0005_daily_stats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="profile_version",
+            field=models.PositiveIntegerField(
+                default=0,
+                help_text="Увеличивается при каждом изменении данных профиля, используется в ETag",
+                verbose_name="Версия профиля",
+            ),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2 on 2026-10-19 16:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0006_user_profile_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserDirectory",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phone",
+                    models.CharField(
+                        max_length=11, unique=True, verbose_name="Номер телефона"
+                    ),
+                ),
+                (
+                    "invite_code",
+                    models.CharField(
+                        max_length=6, unique=True, verbose_name="Инвайт-код"
+                    ),
+                ),
+                ("shard", models.CharField(max_length=50, verbose_name="Шард")),
+                (
+                    "invited_by_id",
+                    models.BigIntegerField(
+                        blank=True, db_index=True, null=True, verbose_name="id реферера"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Запись справочника пользователей",
+                "verbose_name_plural": "Справочник пользователей",
+            },
+        ),
+        migrations.AlterField(
+            model_name="user",
+            name="invited_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                help_text="Пользователь, который Вас пригласил",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="referrals",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="Кем приглашён",
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-19 16:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0007_user_directory"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReferralTreeStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="tree_stats",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Пользователь",
+                    ),
+                ),
+                (
+                    "direct_referrals",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Прямые рефералы"
+                    ),
+                ),
+                (
+                    "descendants",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="Пусто, если пользователь входит в цикл взаимных приглашений",
+                        null=True,
+                        verbose_name="Все рефералы по цепочке",
+                    ),
+                ),
+                (
+                    "depth",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="Пусто, если пользователь входит в цикл взаимных приглашений",
+                        null=True,
+                        verbose_name="Глубина в дереве приглашений",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Показатели в дереве приглашений",
+                "verbose_name_plural": "Показатели в дереве приглашений",
+            },
+        ),
+    ]
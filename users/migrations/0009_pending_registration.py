@@ -0,0 +1,52 @@
+# Generated by Django 4.2 on 2026-10-19 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0008_referral_tree_stats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingRegistration",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phone",
+                    models.CharField(
+                        max_length=11, unique=True, verbose_name="Номер телефона"
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Создано"),
+                ),
+                (
+                    "expires_at",
+                    models.DateTimeField(db_index=True, verbose_name="Действует до"),
+                ),
+            ],
+            options={
+                "verbose_name": "Незавершённая регистрация",
+                "verbose_name_plural": "Незавершённые регистрации",
+            },
+        ),
+        migrations.AlterField(
+            model_name="dailystats",
+            name="registrations",
+            field=models.PositiveIntegerField(
+                default=0, verbose_name="Регистрации (первые входы с нового номера)"
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-19 18:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0009_pending_registration"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True,
+                db_index=True,
+                default=django.utils.timezone.now,
+                verbose_name="Изменён",
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="userdirectory",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True,
+                db_index=True,
+                default=django.utils.timezone.now,
+                verbose_name="Изменена",
+            ),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-19 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0010_updated_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="dailystats",
+            name="registrations",
+            field=models.PositiveIntegerField(
+                default=0, verbose_name="Регистрации (запросы кода для нового номера)"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="outboxevent",
+            name="event_type",
+            field=models.CharField(
+                choices=[
+                    ("referrer_set", "Установлен реферер"),
+                    ("first_login", "Первый вход"),
+                    ("registration_started", "Запрошен код для нового номера"),
+                ],
+                max_length=50,
+                verbose_name="Тип события",
+            ),
+        ),
+    ]
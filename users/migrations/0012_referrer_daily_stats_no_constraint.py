@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-19 17:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0011_registration_started_event"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="referrerdailystats",
+            name="referrer",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="daily_stats",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="Реферер",
+            ),
+        ),
+    ]
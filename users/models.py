@@ -31,21 +31,254 @@ class User(AbstractUser):
         verbose_name="Инвайт-код",
         help_text="Автоматически генерируется при регистрации",
     )
+    # Без ограничения внешнего ключа в БД: при шардировании реферер может находиться в другом шарде
     invited_by = models.ForeignKey(
         "self",
         on_delete=models.SET_NULL,
+        db_constraint=False,
         related_name="referrals",
         verbose_name="Кем приглашён",
         help_text="Пользователь, который Вас пригласил",
-        **NULLABLE
+        **NULLABLE,
+    )
+    profile_version = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Версия профиля",
+        help_text="Увеличивается при каждом изменении данных профиля, используется в ETag",
+    )
+    # По нему фильтр Блума инвайт-кодов (users.bloom) подгружает новые и изменённые коды
+    updated_at = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name="Изменён"
     )
 
     USERNAME_FIELD = "phone"
     REQUIRED_FIELDS = []
 
+    # Поля, изменение которых меняет профиль пользователя (/users/retrieve/)
+    PROFILE_FIELDS = {"phone", "invite_code", "invited_by", "avatar"}
+
     class Meta:
         verbose_name = "Пользователь"
         verbose_name_plural = "Пользователи"
 
     def __str__(self):
         return self.phone
+
+    def save(self, *args, **kwargs):
+        """
+        Сохраняет пользователя и увеличивает версию профиля, если изменились поля профиля.
+        Также увеличивается версия профиля реферера (в его профиле выводятся номера рефералов)
+        и рефералов (в их профилях выводятся номер и инвайт-код реферера).
+        """
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            changed = set(self.PROFILE_FIELDS)
+        else:
+            changed = self.PROFILE_FIELDS & {
+                "invited_by" if field == "invited_by_id" else field
+                for field in update_fields
+            }
+        adding = self._state.adding
+        bump = bool(changed) and not adding
+        if bump:
+            self.profile_version = models.F("profile_version") + 1
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "profile_version"}
+        super().save(*args, **kwargs)
+        if bump:
+            self.refresh_from_db(fields=["profile_version"])
+
+        related = models.Q()
+        if changed & {"phone", "invited_by"} and self.invited_by_id:
+            related |= models.Q(pk=self.invited_by_id)
+        if changed & {"phone", "invite_code"} and not adding:
+            related |= models.Q(invited_by=self)
+        if related:
+            bump_profile_version(User.objects.using(self._state.db).filter(related))
+
+
+def bump_profile_version(queryset) -> None:
+    """Увеличивает версию профиля у всех пользователей из queryset одним запросом"""
+    queryset.update(profile_version=models.F("profile_version") + 1)
+
+
+class PendingRegistration(models.Model):
+    """
+    Номер телефона, на который запрошен код входа, но вход ещё не выполнен.
+    Пользователь создаётся только после ввода верного кода (EnterCodeBackend),
+    поэтому номера ботов и опечатки не попадают в таблицу пользователей.
+    Просроченные записи удаляет команда purge_pending_registrations.
+    """
+
+    phone = models.CharField(max_length=11, unique=True, verbose_name="Номер телефона")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="Действует до")
+
+    class Meta:
+        verbose_name = "Незавершённая регистрация"
+        verbose_name_plural = "Незавершённые регистрации"
+
+    def __str__(self):
+        return self.phone
+
+
+class OutboxEvent(models.Model):
+    """
+    Событие реферальной системы для доставки во внешние системы (transactional outbox).
+    Записывается в той же транзакции, что и изменение пользователя.
+    """
+
+    REFERRER_SET = "referrer_set"
+    FIRST_LOGIN = "first_login"
+    REGISTRATION_STARTED = "registration_started"
+    EVENT_TYPES = [
+        (REFERRER_SET, "Установлен реферер"),
+        (FIRST_LOGIN, "Первый вход"),
+        (REGISTRATION_STARTED, "Запрошен код для нового номера"),
+    ]
+
+    event_type = models.CharField(
+        max_length=50, choices=EVENT_TYPES, verbose_name="Тип события"
+    )
+    payload = models.JSONField(verbose_name="Данные события")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    processed_at = models.DateTimeField(verbose_name="Доставлено", **NULLABLE)
+
+    class Meta:
+        verbose_name = "Событие outbox"
+        verbose_name_plural = "События outbox"
+        ordering = ["id"]
+        indexes = [
+            # Частичный индекс по недоставленным событиям, чтобы выборка очереди
+            # не зависела от объёма уже обработанной истории
+            models.Index(
+                fields=["id"],
+                condition=models.Q(processed_at__isnull=True),
+                name="outbox_pending_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} #{self.pk}"
+
+
+class DailyStats(models.Model):
+    """Агрегированная статистика за день. Обновляется командой update_rollups."""
+
+    day = models.DateField(unique=True, verbose_name="День")
+    registrations = models.PositiveIntegerField(
+        default=0, verbose_name="Регистрации (запросы кода для нового номера)"
+    )
+    logins = models.PositiveIntegerField(default=0, verbose_name="Первые входы")
+    referrals = models.PositiveIntegerField(default=0, verbose_name="Рефералы")
+
+    class Meta:
+        verbose_name = "Статистика за день"
+        verbose_name_plural = "Статистика по дням"
+        ordering = ["-day"]
+
+    def __str__(self):
+        return str(self.day)
+
+
+class ReferrerDailyStats(models.Model):
+    """Количество приглашённых рефералов на реферера за день"""
+
+    day = models.DateField(verbose_name="День")
+    # Без ограничения внешнего ключа в БД: при шардировании пользователи находятся в других базах
+    referrer = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        db_constraint=False,
+        related_name="daily_stats",
+        verbose_name="Реферер",
+    )
+    referrals = models.PositiveIntegerField(default=0, verbose_name="Рефералы")
+
+    class Meta:
+        verbose_name = "Статистика реферера за день"
+        verbose_name_plural = "Статистика рефереров по дням"
+        ordering = ["-day"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "referrer"], name="unique_referrer_daily_stats"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.referrer} {self.day}"
+
+
+class RollupWatermark(models.Model):
+    """Последний обработанный id источника для инкрементального пересчёта статистики"""
+
+    name = models.CharField(max_length=50, unique=True, verbose_name="Источник")
+    last_id = models.BigIntegerField(default=0, verbose_name="Последний id")
+
+    class Meta:
+        verbose_name = "Отметка пересчёта статистики"
+        verbose_name_plural = "Отметки пересчёта статистики"
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
+
+
+class UserDirectory(models.Model):
+    """
+    Глобальный справочник пользователей при шардировании (см. users.sharding).
+    Хранится в базе default, id записи является глобальным id пользователя.
+    """
+
+    phone = models.CharField(max_length=11, unique=True, verbose_name="Номер телефона")
+    invite_code = models.CharField(max_length=6, unique=True, verbose_name="Инвайт-код")
+    shard = models.CharField(max_length=50, verbose_name="Шард")
+    invited_by_id = models.BigIntegerField(
+        db_index=True, verbose_name="id реферера", **NULLABLE
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name="Изменена"
+    )
+
+    class Meta:
+        verbose_name = "Запись справочника пользователей"
+        verbose_name_plural = "Справочник пользователей"
+
+    def __str__(self):
+        return f"{self.phone} ({self.shard})"
+
+
+class ReferralTreeStats(models.Model):
+    """
+    Показатели пользователя в дереве приглашений. Пересчитываются для всех
+    пользователей сразу командой referral_graph_stats.
+    """
+
+    # Без ограничения внешнего ключа в БД: при шардировании пользователи находятся в других базах
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        db_constraint=False,
+        related_name="tree_stats",
+        verbose_name="Пользователь",
+    )
+    direct_referrals = models.PositiveIntegerField(
+        default=0, verbose_name="Прямые рефералы"
+    )
+    descendants = models.PositiveIntegerField(
+        verbose_name="Все рефералы по цепочке",
+        help_text="Пусто, если пользователь входит в цикл взаимных приглашений",
+        **NULLABLE,
+    )
+    depth = models.PositiveIntegerField(
+        verbose_name="Глубина в дереве приглашений",
+        help_text="Пусто, если пользователь входит в цикл взаимных приглашений",
+        **NULLABLE,
+    )
+
+    class Meta:
+        verbose_name = "Показатели в дереве приглашений"
+        verbose_name_plural = "Показатели в дереве приглашений"
+
+    def __str__(self):
+        return str(self.user_id)
@@ -0,0 +1,113 @@
+import json
+
+import requests
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from users.models import OutboxEvent
+
+
+def get_outbox_databases() -> list:
+    """
+    Базы данных, в которых хранятся события outbox: default и шарды пользователей.
+    Событие пишется в ту базу, где изменяются данные, иначе запись не будет атомарной.
+    """
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *settings.USER_SHARDS]))
+
+
+def publish_event(event_type: str, payload: dict, using: str = None) -> OutboxEvent:
+    """
+    Записывает событие в outbox. Вызывается внутри той же транзакции, что и
+    изменение данных, поэтому событие появляется тогда и только тогда, когда
+    транзакция зафиксирована. При шардировании в using передаётся шард, данные
+    которого изменяются, и транзакция открывается в нём же.
+    """
+    return OutboxEvent.objects.using(using or DEFAULT_DB_ALIAS).create(
+        event_type=event_type, payload=payload
+    )
+
+
+def serialize_event(event: OutboxEvent) -> dict:
+    """
+    Представление события, которое передаётся во внешние системы.
+    id уникален только в пределах базы данных, поэтому передаётся и её алиас.
+    """
+    return {
+        "id": event.pk,
+        "database": event._state.db,
+        "event_type": event.event_type,
+        "payload": event.payload,
+        "created_at": event.created_at.isoformat(),
+    }
+
+
+def drain_batch(sink, batch_size: int, using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Доставляет в sink одну пачку недоставленных событий из базы using.
+
+    Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько
+    потребителей могут работать параллельно, не получая одни и те же события.
+    Если sink выбросит исключение, транзакция откатится и пачка будет доставлена повторно.
+
+    Returns:
+    int: количество доставленных событий
+    """
+    with transaction.atomic(using=using):
+        events = list(
+            OutboxEvent.objects.using(using)
+            .select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True)
+            .order_by("id")[:batch_size]
+        )
+        if not events:
+            return 0
+        sink.send([serialize_event(event) for event in events])
+        OutboxEvent.objects.using(using).filter(
+            pk__in=[event.pk for event in events]
+        ).update(processed_at=timezone.now())
+    return len(events)
+
+
+class BaseSink:
+    """Базовый класс получателя событий outbox"""
+
+    def send(self, events: list) -> None:
+        """Доставляет пачку событий. Требуется переопределить."""
+        raise NotImplementedError
+
+
+class LocMemSink(BaseSink):
+    """Сохраняет события в памяти процесса. Используется в тестах и при разработке."""
+
+    events = []
+
+    def send(self, events):
+        self.events.extend(events)
+
+
+class FileSink(BaseSink):
+    """Дописывает события в файл OUTBOX_FILE_PATH в формате JSON Lines"""
+
+    def __init__(self, path=None):
+        self.path = path or settings.OUTBOX_FILE_PATH
+
+    def send(self, events):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for event in events:
+                file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+class HTTPSink(BaseSink):
+    """Отправляет пачку событий POST-запросом с JSON-телом на OUTBOX_HTTP_URL"""
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or settings.OUTBOX_HTTP_URL
+        self.timeout = timeout or settings.OUTBOX_HTTP_TIMEOUT
+        self.session = requests.Session()
+
+    def send(self, events):
+        response = self.session.post(
+            self.url, json={"events": events}, timeout=self.timeout
+        )
+        response.raise_for_status()
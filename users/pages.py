@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest, HttpResponse
+from django.middleware.csrf import get_token
+from django.template import loader
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+# Подставляется вместо CSRF-токена при предварительном рендеринге страницы
+CSRF_PLACEHOLDER = "__csrf_token_placeholder__"
+
+# Отрендеренные страницы: (шаблон, формат, адрес) -> части страницы вокруг CSRF-токена
+_pages = {}
+
+
+def get_anonymous_request(request) -> HttpRequest:
+    """
+    Запрос на тот же адрес без пользователя, сессии и cookies. Страница рендерится по нему,
+    чтобы context processors (request, user, messages) применялись, но кэшированная страница
+    не зависела от того, кто запросил её первым.
+    """
+    anonymous = HttpRequest()
+    anonymous.method = "GET"
+    anonymous.path = request.path
+    anonymous.path_info = request.path_info
+    anonymous.user = AnonymousUser()
+    return anonymous
+
+
+def render_page_parts(template_name: str, context: dict, request=None) -> list:
+    """
+    Рендерит шаблон с заглушкой вместо CSRF-токена и разбивает результат
+    по заглушке, чтобы при ответе оставалось только склеить части с токеном.
+    """
+    template = loader.get_template(template_name)
+    content = template.render(
+        {**context, "csrf_token": CSRF_PLACEHOLDER}, request=request
+    )
+    return content.split(CSRF_PLACEHOLDER)
+
+
+def cached_form_page(request, template_name: str, context: dict) -> HttpResponse:
+    """
+    Возвращает страницу с формой, отрендеренную один раз на процесс.
+
+    Содержимое формы не зависит от запроса, кроме CSRF-токена, поэтому шаблон
+    рендерится при первом обращении и кэшируется для (шаблон, формат ответа, адрес).
+    Рендеринг идёт с context processors, но от имени анонимного запроса
+    (см. get_anonymous_request). Токен текущего запроса подставляется в готовую
+    страницу, а get_token заодно обеспечивает установку CSRF-cookie.
+
+    Parameters:
+    request (Request): Запрос, для которого отдаётся страница.
+    template_name (str): Имя шаблона формы.
+    context (dict): Контекст для первого рендеринга, например {"serializer": ...}.
+
+    Returns:
+    HttpResponse: Страница с заголовками Cache-Control и Vary: Cookie.
+    """
+    key = (template_name, request.accepted_renderer.format, request.path_info)
+    parts = _pages.get(key)
+    if parts is None:
+        parts = _pages[key] = render_page_parts(
+            template_name, context, get_anonymous_request(request)
+        )
+
+    response = HttpResponse(
+        get_token(request).join(parts), content_type="text/html; charset=utf-8"
+    )
+    # Страница содержит CSRF-токен, привязанный к cookie, поэтому кэшировать её
+    # может только браузер пользователя
+    patch_cache_control(response, private=True, max_age=settings.FORM_PAGE_MAX_AGE)
+    patch_vary_headers(response, ["Cookie"])
+    return response
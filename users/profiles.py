@@ -0,0 +1,55 @@
+"""
+Загрузка профиля пользователя одним SQL-запросом.
+
+Номер телефона и инвайт-код реферера присоединяются через LEFT JOIN, а номера рефералов
+собираются в JSON-массив коррелированным подзапросом с агрегатом. UserRetrieveSerializer
+читает эти аннотации вместо отдельных запросов к рефереру и рефералам.
+При шардировании реферер и рефералы могут находиться в других базах, поэтому
+профиль собирается функциями users.sharding.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db.models import Aggregate, F, JSONField, OuterRef, Subquery
+
+User = get_user_model()
+
+
+class JSONArrayAgg(Aggregate):
+    """
+    Агрегат значений в JSON-массив: json_group_array в SQLite, jsonb_agg в Postgres.
+    В Postgres используется jsonb, а не json: Django получает jsonb строкой и разбирает
+    её JSONField, а json драйвер psycopg2 разобрал бы сам.
+    """
+
+    function = "JSON_GROUP_ARRAY"
+    output_field = JSONField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, function="JSONB_AGG", **extra_context
+        )
+
+
+def annotate_profile(queryset, referrer: bool = True, referrals: bool = True):
+    """
+    Добавляет к пользователям аннотации профиля:
+    referrer_phone и referrer_invite_code - поля реферера (None, если реферера нет),
+    referral_phones - номера рефералов (None, если рефералов нет).
+    """
+    if referrer:
+        queryset = queryset.annotate(
+            referrer_phone=F("invited_by__phone"),
+            referrer_invite_code=F("invited_by__invite_code"),
+        )
+    if referrals:
+        queryset = queryset.annotate(
+            referral_phones=Subquery(
+                User.objects.filter(invited_by=OuterRef("pk"))
+                .order_by()
+                .values("invited_by")
+                .annotate(phones=JSONArrayAgg("phone"))
+                .values("phones"),
+                output_field=JSONField(),
+            )
+        )
+    return queryset
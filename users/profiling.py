@@ -0,0 +1,90 @@
+import cProfile
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+def get_profile_dir(view_name: str) -> str:
+    """Каталог с профилями представления"""
+    return os.path.join(settings.PROFILING_DIR, view_name.replace(":", "."))
+
+
+def save_profile(view_name: str, profiler: cProfile.Profile) -> None:
+    """
+    Сохраняет профиль запроса в формате pstats в каталог представления.
+    Каждый запрос пишется в отдельный файл, поэтому процессы не блокируют
+    друг друга, а команда profile_report агрегирует файлы при чтении.
+    """
+    directory = get_profile_dir(view_name)
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{time.time_ns()}-{os.getpid()}.prof"
+    profiler.dump_stats(os.path.join(directory, filename))
+    rotate_profiles(directory, settings.PROFILING_MAX_FILES)
+
+
+def rotate_profiles(directory: str, max_files: int) -> None:
+    """
+    Оставляет в каталоге не больше max_files последних профилей, удаляя самые старые.
+    Имя файла начинается со времени записи, поэтому сортировка по имени - это сортировка
+    по времени. Файл может одновременно удалить другой процесс, это не ошибка.
+    """
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".prof"))
+    for name in files[: max(len(files) - max_files, 0)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    """
+    Профилирует выборку запросов через cProfile и сохраняет профили по представлениям.
+
+    Профилируется доля PROFILING_SAMPLE_RATE всех запросов, все запросы к
+    представлениям из PROFILING_URL_NAMES (например, "users:retrieve") и запросы
+    с заголовком X-Profile, равным PROFILING_TOKEN. Для каждого представления хранится
+    не больше PROFILING_MAX_FILES последних профилей. Если PROFILING_ENABLED выключен,
+    middleware исключается из обработки запросов и не создаёт накладных расходов.
+    """
+
+    header = "HTTP_X_PROFILE"
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.url_names = set(settings.PROFILING_URL_NAMES)
+        self.token = settings.PROFILING_TOKEN
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        profiler = getattr(request, "_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            save_profile(request.resolver_match.view_name, profiler)
+        return response
+
+    def should_profile(self, request) -> bool:
+        """Нужно ли профилировать запрос"""
+        if request.resolver_match.view_name in self.url_names:
+            return True
+        if self.token and request.META.get(self.header) == self.token:
+            return True
+        return random.random() < self.sample_rate
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Запускает профилировщик перед вызовом представления, если запрос попал в выборку"""
+        if not self.should_profile(request):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # В этом потоке уже работает другой профилировщик
+            return None
+        request._profiler = profiler
+        return None
@@ -0,0 +1,96 @@
+import numpy as np
+
+# Пары (id, invited_by_id) читаются из базы кусками такого размера
+CHUNK_SIZE = 100_000
+
+
+def load_edges(querysets, chunk_size=CHUNK_SIZE) -> tuple:
+    """
+    Читает пары (id, invited_by_id) из querysets потоково и складывает их
+    в компактные массивы int64. Отсутствующий реферер записывается как -1.
+
+    Returns:
+    tuple: (массив id, массив id рефереров), отсортированные по id
+    """
+    id_chunks, parent_chunks = [], []
+    for queryset in querysets:
+        rows = (
+            queryset.values_list("pk", "invited_by_id")
+            .order_by()
+            .iterator(chunk_size=chunk_size)
+        )
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+            if not chunk:
+                break
+            ids, parents = zip(*chunk)
+            id_chunks.append(np.array(ids, dtype=np.int64))
+            parent_chunks.append(
+                np.array([-1 if p is None else p for p in parents], dtype=np.int64)
+            )
+
+    if not id_chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    ids = np.concatenate(id_chunks)
+    parents = np.concatenate(parent_chunks)
+    order = np.argsort(ids, kind="stable")
+    return ids[order], parents[order]
+
+
+def compute_tree_stats(ids, parent_ids) -> tuple:
+    """
+    Считает для всех пользователей сразу количество прямых рефералов, размер
+    поддерева (всех рефералов по цепочке) и глубину в дереве приглашений.
+
+    Граф обходится по уровням от корней (пользователей без реферера): каждый
+    уровень - одна векторная операция над массивами, поэтому число итераций
+    Python равно глубине дерева, а не количеству пользователей. Размеры поддеревьев
+    накапливаются проходом по уровням в обратном порядке.
+
+    Пользователи, до которых нельзя дойти от корня (взаимные приглашения образуют
+    цикл), получают глубину и размер поддерева -1.
+
+    Parameters:
+    ids (ndarray): Отсортированные id пользователей.
+    parent_ids (ndarray): id реферера каждого пользователя или -1.
+
+    Returns:
+    tuple: (прямые рефералы, размер поддерева без самого пользователя, глубина)
+    """
+    count = len(ids)
+    # Индекс реферера в массиве ids, -1 если реферера нет или он не найден
+    parents = np.searchsorted(ids, parent_ids).astype(np.int32)
+    parents[parents >= count] = 0
+    parents[(parent_ids < 0) | (ids[parents] != parent_ids)] = -1
+
+    has_parent = parents >= 0
+    direct = np.bincount(parents[has_parent], minlength=count).astype(np.int32)
+
+    # Списки детей в формате CSR: дети узла i - children[start[i]:start[i + 1]]
+    roots_count = count - int(has_parent.sum())
+    children = np.argsort(parents, kind="stable").astype(np.int32)[roots_count:]
+    start = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(direct, out=start[1:])
+
+    depth = np.full(count, -1, dtype=np.int32)
+    levels = []
+    frontier = np.flatnonzero(~has_parent).astype(np.int32)
+    level = 0
+    while len(frontier):
+        depth[frontier] = level
+        levels.append(frontier)
+        # Все дети узлов текущего уровня одной векторной операцией
+        sizes = direct[frontier]
+        total = int(sizes.sum())
+        if not total:
+            break
+        offsets = np.repeat(start[frontier] - np.cumsum(sizes) + sizes, sizes)
+        frontier = children[offsets + np.arange(total)]
+        level += 1
+
+    subtree = np.ones(count, dtype=np.int64)
+    for nodes in reversed(levels[1:]):
+        np.add.at(subtree, parents[nodes], subtree[nodes])
+    descendants = subtree - 1
+    descendants[depth < 0] = -1
+    return direct, descendants, depth
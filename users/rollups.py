@@ -0,0 +1,154 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from users.models import DailyStats, OutboxEvent, ReferrerDailyStats, RollupWatermark
+from users.outbox import get_outbox_databases
+from users.sharding import get_phones_by_id
+
+EVENTS_WATERMARK = "outbox_events"
+
+
+def _watermark_name(using: str) -> str:
+    """
+    Имя отметки для событий outbox из базы using. id событий растут независимо
+    в каждой базе, поэтому у каждого шарда своя отметка.
+    """
+    if using == DEFAULT_DB_ALIAS:
+        return EVENTS_WATERMARK
+    return f"{EVENTS_WATERMARK}:{using}"
+
+
+def _lock_watermark(name: str) -> RollupWatermark:
+    """
+    Возвращает отметку пересчёта, заблокированную до конца транзакции.
+    Блокировка не даёт двум одновременным запускам посчитать одни и те же строки дважды.
+    """
+    RollupWatermark.objects.get_or_create(name=name)
+    return RollupWatermark.objects.select_for_update().get(name=name)
+
+
+def _increment_daily_stats(field: str, counts: Counter) -> None:
+    """Прибавляет counts (день -> количество) к полю field дневной статистики"""
+    if not counts:
+        return
+    existing = {stats.day: stats for stats in DailyStats.objects.filter(day__in=counts)}
+    new = []
+    for day, count in counts.items():
+        stats = existing.get(day)
+        if stats is None:
+            new.append(DailyStats(day=day, **{field: count}))
+        else:
+            setattr(stats, field, getattr(stats, field) + count)
+    DailyStats.objects.bulk_update(existing.values(), [field])
+    DailyStats.objects.bulk_create(new)
+
+
+def _increment_referrer_stats(counts: Counter) -> None:
+    """Прибавляет counts ((день, id реферера) -> количество) к статистике рефереров"""
+    # Реферер мог быть удалён после события - такие события не учитываются
+    referrer_ids = set(get_phones_by_id({referrer_id for _, referrer_id in counts}))
+    counts = Counter(
+        {key: count for key, count in counts.items() if key[1] in referrer_ids}
+    )
+    if not counts:
+        return
+    existing = {
+        (stats.day, stats.referrer_id): stats
+        for stats in ReferrerDailyStats.objects.filter(
+            day__in={day for day, _ in counts}, referrer_id__in=referrer_ids
+        )
+    }
+    new = []
+    for (day, referrer_id), count in counts.items():
+        stats = existing.get((day, referrer_id))
+        if stats is None:
+            new.append(
+                ReferrerDailyStats(day=day, referrer_id=referrer_id, referrals=count)
+            )
+        else:
+            stats.referrals += count
+    ReferrerDailyStats.objects.bulk_update(existing.values(), ["referrals"])
+    ReferrerDailyStats.objects.bulk_create(new)
+
+
+def _settled(queryset, created_field: str, last_id: int):
+    """
+    Строки после отметки, которые уже нельзя обогнать незакоммиченной транзакцией.
+
+    id выдаются при вставке, а строки видны только после коммита, поэтому строка с
+    меньшим id может появиться позже строки с большим. Если сдвинуть отметку за такую
+    строку, она не будет учтена никогда. Поэтому обрабатываются только строки до первой,
+    созданной менее ROLLUP_SAFETY_LAG секунд назад: более старые транзакции уже завершены.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ROLLUP_SAFETY_LAG)
+    rows = queryset.filter(pk__gt=last_id)
+    first_recent_id = (
+        rows.filter(**{f"{created_field}__gt": cutoff})
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .first()
+    )
+    if first_recent_id is not None:
+        rows = rows.filter(pk__lt=first_recent_id)
+    return rows
+
+
+def _rollup_events(watermark: RollupWatermark, batch_size: int, using: str) -> int:
+    """
+    Учитывает регистрации (запросы кода для нового номера), первые входы и установку
+    рефереров по событиям outbox из базы using после отметки
+    """
+    events = list(
+        _settled(OutboxEvent.objects.using(using), "created_at", watermark.last_id)
+        .order_by("pk")
+        .values_list("pk", "event_type", "created_at", "payload")[:batch_size]
+    )
+    if not events:
+        return 0
+    registrations = Counter()
+    logins = Counter()
+    referrals = Counter()
+    referrer_referrals = Counter()
+    for _, event_type, created_at, payload in events:
+        day = timezone.localtime(created_at).date()
+        if event_type == OutboxEvent.REGISTRATION_STARTED:
+            registrations[day] += 1
+        elif event_type == OutboxEvent.FIRST_LOGIN:
+            logins[day] += 1
+        elif event_type == OutboxEvent.REFERRER_SET:
+            referrals[day] += 1
+            referrer_referrals[day, payload["referrer_id"]] += 1
+    _increment_daily_stats("registrations", registrations)
+    _increment_daily_stats("logins", logins)
+    _increment_daily_stats("referrals", referrals)
+    _increment_referrer_stats(referrer_referrals)
+    watermark.last_id = events[-1][0]
+    watermark.save(update_fields=["last_id"])
+    return len(events)
+
+
+def update_rollups(batch_size: int) -> int:
+    """
+    Инкрементально обновляет статистику: обрабатывает только события outbox,
+    появившиеся в каждой из баз после её отметки и не позже чем ROLLUP_SAFETY_LAG
+    секунд назад (см. _settled). Каждая пачка обрабатывается в отдельной транзакции
+    вместе со сдвигом отметки.
+
+    Returns:
+    int: количество учтённых событий
+    """
+    total = 0
+    for using in get_outbox_databases():
+        while True:
+            with transaction.atomic():
+                events = _rollup_events(
+                    _lock_watermark(_watermark_name(using)), batch_size, using
+                )
+            total += events
+            if not events:
+                break
+    return total
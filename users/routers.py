@@ -0,0 +1,34 @@
+from users.models import User, UserDirectory
+
+
+class UserShardRouter:
+    """
+    Роутер баз данных для шардирования пользователей (см. users.sharding).
+    Справочник пользователей всегда находится в базе default, запросы к связанным
+    объектам пользователя выполняются в базе, из которой загружен сам пользователь.
+    """
+
+    def _db_for_model(self, model, **hints):
+        if model is UserDirectory:
+            return "default"
+        instance = hints.get("instance")
+        if model is User and instance is not None and instance._state.db:
+            return instance._state.db
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реферер может находиться в другом шарде, связь хранится по глобальному id
+        if isinstance(obj1, User) and isinstance(obj2, User):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == "users" and model_name == "userdirectory":
+            return db == "default"
+        return None
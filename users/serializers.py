@@ -1,10 +1,90 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from PIL import Image
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from users.avatars import get_thumbnail_urls
+from users.models import DailyStats
+from users.profiles import annotate_profile
+from users.sharding import get_referral_phones, get_referrer, is_sharded
+
 User = get_user_model()
 
 
+def split_fields(value) -> list:
+    """Список имён полей из параметра запроса вида phone,invite_code"""
+    return [name.strip() for name in (value or "").split(",") if name.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Ограничивает набор полей сериализатора параметрами запроса ?fields=a,b и ?exclude=c.
+
+    Невыбранные поля удаляются из сериализатора до сериализации, поэтому их методы
+    (и запросы к базе данных в них) не выполняются. optimize_queryset подстраивает
+    only() и select_related под выбранные поля.
+    """
+
+    # Поля модели, которые читает поле сериализатора (по умолчанию - одноимённое поле модели)
+    sparse_only = {}
+    # Связи, которые поле сериализатора читает через select_related
+    sparse_select_related = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None:
+            return
+        fieldset = self.get_fieldset(request.query_params)
+        for name in list(self.fields):
+            if name not in fieldset:
+                self.fields.pop(name)
+
+    @classmethod
+    def get_fieldset(cls, query_params) -> tuple:
+        """Имена выбранных полей в порядке Meta.fields"""
+        fields = split_fields(query_params.get("fields"))
+        exclude = split_fields(query_params.get("exclude"))
+        unknown = set(fields + exclude) - set(cls.Meta.fields)
+        if unknown:
+            raise serializers.ValidationError(
+                {"fields": f"Неизвестные поля: {', '.join(sorted(unknown))}"}
+            )
+        return tuple(
+            name
+            for name in cls.Meta.fields
+            if (not fields or name in fields) and name not in exclude
+        )
+
+    @classmethod
+    def is_sparse(cls, fieldset) -> bool:
+        """Выбраны ли не все поля сериализатора"""
+        return len(fieldset) != len(cls.Meta.fields)
+
+    @classmethod
+    def get_select_related(cls, fieldset) -> list:
+        """Связи, которые нужно загрузить через select_related для выбранных полей"""
+        return sorted(
+            {
+                cls.sparse_select_related[name]
+                for name in fieldset
+                if name in cls.sparse_select_related
+            }
+        )
+
+    @classmethod
+    def optimize_queryset(cls, queryset, fieldset):
+        """Загружает только поля модели и связи, нужные выбранным полям сериализатора"""
+        only = {"pk"}
+        for name in fieldset:
+            only.update(cls.sparse_only.get(name, (name,)))
+        select_related = cls.get_select_related(fieldset)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        return queryset.only(*sorted(only))
+
+
 class UserPhoneSerializer(serializers.ModelSerializer):
     """Сериализатор для номера телефона пользователя"""
 
@@ -22,36 +102,98 @@ class UserPhoneSerializer(serializers.ModelSerializer):
         fields = ["phone"]
 
 
-class UserRetrieveSerializer(serializers.ModelSerializer):
+class UserRetrieveSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор для получения данных пользователя"""
 
+    sparse_only = {
+        "invited_by_phone": ("invited_by",),
+        "invite_code_referer": ("invited_by",),
+        "referrals": (),
+        "avatar_thumbnails": ("avatar",),
+    }
+    # Поля, которые запрос профиля (users.profiles.annotate_profile) загружает вместе с пользователем
+    referrer_fields = ("invited_by_phone", "invite_code_referer")
+    profile_fields = (*referrer_fields, "referrals")
+
     referrals = serializers.SerializerMethodField()
     invited_by_phone = serializers.SerializerMethodField()
     invite_code_referer = serializers.SerializerMethodField()
+    avatar_thumbnails = serializers.SerializerMethodField()
+
+    def get_referrer_value(self, obj, field):
+        """
+        Поле реферера из аннотации запроса профиля (referrer_phone, referrer_invite_code),
+        а если пользователь загружен без неё - из реферера, загруженного get_referrer.
+        """
+        if hasattr(obj, f"referrer_{field}"):
+            return getattr(obj, f"referrer_{field}")
+        referrer = get_referrer(obj)
+        if referrer:
+            return getattr(referrer, field)
+        return None
 
     def get_referrals(self, obj):
         """Метод получает объект пользователя (obj) и возвращает список номеров телефонов пользователей,
         которые являются его рефералами."""
-        return obj.referrals.values_list("phone", flat=True)
+        if hasattr(obj, "referral_phones"):
+            return obj.referral_phones or []
+        return get_referral_phones(obj)
 
     def get_invited_by_phone(self, obj):
         """Этот метод проверяет, есть ли у пользователя invited_by (т.е. реферер).
         Если реферер есть, он возвращает его номер телефона. Если реферера нет, возвращается "У Вас нет реферера".
         """
-        referrer = obj.invited_by
-        if referrer:
-            return f"+{referrer.phone}"  # Возвращаем номер телефона реферера
+        phone = self.get_referrer_value(obj, "phone")
+        if phone:
+            return f"+{phone}"  # Возвращаем номер телефона реферера
         return "У Вас нет реферера"
 
     def get_invite_code_referer(self, obj):
         """Этот метод проверяет, есть ли у пользователя invited_by (т.е. реферер).
         Если реферер есть, он возвращает его invite_code. Если реферера нет, возвращается "У Вас нет кода от реферера".
         """
-        referrer = obj.invited_by
-        if referrer:
-            return referrer.invite_code  # Возвращаем код реферера
+        invite_code = self.get_referrer_value(obj, "invite_code")
+        if invite_code:
+            return invite_code  # Возвращаем код реферера
         return "У Вас нет кода от реферера"
 
+    def get_avatar_thumbnails(self, obj):
+        """Возвращает URL миниатюр аватара по размерам или пустой словарь, если аватара нет"""
+        return get_thumbnail_urls(obj.avatar.name)
+
+    @classmethod
+    def uses_profile_query(cls, fieldset) -> bool:
+        """
+        Загружать ли пользователя запросом профиля. При шардировании реферер и рефералы
+        могут находиться в других базах, их загружают функции users.sharding.
+        """
+        return not is_sharded() and any(name in cls.profile_fields for name in fieldset)
+
+    @classmethod
+    def annotate_profile(cls, queryset, fieldset):
+        """Аннотации запроса профиля, нужные выбранным полям"""
+        return annotate_profile(
+            queryset,
+            referrer=any(name in cls.referrer_fields for name in fieldset),
+            referrals="referrals" in fieldset,
+        )
+
+    @classmethod
+    def has_profile(cls, user, fieldset) -> bool:
+        """Загружен ли пользователь запросом профиля с аннотациями для выбранных полей"""
+        if any(name in cls.referrer_fields for name in fieldset) and not hasattr(
+            user, "referrer_phone"
+        ):
+            return False
+        return "referrals" not in fieldset or hasattr(user, "referral_phones")
+
+    @classmethod
+    def optimize_queryset(cls, queryset, fieldset):
+        queryset = super().optimize_queryset(queryset, fieldset)
+        if is_sharded():
+            return queryset
+        return cls.annotate_profile(queryset, fieldset)
+
     class Meta:
         model = User
         fields = [
@@ -60,9 +202,80 @@ class UserRetrieveSerializer(serializers.ModelSerializer):
             "invited_by_phone",
             "invite_code_referer",
             "referrals",
+            "avatar",
+            "avatar_thumbnails",
         ]
 
 
+class AvatarUploadSerializer(serializers.Serializer):
+    """Сериализатор для загрузки аватара пользователя"""
+
+    avatar = serializers.FileField()
+
+    def validate_avatar(self, value):
+        """Проверяет размер файла, формат и количество пикселей по заголовку изображения,
+        не декодируя его целиком"""
+        if value.size > settings.AVATAR_MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                f"Размер файла не должен превышать {settings.AVATAR_MAX_UPLOAD_SIZE} байт."
+            )
+        try:
+            with Image.open(value) as image:
+                width, height = image.size
+                image_format = image.format
+        except (OSError, Image.DecompressionBombError):
+            raise serializers.ValidationError("Файл не является изображением.")
+        if image_format not in settings.AVATAR_ALLOWED_FORMATS:
+            raise serializers.ValidationError(
+                f"Допустимые форматы: {', '.join(settings.AVATAR_ALLOWED_FORMATS)}."
+            )
+        if width * height > settings.AVATAR_MAX_PIXELS:
+            raise serializers.ValidationError(
+                f"Изображение не должно содержать больше {settings.AVATAR_MAX_PIXELS} пикселей."
+            )
+        value.seek(0)
+        return value
+
+
+class DailyStatsSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Сериализатор дневной статистики с конверсией из запроса кода во вход"""
+
+    sparse_only = {"conversion": ("logins", "registrations")}
+
+    conversion = serializers.SerializerMethodField()
+
+    def get_conversion(self, obj):
+        """Доля первых входов от регистраций за день"""
+        if not obj.registrations:
+            return None
+        return round(obj.logins / obj.registrations, 4)
+
+    class Meta:
+        model = DailyStats
+        fields = ["day", "registrations", "logins", "conversion", "referrals"]
+
+
+class BatchLookupSerializer(serializers.Serializer):
+    """Сериализатор пакетной проверки инвайт-кодов и номеров телефонов"""
+
+    invite_codes = serializers.ListField(
+        child=serializers.CharField(max_length=6), required=False
+    )
+    phones = serializers.ListField(
+        child=serializers.CharField(max_length=11), required=False
+    )
+
+    def validate(self, attrs):
+        total = len(attrs.get("invite_codes", [])) + len(attrs.get("phones", []))
+        if not total:
+            raise serializers.ValidationError("Передайте invite_codes или phones.")
+        if total > settings.BATCH_LOOKUP_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f"За один запрос можно проверить не больше {settings.BATCH_LOOKUP_MAX_ITEMS} значений."
+            )
+        return attrs
+
+
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
 
     @classmethod
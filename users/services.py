@@ -1,12 +1,22 @@
+import math
 import string
-from pprint import pprint
+from datetime import timedelta
 from random import choice
-from time import sleep
+from time import sleep, time
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.throttling import BaseThrottle
 from smsaero import SmsAero, SmsAeroException
 
 from config.settings import SMSAERO_API_KEY, SMSAERO_EMAIL
+from users.bloom import invite_codes
+from users.models import OutboxEvent, PendingRegistration
+from users.outbox import publish_event
+from users.sharding import invite_code_exists
 
 User = get_user_model()
 
@@ -27,14 +37,17 @@ def send_sms(phone: int, message: str) -> dict:
 
 
 def create_invite_code():
-    """Создание инвайт-кода для реферальной системы, который состоит из 6 случайных цифр/букв"""
-    existing_codes = User.objects.values_list("invite_code", flat=True)
+    """Создание инвайт-кода для реферальной системы, который состоит из 6 случайных цифр/букв.
+    Если кода нет в фильтре Блума, база данных не проверяется: код, который другой процесс
+    выдал после подгрузки фильтра, отклонит уникальный индекс, и users.sharding.get_or_create_user
+    повторит регистрацию с новым кодом. В фильтр код попадает после сохранения пользователя.
+    """
     alphabet = string.ascii_letters + string.digits
     while True:
         code = ""
         for _ in range(6):
             code += choice(alphabet)
-        if code not in existing_codes:
+        if not invite_codes.might_exist(code) or not invite_code_exists(code):
             break
     return code
 
@@ -47,6 +60,155 @@ def create_enter_code():
     return code
 
 
+def get_enter_code_cache_key(phone: str) -> str:
+    """Ключ кэша, под которым хранится выданный, но ещё не использованный код входа"""
+    return f"enter_code:{phone}"
+
+
+def acquire_enter_code(phone: str) -> tuple:
+    """
+    Объединяет повторные запросы кода на один и тот же номер телефона.
+
+    Первый запрос атомарно занимает запись в кэше (cache.add) и становится
+    "ведущим": он создаёт код, незавершённую регистрацию и отправляет смс. Запросы,
+    пришедшие в течение ENTER_CODE_COALESCE_TIMEOUT, получают только ответ "код уже
+    отправлен" (см. get_enter_code_retry_after): код ведущего им не выдаётся и повторно не сохраняется, поэтому его
+    нельзя получить в другой сессии. Запись снимается при каждой попытке входа.
+
+    Returns:
+    tuple: (код входа или None, True если запрос ведущий и код нужно отправить)
+    """
+    timeout = settings.ENTER_CODE_COALESCE_TIMEOUT
+    # В записи хранится время её истечения, чтобы сообщить остальным запросам, сколько ждать
+    if cache.add(get_enter_code_cache_key(phone), time() + timeout, timeout=timeout):
+        return create_enter_code(), True
+    return None, False
+
+
+def get_enter_code_retry_after(phone: str) -> int:
+    """Через сколько секунд для номера телефона можно будет запросить новый код"""
+    expires_at = cache.get(get_enter_code_cache_key(phone))
+    if expires_at is None:
+        return 0
+    return max(math.ceil(expires_at - time()), 0)
+
+
+def get_client_ident(request) -> str:
+    """
+    Адрес клиента с учётом NUM_PROXIES из настроек DRF, тот же, по которому
+    ограничивается частота запросов (throttling)
+    """
+    return BaseThrottle().get_ident(request)
+
+
+def get_enter_code_attempts_cache_key(phone: str, client: str) -> str:
+    """Ключ кэша со счётчиком попыток ввода кода для номера телефона с адреса клиента"""
+    return f"enter_code:attempts:{phone}:{client}"
+
+
+def register_enter_code_attempt(phone: str, client: str) -> bool:
+    """
+    Учитывает попытку ввода кода для номера телефона с адреса клиента. Возвращает False,
+    если за ENTER_CODE_ATTEMPTS_WINDOW секунд попыток было больше ENTER_CODE_MAX_ATTEMPTS:
+    тогда код не проверяется, даже если он верный. Счётчик ведётся отдельно для каждого
+    адреса, иначе чужие неверные попытки заблокировали бы вход владельцу номера.
+    """
+    key = get_enter_code_attempts_cache_key(phone, client)
+    cache.add(key, 0, timeout=settings.ENTER_CODE_ATTEMPTS_WINDOW)
+    try:
+        attempts = cache.incr(key)
+    except ValueError:
+        # Счётчик истёк между add и incr
+        cache.add(key, 1, timeout=settings.ENTER_CODE_ATTEMPTS_WINDOW)
+        attempts = 1
+    return attempts <= settings.ENTER_CODE_MAX_ATTEMPTS
+
+
+def reset_enter_code_attempts(phone: str, client: str) -> None:
+    """Сбрасывает счётчик попыток после успешного входа"""
+    cache.delete(get_enter_code_attempts_cache_key(phone, client))
+
+
+def get_issued_enter_code_cache_key(phone: str) -> str:
+    """Ключ кэша с кодом входа для клиентов JSON API, у которых нет сессии"""
+    return f"enter_code:issued:{phone}"
+
+
+def save_enter_code(request, phone: str, code: str) -> None:
+    """
+    Запоминает код входа для проверки при авторизации: в сессии браузера,
+    а для запросов без сессии (JSON API /api/v2/) - в кэше на ENTER_CODE_TIMEOUT секунд.
+    """
+    if hasattr(request, "session"):
+        request.session[phone] = code
+    else:
+        cache.set(
+            get_issued_enter_code_cache_key(phone),
+            code,
+            timeout=settings.ENTER_CODE_TIMEOUT,
+        )
+
+
+def pop_enter_code(request, phone: str) -> str:
+    """
+    Извлекает код входа, сохранённый save_enter_code. Код проверяется только один раз:
+    из кэша его получает только тот из одновременных запросов, чей cache.delete
+    действительно удалил запись, остальные получают пустую строку.
+    """
+    if hasattr(request, "session"):
+        return request.session.pop(phone, "")
+    key = get_issued_enter_code_cache_key(phone)
+    code = cache.get(key)
+    if code is None or not cache.delete(key):
+        return ""
+    return code
+
+
+def stage_registration(phone: str) -> None:
+    """
+    Запоминает номер телефона нового пользователя на PENDING_REGISTRATION_TTL секунд.
+    Повторный запрос кода продлевает срок одним запросом (INSERT ... ON CONFLICT DO UPDATE).
+    Для номера без незавершённой регистрации в outbox пишется событие registration_started:
+    по нему считаются регистрации в дневной статистике.
+    """
+    with transaction.atomic():
+        started = not PendingRegistration.objects.filter(phone=phone).exists()
+        PendingRegistration.objects.bulk_create(
+            [
+                PendingRegistration(
+                    phone=phone,
+                    expires_at=timezone.now()
+                    + timedelta(seconds=settings.PENDING_REGISTRATION_TTL),
+                )
+            ],
+            update_conflicts=True,
+            unique_fields=["phone"],
+            update_fields=["expires_at"],
+        )
+        if started:
+            publish_event(OutboxEvent.REGISTRATION_STARTED, {"phone": phone})
+
+
+def complete_registration(phone: str) -> bool:
+    """
+    Завершает регистрацию нового номера: удаляет запись о ней одним запросом DELETE.
+    Возвращает False, если код для нового номера не запрашивался или срок регистрации истёк
+    (просроченные записи удаляет команда purge_pending_registrations).
+    """
+    deleted, _ = PendingRegistration.objects.filter(
+        phone=phone, expires_at__gt=timezone.now()
+    ).delete()
+    return bool(deleted)
+
+
+def release_enter_code(phone: str) -> None:
+    """
+    Освобождает запись кэша ведущего запроса: при его ошибке и при каждой попытке входа,
+    чтобы следующий запрос кода выдал новый код
+    """
+    cache.delete(get_enter_code_cache_key(phone))
+
+
 def send_enter_code(phone: object, code: object) -> object:
     print(f"Номер телефона: {phone}  код для авторизации: {code}")
     # Преобразуем наш номер из строки в int
@@ -0,0 +1,318 @@
+"""
+Шардирование пользователей по номеру телефона.
+
+Пользователи распределяются по базам данных из USER_SHARDS по стабильному хэшу
+номера телефона. В базе default хранится глобальный справочник UserDirectory:
+он выдаёт глобально уникальные id пользователей, знает шард каждого пользователя,
+его номер телефона, инвайт-код и реферера. Через справочник решаются запросы,
+которые затрагивают несколько шардов: поиск по инвайт-коду и список рефералов.
+
+Если USER_SHARDS пуст, все функции модуля работают с базой default напрямую.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connections, transaction
+from django.db.models.signals import post_save
+from django.db.models.utils import resolve_callables
+
+from users.models import UserDirectory, bump_profile_version
+
+User = get_user_model()
+
+# Сколько раз регистрация повторяется при совпадении сгенерированного инвайт-кода
+REGISTRATION_ATTEMPTS = 5
+
+
+def is_sharded() -> bool:
+    """Включено ли шардирование пользователей"""
+    return bool(settings.USER_SHARDS)
+
+
+def get_shard_for_phone(phone: str) -> str:
+    """
+    Шард, в котором должен находиться пользователь с этим номером телефона.
+    Используется crc32, а не hash(): он не зависит от процесса и PYTHONHASHSEED.
+    """
+    shards = settings.USER_SHARDS
+    return shards[zlib.crc32(phone.encode()) % len(shards)]
+
+
+def _get_from_directory(**lookup):
+    """Находит пользователя в его шарде по записи справочника"""
+    try:
+        entry = UserDirectory.objects.get(**lookup)
+    except UserDirectory.DoesNotExist:
+        raise User.DoesNotExist
+    return User.objects.using(entry.shard).get(pk=entry.pk)
+
+
+def get_user_by_id(user_id: int):
+    """Возвращает пользователя по id или выбрасывает User.DoesNotExist"""
+    if not is_sharded():
+        return User.objects.get(pk=user_id)
+    return _get_from_directory(pk=user_id)
+
+
+def get_user_by_phone(phone: str):
+    """Возвращает пользователя по номеру телефона или выбрасывает User.DoesNotExist"""
+    if not is_sharded():
+        return User.objects.get(phone=phone)
+    return _get_from_directory(phone=phone)
+
+
+def get_user_by_invite_code(invite_code: str):
+    """Возвращает пользователя по инвайт-коду или выбрасывает User.DoesNotExist"""
+    if not is_sharded():
+        return User.objects.get(invite_code=invite_code)
+    return _get_from_directory(invite_code=invite_code)
+
+
+def invite_code_exists(invite_code: str) -> bool:
+    """Занят ли инвайт-код каким-либо пользователем во всех шардах"""
+    if not is_sharded():
+        return User.objects.filter(invite_code=invite_code).exists()
+    return UserDirectory.objects.filter(invite_code=invite_code).exists()
+
+
+def get_phones_by_id(user_ids) -> dict:
+    """
+    Номера телефонов пользователей по их id из всех шардов одним запросом.
+    Удалённых пользователей в результате нет.
+
+    Returns:
+    dict: {id пользователя: номер телефона}
+    """
+    model = UserDirectory if is_sharded() else User
+    return dict(model.objects.filter(pk__in=user_ids).values_list("pk", "phone"))
+
+
+def lookup_users(field: str, values: list) -> dict:
+    """
+    Находит пользователей по списку номеров телефонов или инвайт-кодов одним запросом.
+    При шардировании запрос выполняется к справочнику, а не к каждому шарду.
+
+    Parameters:
+    field (str): "phone" или "invite_code".
+    values (list): Искомые значения.
+
+    Returns:
+    dict: {значение: (id пользователя, id реферера или None)} для найденных значений
+    """
+    model = UserDirectory if is_sharded() else User
+    rows = model.objects.filter(**{f"{field}__any": values}).values_list(
+        field, "pk", "invited_by_id"
+    )
+    return {value: (pk, invited_by_id) for value, pk, invited_by_id in rows}
+
+
+def _insert_or_get_user(phone: str, defaults: dict):
+    """
+    Находит пользователя или вставляет его одним запросом (Postgres):
+
+        WITH inserted AS (INSERT ... ON CONFLICT (phone) DO NOTHING RETURNING *)
+        SELECT *, TRUE FROM inserted UNION ALL SELECT *, FALSE FROM users_user WHERE phone = ...
+
+    Значения defaults вычисляются до запроса. Если номер уже зарегистрирован, возвращается
+    существующий пользователь со своим инвайт-кодом, а сгенерированный код не используется.
+    Совпадение инвайт-кода с кодом другого пользователя не подавляется ON CONFLICT и вызывает
+    IntegrityError: get_or_create_user повторяет запрос с новым кодом. Вторая часть запроса
+    видит снимок данных до вставки, поэтому строк нет, только если пользователя с этим
+    номером одновременно создал другой запрос - тогда возвращается None и запрос повторяется.
+    Для вставленного пользователя отправляется post_save, как при User.objects.create:
+    по нему инвайт-код попадает в фильтр Блума.
+
+    Returns:
+    tuple: (пользователь, True если пользователь создан) или None
+    """
+    connection = connections[User.objects.db]
+    quote_name = connection.ops.quote_name
+    table = quote_name(User._meta.db_table)
+    fields = [field for field in User._meta.concrete_fields if not field.primary_key]
+    user = User(phone=phone, **dict(resolve_callables(defaults)))
+    values = [
+        field.get_db_prep_save(field.pre_save(user, True), connection)
+        for field in fields
+    ]
+    sql = f"""
+        WITH inserted AS (
+            INSERT INTO {table} ({", ".join(quote_name(field.column) for field in fields)})
+            VALUES ({", ".join(["%s"] * len(fields))})
+            ON CONFLICT ({quote_name("phone")}) DO NOTHING
+            RETURNING *
+        )
+        SELECT *, TRUE AS created FROM inserted
+        UNION ALL
+        SELECT *, FALSE AS created FROM {table} WHERE {quote_name("phone")} = %s
+    """
+    for row in User.objects.raw(sql, [*values, phone]):
+        created = row.__dict__.pop("created")
+        if created:
+            post_save.send(
+                sender=User,
+                instance=row,
+                created=True,
+                update_fields=None,
+                raw=False,
+                using=row._state.db,
+            )
+        return row, created
+    return None
+
+
+def get_or_create_user(phone: str, defaults: dict) -> tuple:
+    """
+    Аналог User.objects.get_or_create(phone=phone, defaults=defaults).
+    Значения defaults могут быть функциями (например, create_invite_code). Без шардирования
+    в Postgres они вызываются перед запросом, иначе - только при создании пользователя.
+    При совпадении инвайт-кода создание повторяется с новым кодом до REGISTRATION_ATTEMPTS раз.
+
+    Без шардирования в Postgres пользователь находится или создаётся одним запросом
+    INSERT ... ON CONFLICT (см. _insert_or_get_user).
+
+    При шардировании сначала создаётся запись справочника: её id становится
+    глобальным id пользователя, затем пользователь создаётся в своём шарде.
+
+    Returns:
+    tuple: (пользователь, True если пользователь создан)
+    """
+    for attempt in range(REGISTRATION_ATTEMPTS):
+        last_attempt = attempt == REGISTRATION_ATTEMPTS - 1
+        if not is_sharded():
+            if connections[User.objects.db].vendor == "postgresql":
+                try:
+                    with transaction.atomic():
+                        result = _insert_or_get_user(phone, defaults)
+                except IntegrityError:
+                    # Совпал инвайт-код: конфликт по номеру запрос обрабатывает сам
+                    if last_attempt:
+                        raise
+                    continue
+                if result is not None:
+                    return result
+                continue
+            try:
+                return User.objects.get_or_create(phone=phone, defaults=defaults)
+            except IntegrityError:
+                # Пользователя с этим номером нет, значит совпал инвайт-код
+                if last_attempt:
+                    raise
+                continue
+
+        try:
+            return get_user_by_phone(phone), False
+        except User.DoesNotExist:
+            pass
+
+        values = dict(resolve_callables(defaults))
+        shard = get_shard_for_phone(phone)
+        try:
+            with transaction.atomic():
+                entry = UserDirectory.objects.create(
+                    phone=phone, invite_code=values["invite_code"], shard=shard
+                )
+        except IntegrityError:
+            # Пользователя с этим номером одновременно создал другой запрос
+            # или совпал инвайт-код - проверяем номер ещё раз
+            if last_attempt:
+                raise
+            continue
+
+        try:
+            user = User.objects.using(shard).create(pk=entry.pk, phone=phone, **values)
+        except Exception:
+            entry.delete()
+            raise
+        return user, True
+
+    raise IntegrityError(f"Не удалось зарегистрировать пользователя {phone}")
+
+
+def get_referrer(user):
+    """Возвращает реферера пользователя (возможно, из другого шарда) или None"""
+    if user.invited_by_id is None:
+        return None
+    if not is_sharded():
+        return user.invited_by
+    # Загруженный реферер запоминается в кэше поля invited_by, как при обычном обращении
+    field = User._meta.get_field("invited_by")
+    if field.is_cached(user):
+        return field.get_cached_value(user)
+    try:
+        referrer = get_user_by_id(user.invited_by_id)
+    except User.DoesNotExist:
+        return None
+    field.set_cached_value(user, referrer)
+    return referrer
+
+
+def get_referral_phones(user) -> list:
+    """Номера телефонов рефералов пользователя из всех шардов"""
+    if not is_sharded():
+        return list(user.referrals.values_list("phone", flat=True))
+    return list(
+        UserDirectory.objects.filter(invited_by_id=user.pk)
+        .order_by("pk")
+        .values_list("phone", flat=True)
+    )
+
+
+def set_referrer(referral, referrer) -> None:
+    """
+    Назначает пользователю реферера. При шардировании реферер может находиться
+    в другом шарде, поэтому связь хранится по глобальному id и дублируется в справочнике.
+    """
+    referral.invited_by = referrer
+    referral.save(update_fields=["invited_by"])
+    if not is_sharded():
+        return
+    UserDirectory.objects.filter(pk=referral.pk).update(invited_by_id=referrer.pk)
+    if referrer._state.db != referral._state.db:
+        # Версию профиля реферера из другого шарда User.save() увеличить не может
+        bump_profile_version(
+            User.objects.using(referrer._state.db).filter(pk=referrer.pk)
+        )
+
+
+def move_user(user, target_shard: str) -> None:
+    """
+    Переносит пользователя в другой шард с сохранением id и обновляет справочник.
+    Связь с реферером хранится по глобальному id, поэтому рефералы и реферер не меняются.
+    Группы и права пользователя не переносятся: в сервисе они не используются.
+
+    Перенос затрагивает несколько баз и не может быть атомарным, поэтому шаги идут в порядке,
+    при котором его можно повторить после сбоя на любом шаге: строка в целевом шарде
+    записывается через upsert, затем переключается справочник, и только после этого строка
+    удаляется из исходного шарда. До переключения справочника актуальны данные исходного
+    шарда, после - целевого, поэтому при повторе они уже не перезаписываются.
+    """
+    source_shard = user._state.db
+    directory_shard = (
+        UserDirectory.objects.filter(pk=user.pk).values_list("shard", flat=True).first()
+    )
+    if directory_shard != target_shard:
+        values = {
+            field.attname: getattr(user, field.attname)
+            for field in User._meta.concrete_fields
+        }
+        with transaction.atomic(using=target_shard):
+            User.objects.using(target_shard).bulk_create(
+                [User(**values)],
+                update_conflicts=True,
+                unique_fields=[User._meta.pk.name],
+                update_fields=[
+                    field.name
+                    for field in User._meta.concrete_fields
+                    if not field.primary_key
+                ],
+            )
+        UserDirectory.objects.filter(pk=user.pk).update(shard=target_shard)
+    with transaction.atomic(using=source_shard):
+        User.groups.through.objects.using(source_shard).filter(user_id=user.pk).delete()
+        User.user_permissions.through.objects.using(source_shard).filter(
+            user_id=user.pk
+        ).delete()
+        # Удаление без Collector: иначе Django обнулил бы invited_by у рефералов в этом шарде
+        User.objects.using(source_shard).filter(pk=user.pk)._raw_delete(source_shard)
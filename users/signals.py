@@ -0,0 +1,48 @@
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.bloom import invite_codes
+from users.models import User, UserDirectory, bump_profile_version
+from users.sharding import is_sharded
+
+
+@receiver(pre_delete, sender=User)
+def bump_related_profile_versions(sender, instance, using, **kwargs):
+    """
+    При удалении пользователя меняются профили его реферера (список рефералов)
+    и его рефералов (у них обнуляется реферер), поэтому их версии увеличиваются.
+    """
+    related = Q(invited_by=instance)
+    if instance.invited_by_id:
+        related |= Q(pk=instance.invited_by_id)
+    bump_profile_version(User.objects.using(using).filter(related))
+
+
+@receiver(post_save, sender=User)
+def add_invite_code_to_filter(sender, instance, created, **kwargs):
+    """Добавляет инвайт-код нового пользователя в фильтр Блума этого процесса"""
+    if created:
+        invite_codes.add(instance.invite_code)
+
+
+@receiver(post_save, sender=User)
+def sync_user_directory(sender, instance, created, update_fields, **kwargs):
+    """
+    При шардировании переносит изменённые номер телефона и инвайт-код пользователя
+    в справочник: по нему ищут пользователей и строят фильтр Блума.
+    Запись нового пользователя создаёт users.sharding.get_or_create_user.
+    """
+    if created or not is_sharded():
+        return
+    if update_fields is not None and not {"phone", "invite_code"} & set(update_fields):
+        return
+    # update() не заполняет auto_now, а по updated_at фильтр Блума подгружает изменения
+    UserDirectory.objects.filter(pk=instance.pk).exclude(
+        phone=instance.phone, invite_code=instance.invite_code
+    ).update(
+        phone=instance.phone,
+        invite_code=instance.invite_code,
+        updated_at=timezone.now(),
+    )
@@ -1,16 +1,120 @@
+import asyncio
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipIf, skipUnless
+
+import numpy as np
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.template import engines
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from PIL import Image
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework.throttling import ScopedRateThrottle
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.avatars import make_thumbnails
+from users.bloom import BloomFilter, invite_codes
+from users.idempotency import get_idempotency_cache_key, idempotent
+from users.live import (
+    DISCONNECTED_KEY,
+    NEW_REFERRAL,
+    REFERRER_SET,
+    DisconnectMiddleware,
+    EventStream,
+    hub,
+)
+from users.management.commands import seed_users
+from users.models import (
+    DailyStats,
+    OutboxEvent,
+    PendingRegistration,
+    ReferralTreeStats,
+    User,
+    UserDirectory,
+    phone_validator,
+)
+from users.outbox import LocMemSink, publish_event
+from users.pages import CSRF_PLACEHOLDER, render_page_parts
+from users.renderers import FastJSONParser, FastJSONRenderer
+from users.services import get_issued_enter_code_cache_key
+from users.sharding import (
+    get_or_create_user,
+    get_shard_for_phone,
+    get_user_by_phone,
+    is_sharded,
+    lookup_users,
+    set_referrer,
+)
+
+
+class UsersTestCase(APITestCase):
+    """
+    Базовый класс тестов. Тестам доступны все базы, а пользователи создаются
+    так же, как при регистрации: при шардировании - в своём шарде и в справочнике.
+    """
+
+    databases = "__all__"
+
+    def create_user(self, phone, invite_code="", invited_by=None, **fields):
+        if not is_sharded():
+            return User.objects.create(
+                phone=phone, invite_code=invite_code, invited_by=invited_by, **fields
+            )
+        user, _ = get_or_create_user(
+            phone, defaults={"invite_code": invite_code, **fields}
+        )
+        if invited_by is not None:
+            set_referrer(user, invited_by)
+        return user
+
+    def user_exists(self, phone) -> bool:
+        try:
+            get_user_by_phone(phone)
+        except User.DoesNotExist:
+            return False
+        return True
 
-from users.models import User
+    def user_rows(self):
+        """Строки пользователей, по которым ищут и строят фильтр Блума"""
+        return UserDirectory.objects if is_sharded() else User.objects
 
 
-class AuthTestCase(APITestCase):
+class AuthTestCase(UsersTestCase):
 
     def setUp(self):
-        self.user = User.objects.create(phone="70000000000")
+        cache.clear()
+        self.user = self.create_user(phone="70000000000")
         self.client.force_authenticate(user=self.user)
 
+    def register(self, phone):
+        """Запрашивает код для номера и входит с ним, создавая пользователя"""
+        with mock.patch("users.views.send_enter_code"):
+            self.client.post(reverse("users:get_code"), data={"phone": phone})
+        self.client.post(
+            reverse("users:send_code"),
+            data={"phone": phone, "password": self.client.session[phone]},
+        )
+        return get_user_by_phone(phone)
+
     def test_get_code(self):
         """
         Проверяет отправку кода для нового номера телефона и
@@ -26,14 +130,235 @@ class AuthTestCase(APITestCase):
         response = self.client.post(url, data={"phone": "70000000001"})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    @mock.patch("users.views.send_enter_code")
+    def test_get_code_coalesced(self, send_enter_code):
+        """
+        Проверяет, что повторные запросы кода на тот же номер в течение
+        ENTER_CODE_COALESCE_TIMEOUT не отправляют смс повторно и не выдают код ведущего
+        запроса в другую сессию.
+        """
+        url = reverse("users:get_code")
+        self.client.post(url, data={"phone": "70000000001"})
+        first_code = self.client.session["70000000001"]
+
+        response = self.client.post(url, data={"phone": "70000000001"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.session["70000000001"], first_code)
+
+        other_client = self.client_class()
+        with self.settings(ENTER_CODE_COALESCE_TIMEOUT=60):
+            response = other_client.post(url, data={"phone": "70000000001"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("70000000001", other_client.session)
+        self.assertRegex(
+            response.data["message"], r"^Код уже отправлен\. .* через (60|59) сек\.$"
+        )
+        send_enter_code.assert_called_once()
+
+    @mock.patch("users.views.send_enter_code")
+    def test_enter_code_attempts_limited(self, send_enter_code):
+        """
+        Проверяет, что после ENTER_CODE_MAX_ATTEMPTS неверных попыток вход по номеру
+        отклоняется даже с верным кодом, а каждая попытка позволяет запросить новый код.
+        """
+        get_code_url = reverse("users:get_code")
+        send_code_url = reverse("users:send_code")
+        with self.settings(ENTER_CODE_MAX_ATTEMPTS=2):
+            for _ in range(2):
+                self.client.post(get_code_url, data={"phone": "70000000001"})
+                self.client.post(
+                    send_code_url, data={"phone": "70000000001", "password": "wrong"}
+                )
+            self.assertEqual(send_enter_code.call_count, 2)
+
+            self.client.post(get_code_url, data={"phone": "70000000001"})
+            response = self.client.post(
+                send_code_url,
+                data={
+                    "phone": "70000000001",
+                    "password": self.client.session["70000000001"],
+                },
+            )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(self.user_exists("70000000001"))
+
+    @mock.patch("users.views.send_enter_code")
+    def test_enter_code_attempts_limited_per_client(self, send_enter_code):
+        """
+        Проверяет, что неверные попытки с чужого адреса не блокируют вход владельцу номера.
+        """
+        get_code_url = reverse("users:get_code")
+        send_code_url = reverse("users:send_code")
+        attacker = self.client_class(REMOTE_ADDR="10.0.0.2")
+        with self.settings(ENTER_CODE_MAX_ATTEMPTS=2):
+            for _ in range(3):
+                attacker.post(
+                    send_code_url, data={"phone": "70000000001", "password": "wrong"}
+                )
+
+            self.client.post(get_code_url, data={"phone": "70000000001"})
+            response = self.client.post(
+                send_code_url,
+                data={
+                    "phone": "70000000001",
+                    "password": self.client.session["70000000001"],
+                },
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(self.user_exists("70000000001"))
+
+    @mock.patch("users.views.send_enter_code")
+    def test_get_code_existing_user_keeps_invite_code(self, send_enter_code):
+        """
+        Проверяет, что для уже зарегистрированного номера инвайт-код не генерируется
+        и регистрация не начинается заново.
+        """
+        with mock.patch("users.auth_backends.create_invite_code") as create_invite_code:
+            response = self.client.post(
+                reverse("users:get_code"), data={"phone": "70000000000"}
+            )
+            self.client.post(
+                reverse("users:send_code"),
+                data={
+                    "phone": "70000000000",
+                    "password": self.client.session["70000000000"],
+                },
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        create_invite_code.assert_not_called()
+        self.assertFalse(PendingRegistration.objects.exists())
+        self.assertFalse(
+            OutboxEvent.objects.filter(
+                event_type=OutboxEvent.REGISTRATION_STARTED
+            ).exists()
+        )
+
+    @mock.patch("users.views.send_enter_code")
+    def test_get_code_stages_registration(self, send_enter_code):
+        """
+        Проверяет, что запрос кода для нового номера не создаёт пользователя,
+        а пользователь создаётся только после входа с верным кодом.
+        """
+        url = reverse("users:send_code")
+        response = self.client.post(
+            reverse("users:get_code"), data={"phone": "70000000001"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(self.user_exists("70000000001"))
+        self.assertTrue(
+            PendingRegistration.objects.filter(phone="70000000001").exists()
+        )
+        enter_code = self.client.session["70000000001"]
+
+        # Неверный код не создаёт пользователя
+        self.client.post(url, data={"phone": "70000000001", "password": "wrong"})
+        self.assertFalse(self.user_exists("70000000001"))
+
+        # Неверная попытка делает код недействительным: верным кодом уже не войти
+        self.assertNotIn("70000000001", self.client.session)
+        response = self.client.post(
+            url, data={"phone": "70000000001", "password": enter_code}
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(self.user_exists("70000000001"))
+
+        # Войти можно только с новым кодом
+        self.client.post(reverse("users:get_code"), data={"phone": "70000000001"})
+        self.client.post(
+            url,
+            data={
+                "phone": "70000000001",
+                "password": self.client.session["70000000001"],
+            },
+        )
+        self.assertTrue(self.user_exists("70000000001"))
+        self.assertFalse(PendingRegistration.objects.exists())
+
+    @mock.patch("users.views.send_enter_code")
+    def test_purge_pending_registrations(self, send_enter_code):
+        """
+        Проверяет, что команда удаляет только просроченные незавершённые регистрации
+        и вход по просроченной регистрации невозможен.
+        """
+        self.client.post(reverse("users:get_code"), data={"phone": "70000000001"})
+        self.client.post(reverse("users:get_code"), data={"phone": "70000000002"})
+        PendingRegistration.objects.filter(phone="70000000001").update(
+            expires_at=datetime.now(timezone.utc) - timedelta(seconds=1)
+        )
+
+        response = self.client.post(
+            reverse("users:send_code"),
+            data={
+                "phone": "70000000001",
+                "password": self.client.session["70000000001"],
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        out = StringIO()
+        call_command("purge_pending_registrations", batch_size=1, stdout=out)
+        self.assertIn("Удалено незавершённых регистраций: 1", out.getvalue())
+        self.assertEqual(
+            list(PendingRegistration.objects.values_list("phone", flat=True)),
+            ["70000000002"],
+        )
+
+    def test_get_or_create_user_retries_invite_code_collision(self):
+        """
+        Проверяет, что при совпадении инвайт-кода регистрация повторяется с новым кодом.
+        """
+        self.create_user(phone="70000000002", invite_code="taken1")
+        codes = iter(["taken1", "free01"])
+
+        user, created = get_or_create_user(
+            "70000000003", defaults={"invite_code": lambda: next(codes)}
+        )
+
+        self.assertTrue(created)
+        self.assertEqual(user.invite_code, "free01")
+        self.assertEqual(
+            get_or_create_user("70000000003", defaults={"invite_code": "unused"}),
+            (user, False),
+        )
+
+    @skipUnless(
+        connection.vendor == "postgresql",
+        "INSERT ... ON CONFLICT есть только в Postgres",
+    )
+    def test_get_or_create_user_postgresql(self):
+        """
+        Проверяет, что в Postgres пользователь находится или создаётся одним запросом,
+        совпадение инвайт-кода повторяет вставку с новым кодом, а код нового пользователя
+        попадает в фильтр Блума после вставки.
+        """
+        with mock.patch("users.signals.invite_codes") as bloom:
+            with self.assertNumQueries(3):
+                # SAVEPOINT, INSERT ... ON CONFLICT и RELEASE SAVEPOINT
+                self.assertEqual(
+                    get_or_create_user(
+                        "70000000000", defaults={"invite_code": "new001"}
+                    ),
+                    (self.user, False),
+                )
+            bloom.add.assert_not_called()
+
+            codes = iter([self.user.invite_code, "new002"])
+            user, created = get_or_create_user(
+                "70000000001", defaults={"invite_code": lambda: next(codes)}
+            )
+        self.assertTrue(created)
+        self.assertEqual(user.invite_code, "new002")
+        bloom.add.assert_called_once_with("new002")
+
     def test_set_referrer(self):
         """
         Проверяет установку реферала по инвайт-коду.
         Сначала тестируется случай с невалидным кодом, затем с валидным.
         """
         url = reverse("users:set_referrer")
-        self.client.post(reverse("users:get_code"), data={"phone": "70000000001"})
-        invite_code = User.objects.get(phone="70000000001").invite_code
+        invite_code = self.register("70000000001").invite_code
+        self.client.force_authenticate(user=self.user)
 
         # Проверяем, что неверный код возвращает 404
         response = self.client.post(url, data={"invite_code": "hhhhhh"})
@@ -52,6 +377,110 @@ class AuthTestCase(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_retrieve_not_modified(self):
+        """
+        Проверяет, что профиль отдаётся с ETag, неизменившийся профиль возвращает 304,
+        а после появления нового реферала ETag меняется.
+        """
+        url = reverse("users:retrieve")
+        response = self.client.get(url, HTTP_ACCEPT="application/json")
+        etag = response["ETag"]
+
+        response = self.client.get(
+            url, HTTP_ACCEPT="application/json", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.create_user(
+            phone="70000000001", invite_code="abc123", invited_by=self.user
+        )
+        self.user.refresh_from_db()
+        response = self.client.get(
+            url, HTTP_ACCEPT="application/json", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data["referrals"]), ["70000000001"])
+
+    def test_retrieve_sparse_fieldsets(self):
+        """
+        Проверяет, что ?fields= и ?exclude= ограничивают поля профиля, невыбранные поля
+        не вызывают запросов к базе, реферер загружается одним запросом с профилем,
+        а ETag различает наборы полей.
+        """
+        referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.user.invited_by = referrer
+        self.user.save()
+        # Пользователь загружен заново, как при обычном запросе: реферер ещё не загружен
+        self.client.force_authenticate(user=get_user_by_phone("70000000000"))
+        url = reverse("users:retrieve")
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                url, {"fields": "phone,invite_code"}, HTTP_ACCEPT="application/json"
+            )
+        self.assertEqual(
+            response.data,
+            {"phone": "70000000000", "invite_code": self.user.invite_code},
+        )
+        sparse_etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                url, {"exclude": "referrals"}, HTTP_ACCEPT="application/json"
+            )
+        self.assertNotIn("referrals", response.data)
+        self.assertEqual(response.data["invited_by_phone"], "+70000000001")
+        self.assertEqual(response.data["invite_code_referer"], "abc123")
+
+        response = self.client.get(url, HTTP_ACCEPT="application/json")
+        self.assertIn("referrals", response.data)
+        self.assertNotEqual(response["ETag"], sparse_etag)
+
+        response = self.client.get(
+            url, {"fields": "phone,password"}, HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @skipIf(
+        is_sharded(),
+        "При шардировании реферер и рефералы загружаются из справочника отдельными запросами",
+    )
+    def test_retrieve_single_query(self):
+        """
+        Проверяет, что профиль с реферером и рефералами загружается одним запросом,
+        а у пользователя без реферера и рефералов выводятся значения по умолчанию.
+        """
+        url = reverse("users:retrieve")
+        response = self.client.get(url, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.data["invited_by_phone"], "У Вас нет реферера")
+        self.assertEqual(
+            response.data["invite_code_referer"], "У Вас нет кода от реферера"
+        )
+        self.assertEqual(response.data["referrals"], [])
+
+        referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.user.invited_by = referrer
+        self.user.save()
+        for number, invite_code in ((2, "def456"), (3, "ghi789")):
+            self.create_user(
+                phone=f"7000000000{number}",
+                invite_code=invite_code,
+                invited_by=self.user,
+            )
+        # Настоящий JWT, а не force_authenticate: загрузка пользователя тоже считается
+        self.client.force_authenticate(user=None)
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.data["invited_by_phone"], "+70000000001")
+        self.assertEqual(response.data["invite_code_referer"], "abc123")
+        self.assertEqual(
+            sorted(response.data["referrals"]), ["70000000002", "70000000003"]
+        )
+
     def test_auth_backend(self):
         """
         Проверяет отправку кода с неверными учетными данными.
@@ -78,8 +507,8 @@ class AuthTestCase(APITestCase):
         Ожидаем статус 400 Bad Request при повторной попытке.
         """
         url = reverse("users:set_referrer")
-        self.client.post(reverse("users:get_code"), data={"phone": "70000000001"})
-        invite_code = User.objects.get(phone="70000000001").invite_code
+        invite_code = self.register("70000000001").invite_code
+        self.client.force_authenticate(user=self.user)
 
         # Устанавливаем реферала
         self.client.post(url, data={"invite_code": invite_code})
@@ -123,3 +552,1182 @@ class AuthTestCase(APITestCase):
         response = self.client.post(url, data={"invite_code": "invalid_code"})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertIn("error", response.data)
+
+
+class OutboxTestCase(UsersTestCase):
+
+    def setUp(self):
+        LocMemSink.events.clear()
+        self.referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_authenticate(user=self.user)
+
+    def test_set_referrer_publishes_event(self):
+        """
+        Проверяет, что установка реферера записывает событие в outbox,
+        а команда drain_outbox доставляет его в sink и помечает обработанным.
+        """
+        self.client.post(reverse("users:set_referrer"), data={"invite_code": "abc123"})
+        # При шардировании событие хранится в шарде реферала
+        event = OutboxEvent.objects.using(self.user._state.db).get()
+        self.assertEqual(event.event_type, OutboxEvent.REFERRER_SET)
+        self.assertEqual(event.payload["referrer_id"], self.referrer.pk)
+
+        call_command("drain_outbox", sink="users.outbox.LocMemSink", stdout=StringIO())
+        self.assertEqual(
+            [(e["database"], e["id"]) for e in LocMemSink.events],
+            [(self.user._state.db, event.pk)],
+        )
+        event.refresh_from_db()
+        self.assertIsNotNone(event.processed_at)
+
+    def test_event_failure_rolls_back_referrer(self):
+        """
+        Проверяет, что реферер не сохраняется, если событие outbox записать не удалось,
+        в том числе когда пользователь находится в шарде, а не в базе default.
+        """
+        with mock.patch("users.views.publish_event", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(
+                    reverse("users:set_referrer"), data={"invite_code": "abc123"}
+                )
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.invited_by_id)
+
+
+class StatsTestCase(UsersTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = self.create_user(
+            phone="79900000000", invite_code="admin1", is_staff=True
+        )
+        self.referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+
+    @override_settings(ROLLUP_SAFETY_LAG=0)
+    def test_update_rollups_is_incremental(self):
+        """
+        Проверяет, что update_rollups считает регистрации по запросам кода для новых
+        номеров, первые входы и рефералов, а повторный запуск не учитывает уже
+        обработанные события.
+        """
+        with mock.patch("users.views.send_enter_code"):
+            for phone in ("70000000002", "70000000003", "70000000000"):
+                self.client.post(reverse("users:get_code"), data={"phone": phone})
+            # Повторный запрос кода продлевает ту же регистрацию
+            cache.clear()
+            self.client.post(reverse("users:get_code"), data={"phone": "70000000002"})
+        self.client.post(
+            reverse("users:send_code"),
+            data={
+                "phone": "70000000002",
+                "password": self.client.session["70000000002"],
+            },
+        )
+        self.client.force_authenticate(user=self.user)
+        self.client.post(reverse("users:set_referrer"), data={"invite_code": "abc123"})
+
+        call_command("update_rollups", stdout=StringIO())
+        call_command("update_rollups", stdout=StringIO())
+        stats = DailyStats.objects.get()
+        self.assertEqual(stats.registrations, 2)
+        self.assertEqual(stats.logins, 1)
+        self.assertEqual(stats.referrals, 1)
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(reverse("users:stats"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["days"][0]["registrations"], 2)
+        self.assertEqual(response.data["days"][0]["conversion"], 0.5)
+        self.assertEqual(response.data["top_referrers"][0]["phone"], "70000000001")
+
+        response = self.client.get(reverse("users:stats"), {"fields": "day,conversion"})
+        self.assertEqual(list(response.data["days"][0]), ["day", "conversion"])
+
+    def test_update_rollups_waits_for_recent_rows(self):
+        """
+        Проверяет, что update_rollups не сдвигает отметку за событие моложе
+        ROLLUP_SAFETY_LAG: события после него учитываются, когда оно станет старше.
+        """
+        for phone in ("70000000002", "70000000003", "70000000004"):
+            publish_event(OutboxEvent.REGISTRATION_STARTED, {"phone": phone})
+        first = OutboxEvent.objects.order_by("pk").first()
+        old = datetime.now(timezone.utc) - timedelta(
+            seconds=settings.ROLLUP_SAFETY_LAG + 1
+        )
+        OutboxEvent.objects.exclude(pk=first.pk).update(created_at=old)
+
+        call_command("update_rollups", stdout=StringIO())
+        self.assertFalse(DailyStats.objects.exists())
+
+        OutboxEvent.objects.filter(pk=first.pk).update(created_at=old)
+        call_command("update_rollups", stdout=StringIO())
+        self.assertEqual(DailyStats.objects.get().registrations, 3)
+
+    def test_stats_for_regular_user(self):
+        """
+        Проверяет, что статистика недоступна обычному пользователю.
+        """
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse("users:stats"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@skipIf(is_sharded(), "Админка показывает пользователей только из базы default")
+class UserAdminTestCase(UsersTestCase):
+
+    def setUp(self):
+        self.admin = self.create_user(
+            phone="79900000000", invite_code="admin1", is_staff=True, is_superuser=True
+        )
+        self.create_user(
+            phone="70000000001", invite_code="abc123", invited_by=self.admin
+        )
+        self.client.force_login(self.admin)
+
+    def test_changelist(self):
+        """
+        Проверяет, что список пользователей в админке открывается, выводит количество
+        рефералов и поддерживает поиск по префиксу номера телефона.
+        """
+        url = reverse("admin:users_user_changelist")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        admin_row = response.context["cl"].result_list.get(pk=self.admin.pk)
+        self.assertEqual(admin_row.referrals_count, 1)
+
+        response = self.client.get(url, {"q": "7000"})
+        self.assertEqual(response.context["cl"].result_count, 1)
+
+
+class AvatarUploadTestCase(UsersTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, AVATAR_THUMBNAIL_WORKERS=0
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_authenticate(user=self.user)
+        self.max_image_pixels = Image.MAX_IMAGE_PIXELS
+
+    def test_upload_avatar(self):
+        """
+        Проверяет загрузку аватара и создание миниатюр без изменения глобального
+        ограничения Pillow на размер изображения.
+        """
+        buffer = BytesIO()
+        Image.new("RGB", (600, 400), "red").save(buffer, format="JPEG")
+        avatar = SimpleUploadedFile("avatar.jpg", buffer.getvalue(), "image/jpeg")
+
+        response = self.client.put(
+            reverse("users:avatar"), data={"avatar": avatar}, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("256", response.data["avatar_thumbnails"])
+
+        self.user.refresh_from_db()
+        thumbnail_path = os.path.join(
+            self.media_root, "users", "thumbnails", "256", "avatar.jpg"
+        )
+        self.assertTrue(self.user.avatar.name.startswith("users/"))
+        with Image.open(thumbnail_path) as thumbnail:
+            self.assertEqual(thumbnail.size, (256, 171))
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, self.max_image_pixels)
+
+    def test_upload_not_image(self):
+        """
+        Проверяет, что файл, не являющийся изображением, отклоняется.
+        Ожидаем статус 400 Bad Request.
+        """
+        avatar = SimpleUploadedFile("avatar.jpg", b"not an image", "image/jpeg")
+        response = self.client.put(
+            reverse("users:avatar"), data={"avatar": avatar}, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_make_thumbnails_rejects_large_image(self):
+        """
+        Проверяет, что генерация миниатюр отклоняет изображение больше max_pixels.
+        """
+        source_path = os.path.join(self.media_root, "large.png")
+        Image.new("RGB", (100, 100)).save(source_path)
+        target_path = os.path.join(self.media_root, "thumbnails", "large.png")
+        with self.assertRaises(Image.DecompressionBombError):
+            make_thumbnails(source_path, [(64, target_path)], max_pixels=100)
+        self.assertFalse(os.path.exists(target_path))
+
+
+class FastJSONTestCase(UsersTestCase):
+
+    def test_render_matches_json_renderer(self):
+        """
+        Проверяет, что FastJSONRenderer выдаёт тот же JSON, что и стандартный JSONRenderer,
+        а FastJSONParser разбирает его обратно.
+        """
+        data = {
+            "phone": "70000000000",
+            "referrals": ["70000000001", "70000000002"],
+            "balance": Decimal("10.50"),
+            "created_at": datetime(2024, 10, 16, 12, 0, tzinfo=timezone.utc),
+            "message": "Вы стали рефералом\u2028",
+        }
+        body = FastJSONRenderer().render(data)
+        self.assertEqual(body, JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONParser().parse(BytesIO(body))["referrals"], data["referrals"]
+        )
+
+
+@skipUnless(
+    len(settings.USER_SHARDS) > 1,
+    "Для запуска нужны шарды: USER_SHARDS_SQLITE=2 python manage.py test users.tests.ShardingTestCase",
+)
+class ShardingTestCase(UsersTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Подбираем номера телефонов, которые попадают в разные шарды
+        phones = {}
+        for index in range(100):
+            phone = f"7{index:010d}"
+            phones.setdefault(get_shard_for_phone(phone), phone)
+        self.referrer_phone, self.referral_phone = list(phones.values())[:2]
+        for phone in (self.referrer_phone, self.referral_phone):
+            with mock.patch("users.views.send_enter_code"):
+                self.client.post(reverse("users:get_code"), data={"phone": phone})
+            self.client.post(
+                reverse("users:send_code"),
+                data={"phone": phone, "password": self.client.session[phone]},
+            )
+
+    def test_cross_shard_referrer(self):
+        """
+        Проверяет, что пользователи создаются в своих шардах, а реферера из другого шарда
+        можно назначить по инвайт-коду и увидеть реферала в его профиле.
+        """
+        referrer = get_user_by_phone(self.referrer_phone)
+        referral = get_user_by_phone(self.referral_phone)
+        self.assertEqual(referrer._state.db, get_shard_for_phone(self.referrer_phone))
+        self.assertNotEqual(referrer._state.db, referral._state.db)
+
+        self.client.force_authenticate(user=referral)
+        response = self.client.post(
+            reverse("users:set_referrer"), data={"invite_code": referrer.invite_code}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(user=get_user_by_phone(self.referrer_phone))
+        response = self.client.get(
+            reverse("users:retrieve"), HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response.data["referrals"], [self.referral_phone])
+
+    def test_rebalance_shards(self):
+        """
+        Проверяет, что после сокращения списка шардов команда rebalance_shards
+        переносит пользователей в оставшийся шард и обновляет справочник.
+        """
+        shards = settings.USER_SHARDS
+        target = shards[0]
+        with override_settings(USER_SHARDS=[target]):
+            call_command("rebalance_shards", source=shards, stdout=StringIO())
+        self.assertEqual(User.objects.using(target).count(), 2)
+        self.assertEqual(
+            set(UserDirectory.objects.values_list("shard", flat=True)), {target}
+        )
+
+    def test_rebalance_shards_rerun_after_failure(self):
+        """
+        Проверяет, что после сбоя переноса между шагами повторный запуск rebalance_shards
+        завершает перенос: сбой до переключения справочника не мешает повторной записи
+        в целевой шард, а после переключения данные целевого шарда не перезаписываются.
+        """
+        shards = settings.USER_SHARDS
+        target = shards[0]
+        user = get_user_by_phone(self.referrer_phone)
+        if user._state.db == target:
+            user = get_user_by_phone(self.referral_phone)
+        source = user._state.db
+        with override_settings(USER_SHARDS=[target]):
+            # Сбой после записи в целевой шард, до переключения справочника
+            with mock.patch.object(QuerySet, "update", side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    call_command("rebalance_shards", source=shards, stdout=StringIO())
+            self.assertEqual(UserDirectory.objects.get(pk=user.pk).shard, source)
+
+            # Сбой после переключения справочника, до удаления из исходного шарда
+            with mock.patch.object(QuerySet, "_raw_delete", side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    call_command("rebalance_shards", source=shards, stdout=StringIO())
+            self.assertEqual(UserDirectory.objects.get(pk=user.pk).shard, target)
+            User.objects.using(target).filter(pk=user.pk).update(first_name="Новое")
+
+            call_command("rebalance_shards", source=shards, stdout=StringIO())
+        self.assertFalse(User.objects.using(source).filter(pk=user.pk).exists())
+        self.assertEqual(User.objects.using(target).get(pk=user.pk).first_name, "Новое")
+        self.assertEqual(User.objects.using(target).count(), 2)
+
+
+class ReferralGraphStatsTestCase(UsersTestCase):
+
+    def test_referral_graph_stats(self):
+        """
+        Проверяет расчёт прямых рефералов, размера дерева рефералов и глубины.
+        Дерево: root <- child <- grandchild, root <- second_child.
+        """
+        root = self.create_user(phone="70000000000", invite_code="aaaaa1")
+        child = self.create_user(
+            phone="70000000001", invite_code="aaaaa2", invited_by=root
+        )
+        grandchild = self.create_user(
+            phone="70000000002", invite_code="aaaaa3", invited_by=child
+        )
+        self.create_user(phone="70000000003", invite_code="aaaaa4", invited_by=root)
+
+        call_command("referral_graph_stats", stdout=StringIO())
+        stats = {s.user_id: s for s in ReferralTreeStats.objects.all()}
+        self.assertEqual(stats[root.pk].direct_referrals, 2)
+        self.assertEqual(stats[root.pk].descendants, 3)
+        self.assertEqual(stats[root.pk].depth, 0)
+        self.assertEqual(stats[grandchild.pk].depth, 2)
+        self.assertEqual(stats[grandchild.pk].descendants, 0)
+
+
+class ProfilingTestCase(UsersTestCase):
+
+    def setUp(self):
+        self.profiles_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profiles_dir)
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_authenticate(user=self.user)
+
+    def test_profile_by_url_name(self):
+        """
+        Проверяет, что запросы к представлению из PROFILING_URL_NAMES профилируются,
+        а команда profile_report строит по ним отчёт.
+        """
+        with override_settings(
+            PROFILING_ENABLED=True,
+            PROFILING_URL_NAMES=["users:retrieve"],
+            PROFILING_DIR=self.profiles_dir,
+        ):
+            self.client.get(reverse("users:retrieve"), HTTP_ACCEPT="application/json")
+            self.client.get(
+                reverse("users:set_referrer"), HTTP_ACCEPT="application/json"
+            )
+            out = StringIO()
+            call_command("profile_report", stdout=out)
+
+        self.assertEqual(os.listdir(self.profiles_dir), ["users.retrieve"])
+        self.assertIn("users.retrieve: запросов 1", out.getvalue())
+
+    def test_profiles_rotated(self):
+        """
+        Проверяет, что для представления хранится не больше PROFILING_MAX_FILES
+        последних профилей, а более старые удаляются.
+        """
+        with override_settings(
+            PROFILING_ENABLED=True,
+            PROFILING_URL_NAMES=["users:retrieve"],
+            PROFILING_DIR=self.profiles_dir,
+            PROFILING_MAX_FILES=2,
+        ):
+            names = []
+            for _ in range(4):
+                self.client.get(
+                    reverse("users:retrieve"), HTTP_ACCEPT="application/json"
+                )
+                names.append(
+                    max(os.listdir(os.path.join(self.profiles_dir, "users.retrieve")))
+                )
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.profiles_dir, "users.retrieve"))),
+            names[-2:],
+        )
+
+
+class FormPageTestCase(UsersTestCase):
+
+    def setUp(self):
+        # Кэш страниц общий для процесса: другие тесты могли уже отрендерить форму
+        pages = mock.patch.dict("users.pages._pages", clear=True)
+        pages.start()
+        self.addCleanup(pages.stop)
+
+    def test_form_page_rendered_once(self):
+        """
+        Проверяет, что страница с формой рендерится один раз, а CSRF-токен
+        подставляется в готовую страницу для каждого запроса.
+        """
+        url = reverse("users:get_code")
+        with mock.patch(
+            "users.pages.render_page_parts", wraps=render_page_parts
+        ) as render:
+            first = self.client.get(url, HTTP_ACCEPT="text/html")
+            self.client.cookies.clear()
+            second = self.client.get(url, HTTP_ACCEPT="text/html")
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertNotIn(CSRF_PLACEHOLDER, first.content.decode())
+        self.assertIn("csrfmiddlewaretoken", first.content.decode())
+        self.assertIn(settings.CSRF_COOKIE_NAME, second.cookies)
+        self.assertNotEqual(first.content, second.content)
+        self.assertIn("private", second["Cache-Control"])
+        self.assertIn("Cookie", second["Vary"])
+
+    def test_form_page_uses_context_processors(self):
+        """
+        Проверяет, что страница рендерится с context processors, но от имени анонимного
+        запроса: пользователь, запросивший страницу первым, не попадает в кэш.
+        """
+        template = engines["django"].from_string(
+            "{{ request.path }}|{{ user.is_authenticated }}|{{ csrf_token }}"
+        )
+        user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_login(user)
+        url = reverse("users:get_code")
+        with mock.patch("users.pages.loader.get_template", return_value=template):
+            response = self.client.get(url, HTTP_ACCEPT="text/html")
+
+        path, is_authenticated, token = response.content.decode().split("|")
+        self.assertEqual(path, url)
+        self.assertEqual(is_authenticated, "False")
+        self.assertNotEqual(token, CSRF_PLACEHOLDER)
+
+
+class APIv2TestCase(UsersTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_authenticate(user=self.user)
+
+    def test_json_only_without_session(self):
+        """
+        Проверяет, что /api/v2/ отвечает JSON независимо от Accept
+        и не устанавливает cookie сессии и CSRF.
+        """
+        response = self.client.get(reverse("api_v2:retrieve"), HTTP_ACCEPT="text/html")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(response.json()["phone"], "70000000000")
+        self.assertNotIn("X-Frame-Options", response)
+        self.assertFalse(response.cookies)
+
+    def test_login_without_session(self):
+        """
+        Проверяет вход через /api/v2/: код хранится в кэше, а не в сессии.
+        """
+        self.client.force_authenticate(user=None)
+        response = self.client.post(
+            reverse("api_v2:get_code"), {"phone": "70000000001"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        enter_code = cache.get(get_issued_enter_code_cache_key("70000000001"))
+
+        response = self.client.post(
+            reverse("api_v2:send_code"),
+            {"phone": "70000000001", "password": enter_code},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("access", response.json())
+        self.assertIsNone(cache.get(get_issued_enter_code_cache_key("70000000001")))
+
+    def test_wrong_code_without_session_invalidates_code(self):
+        """
+        Проверяет, что неверный код через /api/v2/ удаляет выданный код из кэша,
+        и войти с ним уже нельзя.
+        """
+        self.client.force_authenticate(user=None)
+        self.client.post(
+            reverse("api_v2:get_code"), {"phone": "70000000001"}, format="json"
+        )
+        enter_code = cache.get(get_issued_enter_code_cache_key("70000000001"))
+
+        self.client.post(
+            reverse("api_v2:send_code"),
+            {"phone": "70000000001", "password": "wrong"},
+            format="json",
+        )
+        self.assertIsNone(cache.get(get_issued_enter_code_cache_key("70000000001")))
+        response = self.client.post(
+            reverse("api_v2:send_code"),
+            {"phone": "70000000001", "password": enter_code},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_gzip_threshold(self):
+        """
+        Проверяет, что ответы API сжимаются только начиная с API_GZIP_MIN_SIZE байт.
+        """
+        for i in range(50):
+            self.create_user(
+                f"7900000{i:04d}", invite_code=f"r{i:05d}", invited_by=self.user
+            )
+        url = reverse("api_v2:retrieve")
+        with override_settings(API_GZIP_MIN_SIZE=10_000):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+
+        with override_settings(API_GZIP_MIN_SIZE=100):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+    def test_browser_routes_keep_middleware(self):
+        """
+        Проверяет, что для адресов /users/ middleware браузерного интерфейса работают.
+        """
+        response = self.client.get(reverse("users:get_code"), HTTP_ACCEPT="text/html")
+
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+
+class StaticAssetsTestCase(UsersTestCase):
+
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+        settings_override = override_settings(STATIC_ROOT=self.static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command("collectstatic", interactive=False, verbosity=0)
+
+    def test_precompressed_hashed_asset(self):
+        """
+        Проверяет, что collectstatic пишет файлы с хэшем и копии .gz,
+        а сжатая копия отдаётся клиентам с Accept-Encoding: gzip как immutable.
+        """
+        hashed_name = staticfiles_storage.stored_name("js/color-models.js")
+        self.assertNotEqual(hashed_name, "js/color-models.js")
+        self.assertTrue(staticfiles_storage.exists(f"{hashed_name}.gz"))
+
+        url = staticfiles_storage.url("js/color-models.js")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, br")
+        content = b"".join(response.streaming_content)
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("javascript", response["Content-Type"])
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("Accept-Encoding", response["Vary"])
+        with staticfiles_storage.open("js/color-models.js") as original:
+            self.assertEqual(gzip.decompress(content), original.read())
+
+    def test_uncompressed_without_accept_encoding(self):
+        """
+        Проверяет, что без gzip в Accept-Encoding отдаётся исходный файл,
+        а файл без хэша в имени не кэшируется надолго.
+        """
+        response = self.client.get("/static/js/color-models.js")
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", response)
+        self.assertNotIn("immutable", response["Cache-Control"])
+
+    def test_unknown_hashed_name_not_immutable(self):
+        """
+        Проверяет, что файл, имя которого только похоже на имя с хэшем, но которого
+        нет в манифесте, не кэшируется как immutable, а ссылка на отсутствующий
+        в манифесте файл не подменяется исходным именем.
+        """
+        with open(os.path.join(self.static_root, "stale.0123456789ab.js"), "w") as file:
+            file.write("")
+        response = self.client.get("/static/stale.0123456789ab.js")
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("immutable", response["Cache-Control"])
+        with self.assertRaises(ValueError):
+            staticfiles_storage.stored_name("js/missing.js")
+
+
+class BatchLookupTestCase(UsersTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.referral = self.create_user(
+            phone="70000000001", invite_code="abc123", invited_by=self.user
+        )
+        self.admin = self.create_user(
+            phone="79900000000", invite_code="admin1", is_staff=True
+        )
+        self.client.force_authenticate(user=self.admin)
+
+    def test_lookup(self):
+        """
+        Проверяет, что инвайт-коды и телефоны проверяются одним запросом на список.
+        """
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                reverse("users:lookup"),
+                {
+                    "invite_codes": ["def456", "abc123", "zzz999"],
+                    "phones": ["70000000001"],
+                },
+                format="json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "invite_codes": {
+                    "def456": {
+                        "exists": True,
+                        "id": self.user.pk,
+                        "has_referrer": False,
+                    },
+                    "abc123": {
+                        "exists": True,
+                        "id": self.referral.pk,
+                        "has_referrer": True,
+                    },
+                    "zzz999": {"exists": False, "id": None, "has_referrer": None},
+                },
+                "phones": {
+                    "70000000001": {
+                        "exists": True,
+                        "id": self.referral.pk,
+                        "has_referrer": True,
+                    }
+                },
+            },
+        )
+
+    @override_settings(BATCH_LOOKUP_MAX_ITEMS=2)
+    def test_lookup_limit(self):
+        """
+        Проверяет, что запрос с пустыми списками или больше BATCH_LOOKUP_MAX_ITEMS значений отклоняется.
+        """
+        url = reverse("users:lookup")
+        response = self.client.post(url, {"phones": []}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            url, {"invite_codes": ["a", "b"], "phones": ["c"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_for_regular_user(self):
+        """
+        Проверяет, что пакетная проверка недоступна обычному пользователю.
+        """
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(
+            reverse("users:lookup"), {"phones": ["70000000001"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_lookup_throttled(self):
+        """
+        Проверяет, что запросы сверх BATCH_LOOKUP_THROTTLE_RATE отклоняются.
+        """
+        url = reverse("users:lookup")
+        with mock.patch.dict(
+            ScopedRateThrottle.THROTTLE_RATES, {"batch_lookup": "1/min"}
+        ):
+            response = self.client.post(url, {"phones": ["70000000001"]}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(url, {"phones": ["70000000001"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @skipUnless(
+        connection.vendor == "postgresql", "Запрос = ANY(%s) есть только в Postgres"
+    )
+    def test_any_lookup_postgresql(self):
+        """
+        Проверяет, что в Postgres список передаётся одним параметром-массивом
+        и текст запроса не зависит от длины списка.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            short = lookup_users("invite_code", ["def456"])
+            long = lookup_users("invite_code", ["def456", "abc123", "zzz999"])
+
+        self.assertEqual(short, {"def456": (self.user.pk, None)})
+        self.assertEqual(
+            long,
+            {
+                "def456": (self.user.pk, None),
+                "abc123": (self.referral.pk, self.user.pk),
+            },
+        )
+        self.assertIn("= ANY(", queries[0]["sql"])
+        self.assertEqual(
+            queries[0]["sql"].split("ANY(")[0], queries[1]["sql"].split("ANY(")[0]
+        )
+
+
+class InviteCodeBloomTestCase(UsersTestCase):
+
+    def setUp(self):
+        invite_codes.reset()
+        self.addCleanup(invite_codes.reset)
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.client.force_authenticate(user=self.user)
+
+    def test_filter(self):
+        """
+        Проверяет, что фильтр не даёт ложноотрицательных ответов и держит
+        заданную долю ложноположительных.
+        """
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"code{i}")
+
+        self.assertTrue(all(f"code{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"miss{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 300)
+
+    @override_settings(INVITE_CODE_BLOOM_SYNC_INTERVAL=3600)
+    def test_filter_miss_checked_in_database(self):
+        """
+        Проверяет, что код, которого нет в фильтре, отклоняется после одного запроса
+        EXISTS, а код, созданный другим процессом до подгрузки фильтра, принимается.
+        """
+        url = reverse("users:set_referrer")
+        invite_codes.rebuild()
+        # Пользователь создан другим процессом: в фильтр этого процесса код не попадает
+        with mock.patch("users.signals.invite_codes"):
+            self.create_user("70000000002", invite_code="new789")
+        self.assertFalse(invite_codes.might_exist("new789"))
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                url, {"invite_code": "zzz999"}, HTTP_ACCEPT="application/json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.post(
+            url, {"invite_code": "new789"}, HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_filter_built_in_background(self):
+        """
+        Проверяет, что запрос не строит фильтр сам: пока фильтра нет, код считается
+        возможно существующим, а построение запускается в фоновом потоке.
+        """
+        with mock.patch.object(invite_codes, "rebuild_in_background") as rebuild:
+            self.assertTrue(invite_codes.might_exist("zzz999"))
+        rebuild.assert_called_once_with()
+        self.assertIsNone(invite_codes.bloom)
+
+    @override_settings(INVITE_CODE_BLOOM_SYNC_INTERVAL=0)
+    def test_sync_codes_from_other_processes(self):
+        """
+        Проверяет, что код, созданный в обход этого процесса, подгружается
+        при промахе фильтра.
+        """
+        invite_codes.rebuild()
+        # Пользователь создан другим процессом: в фильтр этого процесса код не попадает
+        with mock.patch("users.signals.invite_codes"):
+            self.create_user("70000000002", invite_code="new789")
+
+        self.assertTrue(invite_codes.might_exist("new789"))
+
+    @override_settings(INVITE_CODE_BLOOM_SYNC_INTERVAL=0)
+    def test_sync_late_commits_and_edits(self):
+        """
+        Проверяет, что подгружаются коды строк, закоммиченных позже строк с большим id
+        (в пределах INVITE_CODE_BLOOM_SYNC_OVERLAP), и коды, изменённые в обход процесса.
+        """
+        invite_codes.rebuild()
+        late = datetime.now(timezone.utc) - timedelta(seconds=1)
+        with mock.patch("users.signals.invite_codes"):
+            self.create_user("70000000002", invite_code="late01")
+        self.user_rows().filter(invite_code="late01").update(updated_at=late)
+        self.referrer.invite_code = "edit01"
+        self.referrer.save()
+
+        self.assertTrue(invite_codes.might_exist("late01"))
+        self.assertTrue(invite_codes.might_exist("edit01"))
+
+    def test_concurrent_rebuild_skipped(self):
+        """
+        Проверяет, что пока фильтр строит один поток, другой не начинает
+        перестройку, а проверка кода уходит в базу данных.
+        """
+        with invite_codes.rebuild_lock:
+            self.assertFalse(invite_codes.rebuild())
+            self.assertTrue(invite_codes.might_exist("zzz999"))
+        self.assertIsNone(invite_codes.bloom)
+
+
+class SeedUsersTestCase(UsersTestCase):
+
+    def seed(self, **options):
+        call_command(
+            "seed_users", count=1000, chunk_size=300, stdout=StringIO(), **options
+        )
+        return list(
+            User.objects.order_by("pk").values_list(
+                "pk", "phone", "invite_code", "invited_by_id", "last_login"
+            )
+        )
+
+    def test_seed_users(self):
+        """
+        Проверяет, что seed_users создаёт пользователей с корректными уникальными
+        номерами и инвайт-кодами, реферер зарегистрирован раньше реферала,
+        а при том же --seed результат повторяется.
+        """
+        users = self.seed(seed=1)
+
+        self.assertEqual(len(users), 1000)
+        self.assertEqual(len({user[1] for user in users}), 1000)
+        self.assertEqual(len({user[2] for user in users}), 1000)
+        for pk, phone, invite_code, invited_by_id, _ in users:
+            phone_validator(phone)
+            self.assertEqual(len(invite_code), 6)
+            self.assertTrue(invited_by_id is None or invited_by_id < pk)
+        self.assertTrue(any(user[3] for user in users))
+        self.assertTrue(any(user[4] is None for user in users))
+
+        repeated = self.seed(seed=1, clear=True)
+        self.assertEqual([user[:4] for user in repeated], [user[:4] for user in users])
+        self.assertNotEqual(self.seed(seed=2, clear=True), users)
+
+        # Новые пользователи получают id после созданных командой
+        user = User.objects.create(phone="70000000000", invite_code="new123")
+        self.assertEqual(user.pk, 1001)
+
+    def test_seed_users_rows_match_table(self):
+        """
+        Проверяет, что строки для COPY заполняют все столбцы таблицы пользователей
+        в порядке COLUMNS: столбец без значения нарушил бы NOT NULL в Postgres.
+        """
+        self.assertCountEqual(
+            seed_users.COLUMNS,
+            [field.column for field in User._meta.concrete_fields],
+        )
+        command = seed_users.Command()
+        command.phone_a = command.code_a = 1
+        command.phone_b = command.code_b = 0
+        command.now = int(datetime.now(timezone.utc).timestamp())
+        options = {
+            "skew": 3.0,
+            "chain_ratio": 0.0,
+            "referral_ratio": 0.5,
+            "unverified_ratio": 0.5,
+        }
+        chunk = command.generate_chunk(np.random.default_rng(0), 0, 10, 10, options)
+        rows = list(command.iter_rows(chunk))
+        self.assertEqual({len(row) for row in rows}, {len(seed_users.COLUMNS)})
+        updated_at = seed_users.COLUMNS.index("updated_at")
+        self.assertTrue(all(row[updated_at] for row in rows))
+
+
+class LiveEventsTestCase(UsersTestCase):
+
+    def setUp(self):
+        self.user = self.create_user(phone="70000000000", invite_code="abc123")
+        self.headers = {"authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+    async def open_stream(self, **headers):
+        response = await self.async_client.get(
+            reverse("users:events"), headers=headers or self.headers
+        )
+        return response
+
+    def test_set_referrer_publishes_events(self):
+        """
+        Проверяет, что после фиксации транзакции установки реферера рефереру
+        отправляется событие о новом реферале, а рефералу - об установке реферера.
+        """
+        referral = self.create_user(phone="70000000001", invite_code="def456")
+        self.client.force_authenticate(user=referral)
+
+        with mock.patch.object(hub, "publish") as publish:
+            # Уведомление отправляется после фиксации транзакции шарда реферала
+            with self.captureOnCommitCallbacks(using=referral._state.db, execute=True):
+                self.client.post(
+                    reverse("users:set_referrer"), data={"invite_code": "abc123"}
+                )
+
+        publish.assert_has_calls(
+            [
+                mock.call(self.user.pk, NEW_REFERRAL, {"phone": "70000000001"}),
+                mock.call(
+                    referral.pk,
+                    REFERRER_SET,
+                    {"phone": "70000000000", "invite_code": "abc123"},
+                ),
+            ]
+        )
+
+    async def test_stream(self):
+        """
+        Проверяет, что поток отдаёт события пользователя в формате text/event-stream,
+        а при отсутствии событий - heartbeat.
+        """
+        with override_settings(LIVE_EVENTS_HEARTBEAT=0.01):
+            response = await self.open_stream()
+            chunks = aiter(response.streaming_content)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            self.assertTrue((await anext(chunks)).startswith(b"retry:"))
+            self.assertEqual(await anext(chunks), b": heartbeat\n\n")
+
+            hub.publish(self.user.pk, NEW_REFERRAL, {"phone": "70000000001"})
+            hub.publish(self.user.pk + 1, NEW_REFERRAL, {"phone": "70000000002"})
+            event = await anext(chunks)
+            self.assertEqual(
+                event, b'event: new_referral\ndata: {"phone": "70000000001"}\n\n'
+            )
+            response.close()
+        self.assertNotIn(self.user.pk, hub.subscriptions)
+
+    async def test_stream_limits(self):
+        """
+        Проверяет, что поток требует авторизации, ограничивает количество соединений
+        пользователя и закрывается, если клиент не успевает забирать события.
+        """
+        response = await self.open_stream(authorization="Bearer invalid")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        with override_settings(LIVE_EVENTS_MAX_CONNECTIONS=1, LIVE_EVENTS_QUEUE_SIZE=2):
+            chunks = aiter((await self.open_stream()).streaming_content)
+            await anext(chunks)
+            response = await self.open_stream()
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+            for number in range(3):
+                hub.publish(self.user.pk, NEW_REFERRAL, {"phone": str(number)})
+            self.assertTrue((await anext(chunks)).startswith(b"event: overflow"))
+            with self.assertRaises(StopAsyncIteration):
+                await anext(chunks)
+        self.assertNotIn(self.user.pk, hub.subscriptions)
+
+    async def test_stream_ends_on_disconnect(self):
+        """
+        Проверяет, что DisconnectMiddleware замечает разрыв соединения после чтения тела
+        запроса, а поток событий сразу завершается и снимает подписку.
+        """
+        scopes = []
+        messages = asyncio.Queue()
+        await messages.put({"type": "http.request", "body": b"", "more_body": False})
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+            await receive()
+            await scope[DISCONNECTED_KEY].wait()
+
+        middleware = DisconnectMiddleware(app)
+        task = asyncio.ensure_future(middleware({"type": "http"}, messages.get, None))
+        await messages.put({"type": "http.disconnect"})
+        await asyncio.wait_for(task, 1)
+        self.assertTrue(scopes[0][DISCONNECTED_KEY].is_set())
+
+        disconnected = asyncio.Event()
+        with override_settings(LIVE_EVENTS_HEARTBEAT=60):
+            stream = EventStream(hub.subscribe(self.user.pk), disconnected)
+            await anext(stream)
+            next_chunk = asyncio.ensure_future(anext(stream))
+            disconnected.set()
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.wait_for(next_chunk, 1)
+        self.assertNotIn(self.user.pk, hub.subscriptions)
+
+    async def test_stream_from_page(self):
+        """
+        Проверяет, что страница профиля, отданная ASGI-сервером по JWT, получает адрес
+        потока с подписанным токеном, а поток по этому адресу открывается без заголовков,
+        как его открывает EventSource. Поддельный и истёкший токены отклоняются.
+        """
+        response = await self.async_client.get(
+            reverse("users:retrieve"), headers={**self.headers, "accept": "text/html"}
+        )
+        events_url = json.loads(
+            '"'
+            + re.search(r'new EventSource\("(.*?)"\)', response.content.decode())[1]
+            + '"'
+        )
+
+        response = await self.async_client.get(events_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        response.close()
+
+        response = await self.async_client.get(events_url + "x")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        with override_settings(LIVE_EVENTS_TOKEN_TTL=-1):
+            response = await self.async_client.get(events_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_page_without_asgi_not_subscribed(self):
+        """
+        Проверяет, что страницы, отданные WSGI-сервером, не подписываются на поток событий.
+        """
+        self.client.force_authenticate(user=self.user)
+        for url in (reverse("users:retrieve"), reverse("users:set_referrer")):
+            response = self.client.get(url, HTTP_ACCEPT="text/html")
+            self.assertNotIn("EventSource", response.content.decode())
+
+    def test_stream_requires_asgi(self):
+        """
+        Проверяет, что при WSGI поток событий отклоняется, а не занимает поток сервера.
+        """
+        response = self.client.get(
+            reverse("users:events"), HTTP_AUTHORIZATION=self.headers["authorization"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    async def test_stream_socket_broker(self):
+        """
+        Проверяет доставку событий через Unix-сокеты в LIVE_EVENTS_SOCKET_DIR
+        и удаление сокета, когда в процессе не остаётся соединений.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(LIVE_EVENTS_SOCKET_DIR=directory):
+            response = await self.open_stream()
+            chunks = aiter(response.streaming_content)
+            await anext(chunks)
+            self.assertEqual(os.listdir(directory), [f"{os.getpid()}.sock"])
+
+            hub.publish(self.user.pk, REFERRER_SET, {"invite_code": "def456"})
+            event = await anext(chunks)
+            self.assertEqual(
+                event, b'event: referrer_set\ndata: {"invite_code": "def456"}\n\n'
+            )
+            response.close()
+        self.assertEqual(os.listdir(directory), [])
+
+
+class IdempotencyTestCase(UsersTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.referrer = self.create_user(phone="70000000001", invite_code="abc123")
+        self.user = self.create_user(phone="70000000000", invite_code="def456")
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("users:set_referrer")
+
+    def set_referrer(self, invite_code="abc123", key="key-1"):
+        return self.client.post(
+            self.url,
+            data={"invite_code": invite_code},
+            HTTP_IDEMPOTENCY_KEY=key,
+            HTTP_ACCEPT="application/json",
+        )
+
+    def test_replay(self):
+        """
+        Проверяет, что повтор запроса с тем же Idempotency-Key получает сохранённый ответ
+        без обращения к базе данных, а тот же ключ с другим телом отклоняется.
+        """
+        first = self.set_referrer()
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            replayed = self.set_referrer()
+        self.assertEqual(replayed.status_code, status.HTTP_200_OK)
+        self.assertEqual(replayed.data, first.data)
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+
+        response = self.set_referrer(invite_code="zzz999")
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # Новый ключ - новый запрос
+        response = self.set_referrer(key="key-2")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch("users.views.send_enter_code")
+    def test_get_code_replay(self, send_enter_code):
+        """
+        Проверяет, что повтор запроса кода через /api/v2/ с тем же ключом возвращает
+        первый ответ, а ключи разных номеров телефона не пересекаются.
+        """
+        url = reverse("api_v2:get_code")
+        headers = {"HTTP_IDEMPOTENCY_KEY": "key-1"}
+        first = self.client.post(url, data={"phone": "70000000005"}, **headers)
+        replayed = self.client.post(url, data={"phone": "70000000005"}, **headers)
+        self.assertEqual(replayed.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replayed.data, first.data)
+        send_enter_code.assert_called_once()
+
+        response = self.client.post(url, data={"phone": "70000000006"}, **headers)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(send_enter_code.call_count, 2)
+
+    @mock.patch("users.views.send_enter_code")
+    def test_get_code_with_session_not_replayed(self, send_enter_code):
+        """
+        Проверяет, что запрос кода с сессией выполняется без сохранённого ответа,
+        и код остаётся в сессии, из которой пришёл запрос.
+        """
+        url = reverse("users:get_code")
+        headers = {"HTTP_IDEMPOTENCY_KEY": "key-1", "HTTP_ACCEPT": "application/json"}
+        self.client.post(url, data={"phone": "70000000005"}, **headers)
+        other_client = self.client_class()
+        response = other_client.post(url, data={"phone": "70000000005"}, **headers)
+
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertIn("70000000005", self.client.session)
+
+    def test_in_flight_request(self):
+        """
+        Проверяет, что повтор, пришедший во время выполнения запроса с тем же ключом,
+        сразу получает 409 с Retry-After и не выполняется.
+        """
+        request = mock.Mock(path_info=self.url)
+        cache_key = get_idempotency_cache_key(request, f"user:{self.user.pk}", "key-1")
+        cache.add(f"{cache_key}:lock", 1)
+
+        response = self.set_referrer()
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response["Retry-After"], "1")
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.invited_by_id)
+
+        cache.delete(f"{cache_key}:lock")
+        self.assertEqual(self.set_referrer().status_code, status.HTTP_200_OK)
+
+    def test_replay_headers_and_cookies(self):
+        """
+        Проверяет, что повтор получает заголовки и cookies, выставленные представлением
+        в первом ответе, а не только статус и тело.
+        """
+
+        class CreateView(APIView):
+            calls = 0
+
+            @idempotent(get_scope=lambda request: "test")
+            def post(self, request):
+                CreateView.calls += 1
+                response = Response(
+                    {"id": 1},
+                    status=status.HTTP_201_CREATED,
+                    headers={"Location": "/items/1/", "ETag": '"v1"'},
+                )
+                response.set_cookie("item", "1")
+                return response
+
+        view = CreateView.as_view()
+        factory = APIRequestFactory()
+        responses = [
+            view(factory.post("/items/", {"name": "x"}, HTTP_IDEMPOTENCY_KEY="key-1"))
+            for _ in range(2)
+        ]
+
+        self.assertEqual(CreateView.calls, 1)
+        first, replayed = responses
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+        self.assertEqual(replayed.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replayed["Location"], first["Location"])
+        self.assertEqual(replayed["ETag"], first["ETag"])
+        self.assertEqual(replayed.cookies["item"].value, "1")
@@ -1,11 +1,14 @@
 from django.urls import path
 
-from users import views
+from users import live, views
 from users.apps import UsersConfig
 from users.views import (
+    AvatarUploadAPIView,
+    BatchLookupAPIView,
     MyTokenObtainPairView,
     MyTokenRefreshView,
     SetReferrerAPIView,
+    StatsAPIView,
     UserRetrieveAPIView,
 )
 
@@ -17,4 +20,8 @@ urlpatterns = [
     path("auth/refresh/", MyTokenRefreshView.as_view(), name="token_refresh"),
     path("set_referrer/", SetReferrerAPIView.as_view(), name="set_referrer"),
     path("retrieve/", UserRetrieveAPIView.as_view(), name="retrieve"),
+    path("stats/", StatsAPIView.as_view(), name="stats"),
+    path("avatar/", AvatarUploadAPIView.as_view(), name="avatar"),
+    path("lookup/", BatchLookupAPIView.as_view(), name="lookup"),
+    path("events/", live.events_stream, name="events"),
 ]
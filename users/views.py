@@ -1,18 +1,57 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import parse_etags
 from rest_framework import generics, status, views
-from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework.renderers import JSONRenderer, TemplateHTMLRenderer
+from rest_framework.parsers import FileUploadParser, MultiPartParser
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.throttling import ScopedRateThrottle
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
+from users.auth_backends import ProfileJWTAuthentication
+from users.avatars import delete_avatar, get_thumbnail_urls, schedule_thumbnails
+from users.bloom import invite_codes
+from users.idempotency import idempotent, phone_scope
+from users.live import NEW_REFERRAL, REFERRER_SET, get_events_url, hub
+from users.models import DailyStats, OutboxEvent, ReferrerDailyStats
+from users.outbox import publish_event
+from users.pages import cached_form_page
+from users.renderers import FastJSONRenderer
 from users.serializers import (
+    AvatarUploadSerializer,
+    BatchLookupSerializer,
+    DailyStatsSerializer,
     MyTokenObtainPairSerializer,
     UserPhoneSerializer,
     UserRetrieveSerializer,
 )
-from users.services import create_enter_code, create_invite_code, send_enter_code
+from users.services import (
+    acquire_enter_code,
+    get_enter_code_retry_after,
+    release_enter_code,
+    save_enter_code,
+    send_enter_code,
+    stage_registration,
+)
+from users.sharding import (
+    get_phones_by_id,
+    get_referrer,
+    get_user_by_invite_code,
+    get_user_by_phone,
+    invite_code_exists,
+    lookup_users,
+    set_referrer,
+)
 
 User = get_user_model()
 
@@ -76,13 +115,28 @@ class UserGetEnterCodeMixin(GetOrCreateModelMixin):
     serializer_class = UserPhoneSerializer
 
     def perform_get_or_create(self, serializer):
-        """Метод пытается получить существующего пользователя или создать нового, если такого нет."""
-        user, created = self.model.objects.get_or_create(
-            **serializer.validated_data, defaults={"invite_code": create_invite_code()}
-        )
-        enter_code = create_enter_code()
-        self.request.session[user.phone] = enter_code
-        send_enter_code(user.phone, enter_code)
+        """Метод проверяет, зарегистрирован ли номер, и для нового номера создаёт незавершённую регистрацию.
+        Повторные запросы на тот же номер в течение ENTER_CODE_COALESCE_TIMEOUT не обращаются к базе
+        данных, не отправляют смс и не получают код: для них возвращается None.
+        """
+        phone = serializer.validated_data["phone"]
+        enter_code, is_leader = acquire_enter_code(phone)
+        if not is_leader:
+            return None
+
+        try:
+            # Пользователь для нового номера создаётся только после ввода верного кода
+            try:
+                get_user_by_phone(phone)
+                created = False
+            except User.DoesNotExist:
+                stage_registration(phone)
+                created = True
+            save_enter_code(self.request, phone, enter_code)
+            send_enter_code(phone, enter_code)
+        except Exception:
+            release_enter_code(phone)
+            raise
         return created
 
 
@@ -92,7 +146,7 @@ class UserGetCodeAPIView(UserGetEnterCodeMixin, generics.GenericAPIView):
     Возвращает либо JSON, либо HTML в зависимости от заголовков запроса.
     """
 
-    renderer_classes = [JSONRenderer, TemplateHTMLRenderer]
+    renderer_classes = [FastJSONRenderer, TemplateHTMLRenderer]
     template_name = "get_code.html"
 
     def get(self, request, *args, **kwargs):
@@ -103,12 +157,13 @@ class UserGetCodeAPIView(UserGetEnterCodeMixin, generics.GenericAPIView):
 
         # Проверяем, что рендер используется для HTML
         if request.accepted_renderer.format == "html":
-            return Response(
-                {"serializer": serializer}, template_name=self.template_name
+            return cached_form_page(
+                request, self.template_name, {"serializer": serializer}
             )
         # Возвращаем данные в формате JSON
         return Response({"serializer": serializer.data})
 
+    @idempotent(get_scope=phone_scope)
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
 
@@ -128,15 +183,23 @@ class UserGetCodeAPIView(UserGetEnterCodeMixin, generics.GenericAPIView):
                     status=status.HTTP_201_CREATED,
                 )
 
-            if request.accepted_renderer.format == "html":
+            if created is None:
+                # Смс не отправляется: код ещё действует
+                retry_after = get_enter_code_retry_after(
+                    serializer.validated_data["phone"]
+                )
+                message = f"Код уже отправлен. Запросить новый код можно через {retry_after} сек."
+            else:
                 message = "Код отправлен повторно."
+
+            if request.accepted_renderer.format == "html":
                 return Response(
                     {"serializer": serializer, "message": message},
                     status=status.HTTP_200_OK,
                     template_name=self.template_name,
                 )
             return Response(
-                {"serializer": serializer.data, "message": "Код отправлен повторно."},
+                {"serializer": serializer.data, "message": message},
                 status=status.HTTP_200_OK,
             )
 
@@ -157,7 +220,7 @@ class MyTokenObtainPairView(TokenObtainPairView):
     Представление для получения токенов по номеру телефона.
     """
 
-    renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
+    renderer_classes = [TemplateHTMLRenderer, FastJSONRenderer]
     template_name = "send_code.html"
     permission_classes = (AllowAny,)
     serializer_class = MyTokenObtainPairSerializer
@@ -205,8 +268,8 @@ class MyTokenObtainPairView(TokenObtainPairView):
         """
         serializer = self.serializer_class()
         if request.accepted_renderer.format == "html":
-            return Response(
-                {"serializer": serializer}, template_name=self.template_name
+            return cached_form_page(
+                request, self.template_name, {"serializer": serializer}
             )
         else:
             return Response(
@@ -220,7 +283,7 @@ class MyTokenRefreshView(TokenRefreshView):
     Представление для обновления токена.
     """
 
-    renderer_classes = [JSONRenderer, TemplateHTMLRenderer]
+    renderer_classes = [FastJSONRenderer, TemplateHTMLRenderer]
     template_name = "refresh.html"
     permission_classes = (AllowAny,)
 
@@ -255,7 +318,7 @@ class MyTokenRefreshView(TokenRefreshView):
         Обрабатывает GET-запрос, возвращая форму для обновления токена.
         """
         serializer = TokenRefreshSerializer()
-        return Response({"serializer": serializer}, template_name=self.template_name)
+        return cached_form_page(request, self.template_name, {"serializer": serializer})
 
 
 class SetReferrerAPIView(views.APIView):
@@ -264,9 +327,10 @@ class SetReferrerAPIView(views.APIView):
     """
 
     permission_classes = [IsAuthenticated]
-    renderer_classes = [JSONRenderer, TemplateHTMLRenderer]
+    renderer_classes = [FastJSONRenderer, TemplateHTMLRenderer]
     template_name = "set_referrer.html"
 
+    @idempotent()
     def post(self, request):
         """
         Обрабатывает POST-запрос для установки реферала.
@@ -286,32 +350,67 @@ class SetReferrerAPIView(views.APIView):
                 {"message": error_message}, status.HTTP_400_BAD_REQUEST
             )
 
-        if referral.invited_by is not None:
-            error_message = f"Вы уже являетесь рефералом пользователя с инвайт-кодом {referral.invited_by.invite_code}"
+        current_referer = get_referrer(referral)
+        if current_referer is not None:
+            error_message = f"Вы уже являетесь рефералом пользователя с инвайт-кодом {current_referer.invite_code}"
             return self._build_response(
                 {"message": error_message}, status.HTTP_400_BAD_REQUEST
             )
 
         try:
-            referer = User.objects.get(invite_code=invite_code)
+            # Промах фильтра Блума проверяется запросом EXISTS по индексу: код мог создать
+            # другой процесс после последней подгрузки фильтра
+            if not invite_codes.might_exist(invite_code) and not invite_code_exists(
+                invite_code
+            ):
+                raise User.DoesNotExist
+            referer = get_user_by_invite_code(invite_code)
         except User.DoesNotExist:
             error_message = "Пользователь с указанным инвайт-кодом не найден"
             return self._build_response(
                 {"error": error_message}, status.HTTP_404_NOT_FOUND
             )
 
-        referral.invited_by = referer
-        referral.save()
+        # Событие outbox пишется в той же транзакции, что и изменение реферера:
+        # при шардировании это транзакция шарда реферала, событие хранится в нём же
+        shard = referral._state.db
+        with transaction.atomic(), transaction.atomic(using=shard):
+            set_referrer(referral, referer)
+            publish_event(
+                OutboxEvent.REFERRER_SET,
+                {
+                    "referral_id": referral.pk,
+                    "referral_phone": referral.phone,
+                    "referrer_id": referer.pk,
+                    "referrer_invite_code": referer.invite_code,
+                },
+                using=shard,
+            )
+            # Открытые потоки событий (users.live) узнают об изменении после фиксации транзакции
+            transaction.on_commit(
+                lambda: self.notify_live(referral, referer), using=shard, robust=True
+            )
         success_message = (
             f"Вы стали рефералом пользователя с инвайт-кодом {referer.invite_code}"
         )
         return self._build_response({"message": success_message})
 
+    def notify_live(self, referral, referer):
+        """
+        Отправляет событие о новом реферале рефереру и событие об установке реферера рефералу.
+        """
+        hub.publish(referer.pk, NEW_REFERRAL, {"phone": referral.phone})
+        hub.publish(
+            referral.pk,
+            REFERRER_SET,
+            {"phone": referer.phone, "invite_code": referer.invite_code},
+        )
+
     def get(self, request, *args, **kwargs):
         """
         Обрабатывает GET-запрос, возвращая информацию о реферале.
         """
-        referral = request.user.invited_by
+        referral = get_referrer(request.user)
         if referral:
             referrer_info = f"Ваш реферер: {referral.invite_code}"
             return self._build_response({"message": referrer_info})
@@ -323,7 +422,12 @@ class SetReferrerAPIView(views.APIView):
         """
         if self.request.accepted_renderer.format == "html":
             return Response(
-                {"context": data}, status=status_code, template_name=self.template_name
+                {
+                    "context": data,
+                    "events_url": get_events_url(self.request, self.request.user),
+                },
+                status=status_code,
+                template_name=self.template_name,
             )
         return Response(data, status=status_code)
 
@@ -334,8 +438,12 @@ class UserRetrieveAPIView(generics.RetrieveAPIView):
     """
 
     serializer_class = UserRetrieveSerializer
+    authentication_classes = [ProfileJWTAuthentication]
     permission_classes = [IsAuthenticated]
-    renderer_classes = [TemplateHTMLRenderer, JSONRenderer]  # Добавляем JSONRenderer
+    renderer_classes = [
+        TemplateHTMLRenderer,
+        FastJSONRenderer,
+    ]  # Добавляем FastJSONRenderer
     template_name = "retrieve.html"
 
     def get_object(self):
@@ -345,19 +453,221 @@ class UserRetrieveAPIView(generics.RetrieveAPIView):
         """
         return self.request.user
 
+    def get_fieldset_key(self, fieldset):
+        """
+        Часть ключа кэша и ETag, различающая наборы полей ?fields= и ?exclude=.
+        Для полного профиля пустая, чтобы ключи и ETag не менялись.
+        """
+        if not self.get_serializer_class().is_sparse(fieldset):
+            return ""
+        return f"-{','.join(fieldset)}"
+
+    def get_etag(self, user, fieldset):
+        """
+        Возвращает ETag профиля. Версия профиля увеличивается при каждом изменении
+        пользователя или его рефералов, формат ответа различает HTML и JSON представления.
+        """
+        return (
+            f'"{user.pk}-{user.profile_version}-{self.request.accepted_renderer.format}'
+            f'{self.get_fieldset_key(fieldset)}"'
+        )
+
+    def get_profile_data(self, user, fieldset):
+        """
+        Возвращает сериализованные данные профиля из кэша по ключу (id пользователя, версия профиля,
+        набор полей), при промахе сериализует пользователя и сохраняет результат в кэш.
+        """
+        cache_key = (
+            f"profile:{user.pk}:{user.profile_version}{self.get_fieldset_key(fieldset)}"
+        )
+        data = cache.get(cache_key)
+        if data is None:
+            serializer_class = self.get_serializer_class()
+            if serializer_class.uses_profile_query(
+                fieldset
+            ) and not serializer_class.has_profile(user, fieldset):
+                # Реферер и рефералы загружаются одним запросом вместе с выбранными полями
+                # профиля, а не отдельными запросами из методов сериализатора.
+                # ProfileJWTAuthentication загружает их сразу вместе с пользователем
+                user = serializer_class.optimize_queryset(
+                    User.objects.using(user._state.db), fieldset
+                ).get(pk=user.pk)
+            data = self.get_serializer(user).data
+            cache.set(cache_key, data, timeout=settings.PROFILE_CACHE_TIMEOUT)
+        return data
+
     def get(self, request, *args, **kwargs):
         """
         Переопределяем метод GET для возврата JSON или HTML в зависимости от заголовка запроса.
+        Если профиль не изменился с прошлого запроса (If-None-Match), возвращает 304 без обращения к базе данных.
+        Параметры ?fields= и ?exclude= ограничивают набор полей профиля.
         """
         user = self.get_object()
-        serializer = self.get_serializer(user)
+        fieldset = self.get_serializer_class().get_fieldset(request.query_params)
+        etag = self.get_etag(user, fieldset)
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        data = self.get_profile_data(user, fieldset)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
 
         # Проверяем, какой рендер используется (html или json)
         if request.accepted_renderer.format == "html":
             # Передаем сериализатор и его данные в шаблон
             return Response(
-                {"serializer": serializer, "user": serializer.data},
+                {
+                    "serializer": self.get_serializer(user),
+                    "user": data,
+                    "events_url": get_events_url(request, user),
+                },
                 template_name=self.template_name,
+                headers=headers,
             )
         # Если запрос на JSON, возвращаем данные пользователя в формате JSON
-        return Response(serializer.data)
+        return Response(data, headers=headers)
+
+
+class StatsAPIView(views.APIView):
+    """
+    Представление статистики реферальной системы для администраторов.
+    Читает только агрегированные таблицы, которые обновляет команда update_rollups.
+    """
+
+    permission_classes = [IsAdminUser]
+    renderer_classes = [FastJSONRenderer]
+    default_days = 30
+    max_days = 366
+    top_referrers_limit = 10
+
+    def get(self, request, *args, **kwargs):
+        """
+        Возвращает статистику по дням и самых активных рефереров за последние ?days= дней.
+        """
+        try:
+            days = int(request.query_params.get("days", self.default_days))
+        except ValueError:
+            return Response(
+                {"error": "Параметр days должен быть целым числом"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        days = min(max(days, 1), self.max_days)
+        date_from = timezone.localdate() - timedelta(days=days - 1)
+
+        fieldset = DailyStatsSerializer.get_fieldset(request.query_params)
+        daily = DailyStatsSerializer.optimize_queryset(
+            DailyStats.objects.filter(day__gte=date_from).order_by("day"), fieldset
+        )
+        top_referrers = list(
+            ReferrerDailyStats.objects.filter(day__gte=date_from)
+            .values("referrer_id")
+            .annotate(referrals=Sum("referrals"))
+            .order_by("-referrals")[: self.top_referrers_limit]
+        )
+        # Номера отдельным запросом: при шардировании рефереры находятся в других базах
+        phones = get_phones_by_id({row["referrer_id"] for row in top_referrers})
+        return Response(
+            {
+                "days": DailyStatsSerializer(
+                    daily, many=True, context={"request": request}
+                ).data,
+                "top_referrers": [
+                    {
+                        "referrer_id": row["referrer_id"],
+                        "phone": phones.get(row["referrer_id"]),
+                        "referrals": row["referrals"],
+                    }
+                    for row in top_referrers
+                ],
+            }
+        )
+
+
+class AvatarUploadAPIView(views.APIView):
+    """
+    Представление для загрузки аватара текущего пользователя.
+    Принимает multipart/form-data с полем avatar или файл в теле запроса
+    с заголовком Content-Disposition.
+    """
+
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FileUploadParser]
+    renderer_classes = [FastJSONRenderer]
+    # Запас на заголовки частей multipart/form-data сверх размера самого файла
+    multipart_overhead = 16 * 1024
+
+    def put(self, request, *args, **kwargs):
+        """
+        Сохраняет аватар и ставит генерацию миниатюр в фоновый пул процессов.
+        Файл передаётся в хранилище частями из временного файла загрузки,
+        целиком в память он не считывается.
+        """
+        # Слишком большой запрос отклоняем до чтения тела
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        if content_length > settings.AVATAR_MAX_UPLOAD_SIZE + self.multipart_overhead:
+            return Response(
+                {"error": "Слишком большой файл"},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+
+        serializer = AvatarUploadSerializer(
+            data={"avatar": request.data.get("avatar") or request.data.get("file")}
+        )
+        serializer.is_valid(raise_exception=True)
+        avatar = serializer.validated_data["avatar"]
+
+        user = request.user
+        old_avatar_name = user.avatar.name
+        user.avatar.save(avatar.name, avatar, save=False)
+        user.save(update_fields=["avatar"])
+        schedule_thumbnails(user.avatar.name)
+        if old_avatar_name and old_avatar_name != user.avatar.name:
+            delete_avatar(old_avatar_name)
+
+        return Response(
+            {
+                "avatar": user.avatar.url,
+                "avatar_thumbnails": get_thumbnail_urls(user.avatar.name),
+            }
+        )
+
+
+class BatchLookupAPIView(views.APIView):
+    """
+    Пакетная проверка инвайт-кодов и номеров телефонов для интеграций.
+    Каждый список проверяется одним запросом к базе данных. Доступна только
+    администраторам и ограничена по частоте (BATCH_LOOKUP_THROTTLE_RATE), чтобы
+    через неё нельзя было перебрать номера телефонов и инвайт-коды.
+    """
+
+    permission_classes = [IsAdminUser]
+    renderer_classes = [FastJSONRenderer]
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = "batch_lookup"
+
+    def post(self, request, *args, **kwargs):
+        """
+        Принимает {"invite_codes": [...], "phones": [...]} (до BATCH_LOOKUP_MAX_ITEMS значений)
+        и для каждого значения возвращает, существует ли пользователь, его id и есть ли у него реферер.
+        """
+        serializer = BatchLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        result = {}
+        for key, field in (("invite_codes", "invite_code"), ("phones", "phone")):
+            values = serializer.validated_data.get(key)
+            if not values:
+                continue
+            found = lookup_users(field, set(values))
+            result[key] = {}
+            for value in values:
+                user_id, invited_by_id = found.get(value, (None, None))
+                result[key][value] = {
+                    "exists": user_id is not None,
+                    "id": user_id,
+                    "has_referrer": (
+                        None if user_id is None else invited_by_id is not None
+                    ),
+                }
+        return Response(result)